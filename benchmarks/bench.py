@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of imgkit's own overhead
+
+wkhtmltoimage is replaced by ``stub_wkhtmltoimage``, a shell script that
+takes the same arguments and writes a fake image, so the timings contain
+what imgkit does around a render (config resolution, meta tag scan, CSS
+injection, argv building, process spawn and pipe I/O) and not WebKit.
+
+Usage::
+
+    python benchmarks/bench.py --iterations 200 --output results.json
+    python benchmarks/bench.py --baseline results.json --threshold 0.2
+
+Results are written as JSON, times are in milliseconds. With ``--baseline``
+every median that got slower than ``threshold`` is reported and the exit
+code is 1.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+BENCH_ROOT = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.realpath(os.path.join(BENCH_ROOT, "../src")))
+
+import imgkit  # noqa: E402
+from imgkit.process import Child  # noqa: E402
+
+STUB = os.path.join(BENCH_ROOT, "stub_wkhtmltoimage")
+OPTIONS = {"quiet": "", "width": 1024}
+SCENARIOS = ("from_string", "from_file", "from_url", "batch", "concurrent", "async")
+
+timer = getattr(time, "perf_counter", time.time)
+
+
+class Stages:
+
+    """Durations of named stages, in milliseconds"""
+
+    def __init__(self):
+        self.samples = {}
+
+    @contextmanager
+    def time(self, name):
+        start = timer()
+        yield
+        self.add(name, (timer() - start) * 1000)
+
+    def add(self, name, duration):
+        self.samples.setdefault(name, []).append(duration)
+
+    def summary(self):
+        return dict((name, summarize(values)) for name, values in self.samples.items())
+
+
+def summarize(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        median = values[middle]
+    else:
+        median = (values[middle - 1] + values[middle]) / 2.0
+    return {
+        "min": values[0],
+        "median": median,
+        "mean": sum(values) / len(values),
+        "max": values[-1],
+        "n": len(values),
+    }
+
+
+def write_fixtures(directory, html_bytes):
+    """HTML document of about ``html_bytes`` with imgkit meta tags, and a stylesheet"""
+
+    head = (
+        "<html><head>"
+        '<meta name="imgkit-format" content="jpg"/>'
+        '<meta name="imgkit-quality" content="80"/>'
+        "<title>bench</title></head><body>"
+    )
+    paragraph = "<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p>\n"
+    body = paragraph * max(1, (html_bytes - len(head)) // len(paragraph))
+    html = head + body + "</body></html>"
+
+    html_path = os.path.join(directory, "bench.html")
+    css_path = os.path.join(directory, "bench.css")
+    with open(html_path, "w") as f:
+        f.write(html)
+    with open(css_path, "w") as f:
+        f.write("body { font-size: 80px; }\np { color: #333; margin: 0 1em; }\n")
+    return html, html_path, css_path
+
+
+def staged_render(stages, source, source_type, css, path, validate_once):
+    """One render split into stages, using the same steps as ``IMGKit.to_img``"""
+
+    with stages.time("config"):
+        config = imgkit.config(
+            wkhtmltoimage=STUB, validate_once=validate_once, scan_meta_tags=False
+        )
+        config.get_wkhtmltoimage()
+
+    with stages.time("init"):
+        kit = imgkit.IMGKit(source, source_type, config=config)
+
+    # scanning was off for __init__ only, so that it is timed on its own here
+    config.scan_meta_tags = True
+    if source_type == "string":
+        with stages.time("meta_scan"):
+            kit.options.update(kit._find_options_in_meta(source))
+    kit.options.update(OPTIONS)
+
+    if css:
+        with stages.time("css"):
+            kit._prepend_css(css)
+
+    with stages.time("argv"):
+        args = kit.command(path)
+
+    payload = kit._stdin_payload()
+    with stages.time("spawn"):
+        child = Child(args, payload)
+    with stages.time("io"):
+        stdout = child.read()
+        stderr, exit_code = child.wait()
+
+    with stages.time("result"):
+        kit._handle_result(args, path, stdout, stderr, exit_code)
+
+
+def bench_single(name, iterations, fixtures, out_dir, validate_once):
+    html, html_path, css_path = fixtures
+    source, source_type, css, render = {
+        "from_string": (html, "string", css_path, imgkit.from_string),
+        "from_file": (html_path, "file", css_path, imgkit.from_file),
+        "from_url": ("http://example.com/", "url", None, imgkit.from_url),
+    }[name]
+    output = os.path.join(out_dir, name + ".jpg")
+    kwargs = {"css": css} if css else {}
+    config = imgkit.config(wkhtmltoimage=STUB, validate_once=validate_once)
+
+    stages = Stages()
+    for i in range(iterations):
+        path = output if i % 2 else False
+        staged_render(stages, source, source_type, css, path, validate_once)
+        with stages.time("end_to_end"):
+            render(source, path, options=OPTIONS, config=config, **kwargs)
+    return {"stages": stages.summary()}
+
+
+def bench_parallel(name, iterations, workers, fixtures, validate_once):
+    html = fixtures[0]
+    config = imgkit.config(wkhtmltoimage=STUB, validate_once=validate_once)
+    jobs = iterations
+
+    start = timer()
+    if name == "batch":
+        results = imgkit.render_many(
+            [{"source": html} for _ in range(jobs)],
+            max_workers=workers,
+            options=OPTIONS,
+            config=config,
+        )
+        errors = [result.error for result in results if not result.ok]
+        if errors:
+            raise errors[0]
+    elif name == "concurrent":
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(imgkit.from_string, html, False, OPTIONS, config=config)
+                for _ in range(jobs)
+            ]
+            for future in futures:
+                future.result()
+    else:
+        from bench_aio import render_strings
+
+        render_strings(html, jobs, workers, OPTIONS, config)
+    wall = timer() - start
+
+    return {
+        "jobs": jobs,
+        "workers": workers,
+        "wall_ms": wall * 1000,
+        "renders_per_second": jobs / wall,
+    }
+
+
+def run(args):
+    scenarios = args.scenarios or [
+        name for name in SCENARIOS if name != "async" or sys.version_info >= (3, 5)
+    ]
+    os.environ["IMGKIT_STUB_BYTES"] = str(args.image_bytes)
+    work_dir = tempfile.mkdtemp(prefix="imgkit-bench-")
+    try:
+        fixtures = write_fixtures(work_dir, args.html_bytes)
+        results = {}
+        for name in scenarios:
+            if name in ("batch", "concurrent", "async"):
+                results[name] = bench_parallel(
+                    name, args.iterations, args.workers, fixtures, args.validate_once
+                )
+            else:
+                results[name] = bench_single(
+                    name, args.iterations, fixtures, work_dir, args.validate_once
+                )
+    finally:
+        shutil.rmtree(work_dir)
+
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "iterations": args.iterations,
+        "workers": args.workers,
+        "html_bytes": args.html_bytes,
+        "image_bytes": args.image_bytes,
+        "validate_once": args.validate_once,
+        "unit": "ms",
+        "scenarios": results,
+    }
+
+
+def regressions(baseline, results, threshold):
+    """Medians (and throughputs) of ``results`` more than ``threshold`` worse than ``baseline``"""
+
+    found = []
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        for stage, summary in current.get("stages", {}).items():
+            before = previous.get("stages", {}).get(stage)
+            if before and summary["median"] > before["median"] * (1 + threshold):
+                found.append((name, stage, before["median"], summary["median"]))
+        if "renders_per_second" in previous:
+            before = previous["renders_per_second"]
+            if current["renders_per_second"] < before / (1 + threshold):
+                found.append(
+                    (name, "renders_per_second", before, current["renders_per_second"])
+                )
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        metavar="scenario",
+        help="scenarios to run: {}, all by default".format(", ".join(SCENARIOS)),
+    )
+    parser.add_argument("-n", "--iterations", type=int, default=100)
+    parser.add_argument("-w", "--workers", type=int, default=4)
+    parser.add_argument("--html-bytes", type=int, default=16 * 1024)
+    parser.add_argument("--image-bytes", type=int, default=64 * 1024)
+    parser.add_argument("--validate-once", action="store_true")
+    parser.add_argument("-o", "--output", help="write results to this file instead of stdout")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="relative slowdown reported as regression (default: %(default)s)",
+    )
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error("unknown scenario: {}".format(", ".join(sorted(unknown))))
+
+    results = run(args)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(baseline, results, args.threshold)
+        for name, stage, before, after in found:
+            sys.stderr.write(
+                "regression: {} {}: {:.3f} -> {:.3f}\n".format(name, stage, before, after)
+            )
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""asyncio scenario of bench.py, kept apart since it needs Python 3.5+"""
+import asyncio
+
+import imgkit
+
+
+def render_strings(html, jobs, workers, options, config):
+    """Render ``html`` ``jobs`` times with at most ``workers`` concurrent renders"""
+
+    async def run():
+        semaphore = asyncio.Semaphore(workers)
+        await asyncio.gather(
+            *[
+                imgkit.from_string_async(
+                    html, False, options, config=config, semaphore=semaphore
+                )
+                for _ in range(jobs)
+            ]
+        )
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
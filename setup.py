@@ -4,5 +4,9 @@ setup(
     name="imgkit",
     install_requires=[
         "six",
+        'futures; python_version < "3"',
     ],
+    extras_require={
+        "pillow": ["Pillow"],
+    },
 )
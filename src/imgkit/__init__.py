@@ -6,5 +6,26 @@ __contact__ = "me@jarrekk.com"
 __homepage__ = "https://github.com/jarrekk/imgkit"
 __license__ = "MIT"
 
+import sys
+
 from .api import config, from_file, from_string, from_url
+from .assets import AssetCache
+from .assetserver import AssetServer
+from .batch import RenderResult, render_many
+from .cache import CacheBackend, DiskCache, MemoryCache
+from .client import Client
+from .config import Config
+from .derivatives import Derivative
+from .errors import RenderError, TransientError
 from .imgkit import IMGKit
+from .incremental import RenderManifest
+from .libwkhtmltox import LibEngine
+from .renderer import Renderer
+from .retry import RetryPolicy
+from .scheduler import AdaptiveScheduler
+from .singleflight import SingleFlight
+from .stats import RenderStats
+from .xvfb import XvfbPool
+
+if sys.version_info >= (3, 5):
+    from .aio import from_file_async, from_string_async, from_url_async
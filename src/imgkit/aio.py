@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+"""asyncio flavour of the imgkit API, wkhtmltoimage runs without blocking the event loop"""
+import asyncio
+import functools
+import os
+import subprocess
+
+from .api import string_type
+from .imgkit import IMGKit
+from .process import kill_group, popen_options
+from .scheduler import BULK, AdaptiveScheduler
+from .stats import timer
+
+
+def _kill(process, group=False):
+    if group:
+        kill_group(process.pid)
+        return
+    try:
+        process.kill()
+    except ProcessLookupError:
+        pass
+
+
+def _blocking(func, *args, **kwargs):
+    """
+    Run ``func`` in the default executor: preparing a render may fetch assets, hash
+    manifest inputs or read and write cache entries, none of it on the event loop
+    """
+    call = functools.partial(func, *args, **kwargs)
+    return asyncio.get_event_loop().run_in_executor(None, call)
+
+
+async def _feed(stdin, chunks):
+    written = 0
+    try:
+        for chunk in chunks:
+            stdin.write(chunk)
+            written += len(chunk)
+            await stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # the child may exit without reading all its input
+        pass
+    finally:
+        stdin.close()
+    return written
+
+
+async def _run(imgkit, args, path, payload):
+    stats = imgkit.stats
+    engine = imgkit.config.engine
+    if engine is not None and engine.supports(imgkit, path):
+        loop = asyncio.get_event_loop()
+        if payload is not None and not isinstance(payload, bytes):
+            payload = b"".join(payload)
+        stats.bytes_in = len(payload) if payload else imgkit._source_size()
+        with stats.stage("engine"):
+            image = await loop.run_in_executor(None, engine.render, imgkit, payload, path)
+        stats.bytes_out = len(image)
+        with stats.stage("result"):
+            return imgkit._write_output(path, image)
+
+    pool = imgkit.xvfb_pool
+    if pool is None:
+        return await _spawn(imgkit, args, path, payload)
+    # leasing blocks until a display is free, keep that off the event loop
+    with stats.stage("xvfb"):
+        display = await asyncio.get_event_loop().run_in_executor(None, pool.acquire)
+    try:
+        return await _spawn(imgkit, args, path, payload, imgkit._display_env(display))
+    finally:
+        pool.release(display)
+
+
+async def _communicate(process, payload):
+    if payload is None or isinstance(payload, bytes):
+        stdout, stderr = await process.communicate(input=payload)
+        return len(payload or b""), stdout, stderr
+    written, stdout, stderr = await asyncio.gather(
+        _feed(process.stdin, payload),
+        process.stdout.read(),
+        process.stderr.read(),
+    )
+    await process.wait()
+    return written, stdout, stderr
+
+
+async def _spawn(imgkit, args, path, payload, env=None):
+    stats = imgkit.stats
+    group = imgkit.timeout is not None and os.name != "nt"
+    started = timer()
+    with stats.stage("spawn"):
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+            **popen_options(group, imgkit.memory_limit, imgkit.cpu_limit)
+        )
+    try:
+        written, stdout, stderr = await asyncio.wait_for(
+            _communicate(process, payload), imgkit.timeout
+        )
+    except asyncio.TimeoutError:
+        _kill(process, group)
+        await asyncio.shield(process.wait())
+        stats.exit_code = process.returncode
+        raise imgkit._timeout_error(args)
+    except BaseException:
+        # cancelled (or failed) while wkhtmltoimage is running: don't leave it behind
+        _kill(process, group)
+        await asyncio.shield(process.wait())
+        raise
+    stats.stages["process"] = timer() - started
+
+    # the event loop reaps the child, its resource usage isn't available here
+    stats.exit_code = process.returncode
+    stats.bytes_in = written if payload is not None else imgkit._source_size()
+    stats.bytes_out = len(stdout)
+    with stats.stage("result"):
+        result = imgkit._handle_result(args, path, stdout, stderr, process.returncode)
+    if path:
+        stats.bytes_out = os.path.getsize(path)
+    return result
+
+
+async def _bounded(imgkit, args, path, payload, semaphore):
+    if semaphore is None:
+        return await _run(imgkit, args, path, payload)
+    if isinstance(semaphore, AdaptiveScheduler):
+        await _acquire(semaphore, imgkit.priority)
+        try:
+            return await _run(imgkit, args, path, payload)
+        finally:
+            semaphore.release(imgkit.stats)
+    async with semaphore:
+        return await _run(imgkit, args, path, payload)
+
+
+async def _acquire(scheduler, priority):
+    """Coroutine version of ``AdaptiveScheduler.acquire``, slots may be released by threads"""
+
+    loop = asyncio.get_event_loop()
+    granted = loop.create_future()
+
+    def grant():
+        if not granted.done():
+            granted.set_result(None)
+
+    entry = scheduler._enqueue(
+        BULK if priority is None else priority, lambda: loop.call_soon_threadsafe(grant)
+    )
+    try:
+        await granted
+    except asyncio.CancelledError:
+        if not scheduler._cancel(entry):
+            # the slot was handed over while this task was being cancelled
+            scheduler.release()
+        raise
+
+
+async def to_img_async(imgkit, path=None, semaphore=None):
+    """
+    Generate image to path without blocking the event loop
+
+    Cancelling the awaiting task kills the wkhtmltoimage process.
+
+    :param imgkit: instance of imgkit.IMGKit
+    :param path: path to output image file. False means image will be returned as bytes
+    :param semaphore: (optional) asyncio.Semaphore or imgkit.scheduler.AdaptiveScheduler
+        bounding concurrent renders
+    :return: True when success, image bytes when path is False
+    """
+    started = imgkit._begin()
+    error = None
+    attempt = 1
+    try:
+        await _blocking(imgkit._publish)
+        while True:
+            try:
+                return await _to_img(imgkit, path, semaphore)
+            except Exception as e:
+                delay = imgkit._retry_delay(e, path, attempt)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        imgkit._finish(started, error)
+
+
+async def _to_img(imgkit, path, semaphore):
+    skip, fingerprint = await _blocking(imgkit._check_manifest, path)
+    if skip:
+        return True
+    result = await _write_img(imgkit, path, semaphore)
+    if fingerprint is not None:
+        imgkit.manifest.record(path, fingerprint)
+    return result
+
+
+async def _write_img(imgkit, path, semaphore):
+    flight = imgkit.config.single_flight
+    if imgkit.cache is None and flight is None and not imgkit._atomic(path):
+        if getattr(path, "write", None) or getattr(path, "sendall", None):
+            # file-like objects and sockets receive the image from stdout
+            args = await _blocking(imgkit.command)
+            data = await _bounded(imgkit, args, None, imgkit._stdin_payload(), semaphore)
+            with imgkit.stats.stage("result"):
+                return imgkit._write_output(path, data)
+        args = await _blocking(imgkit.command, path)
+        return await _bounded(imgkit, args, path, imgkit._stdin_payload(), semaphore)
+
+    def prepare():
+        args = imgkit.command(output=path)
+        payload = imgkit._buffered_payload()
+        return args, payload, imgkit._cache_key(args, payload)
+
+    args, payload, key = await _blocking(prepare)
+
+    async def render():
+        # atomic writes go through stdout and _write_output
+        if imgkit.cache is None:
+            return await _bounded(imgkit, args, None, payload, semaphore)
+        data = await _blocking(imgkit._lookup, key)
+        if data is None:
+            data = await _bounded(imgkit, args, None, payload, semaphore)
+            await _blocking(imgkit.cache.store, key, data)
+        return data
+
+    if flight is None:
+        data = await render()
+    else:
+        data, shared = await _shared(flight, key, render)
+        imgkit._shared_result(data, shared)
+    with imgkit.stats.stage("result"):
+        return await _blocking(imgkit._write_output, path, data)
+
+
+def _settle(waiter, call):
+    if not waiter.done():
+        waiter.set_result(call)
+
+
+async def _wait(call):
+    """Wait for the call of another leader, thread or coroutine, to finish"""
+
+    loop = asyncio.get_event_loop()
+    waiter = loop.create_future()
+
+    def wake(call):
+        try:
+            loop.call_soon_threadsafe(_settle, waiter, call)
+        except RuntimeError:
+            # the waiting loop is closed already
+            pass
+
+    call.add_done_callback(wake)
+    return await waiter
+
+
+async def _shared(flight, key, render):
+    """Coroutine version of ``SingleFlight.do``, the leader may be a thread or coroutine"""
+
+    while True:
+        call, leader = flight._join(key)
+        if leader:
+            break
+        call = await _wait(call)
+        if not call.abandoned:
+            return call.outcome(), True
+
+    try:
+        result = await render()
+    except BaseException as error:
+        # cancelled (an Exception before Python 3.8): the waiters render themselves
+        # instead of being cancelled too
+        if isinstance(error, asyncio.CancelledError) or not isinstance(error, Exception):
+            flight._leave(key, call, abandoned=True)
+        else:
+            flight._leave(key, call, error=error)
+        raise
+    flight._leave(key, call, result)
+    return result, False
+
+
+async def from_url_async(
+    url,
+    output_path,
+    options=None,
+    toc=None,
+    cover=None,
+    config=None,
+    cover_first=None,
+    cache=None,
+    timeout=None,
+    memory_limit=None,
+    cpu_limit=None,
+    semaphore=None,
+    priority=None,
+):
+    """
+    Convert URL/URLs to IMG file/files, see :func:`imgkit.from_url`
+
+    :param cache: (optional) instance of imgkit.cache.CacheBackend, hits skip wkhtmltoimage
+    :param timeout: (optional) seconds after which wkhtmltoimage and the processes it started
+        are killed and IMGKit.RenderTimeout is raised
+    :param memory_limit: (optional) max address space of wkhtmltoimage in bytes
+    :param cpu_limit: (optional) max CPU time of wkhtmltoimage in seconds
+    :param semaphore: (optional) asyncio.Semaphore or imgkit.scheduler.AdaptiveScheduler
+        bounding concurrent renders
+    :param priority: (optional) queue priority with an AdaptiveScheduler, e.g.
+        imgkit.scheduler.INTERACTIVE
+    """
+    rtn = IMGKit(
+        url,
+        "url",
+        options=options,
+        toc=toc,
+        cover=cover,
+        config=config,
+        cover_first=cover_first,
+        cache=cache,
+        timeout=timeout,
+        memory_limit=memory_limit,
+        cpu_limit=cpu_limit,
+        priority=priority,
+    )
+    return await to_img_async(rtn, output_path, semaphore=semaphore)
+
+
+async def from_file_async(
+    filename,
+    output_path,
+    options=None,
+    toc=None,
+    cover=None,
+    css=None,
+    config=None,
+    cover_first=None,
+    cache=None,
+    timeout=None,
+    memory_limit=None,
+    cpu_limit=None,
+    manifest=None,
+    assets=None,
+    semaphore=None,
+    priority=None,
+):
+    """
+    Convert HTML file/files to IMG file/files, see :func:`imgkit.from_file`
+
+    :param cache: (optional) instance of imgkit.cache.CacheBackend, hits skip wkhtmltoimage
+    :param timeout: (optional) seconds after which wkhtmltoimage and the processes it started
+        are killed and IMGKit.RenderTimeout is raised
+    :param memory_limit: (optional) max address space of wkhtmltoimage in bytes
+    :param cpu_limit: (optional) max CPU time of wkhtmltoimage in seconds
+    :param manifest: (optional) instance of imgkit.incremental.RenderManifest, renders to
+        output paths whose inputs didn't change are skipped
+    :param assets: (optional) instance of imgkit.assets.AssetCache, asset references are
+        pointed at local copies before rendering
+    :param semaphore: (optional) asyncio.Semaphore or imgkit.scheduler.AdaptiveScheduler
+        bounding concurrent renders
+    :param priority: (optional) queue priority with an AdaptiveScheduler, e.g.
+        imgkit.scheduler.INTERACTIVE
+    """
+    rtn = IMGKit(
+        filename,
+        "file",
+        options=options,
+        toc=toc,
+        cover=cover,
+        css=css,
+        config=config,
+        cover_first=cover_first,
+        cache=cache,
+        timeout=timeout,
+        memory_limit=memory_limit,
+        cpu_limit=cpu_limit,
+        manifest=manifest,
+        assets=assets,
+        priority=priority,
+    )
+    return await to_img_async(rtn, output_path, semaphore=semaphore)
+
+
+async def from_string_async(
+    string,
+    output_path,
+    options=None,
+    toc=None,
+    cover=None,
+    css=None,
+    config=None,
+    cover_first=None,
+    cache=None,
+    timeout=None,
+    memory_limit=None,
+    cpu_limit=None,
+    manifest=None,
+    assets=None,
+    semaphore=None,
+    priority=None,
+):
+    """
+    Convert given string/strings to IMG file, see :func:`imgkit.from_string`
+
+    :param cache: (optional) instance of imgkit.cache.CacheBackend, hits skip wkhtmltoimage
+    :param timeout: (optional) seconds after which wkhtmltoimage and the processes it started
+        are killed and IMGKit.RenderTimeout is raised
+    :param memory_limit: (optional) max address space of wkhtmltoimage in bytes
+    :param cpu_limit: (optional) max CPU time of wkhtmltoimage in seconds
+    :param manifest: (optional) instance of imgkit.incremental.RenderManifest, renders to
+        output paths whose inputs didn't change are skipped
+    :param assets: (optional) instance of imgkit.assets.AssetCache, asset references are
+        pointed at local copies before rendering
+    :param semaphore: (optional) asyncio.Semaphore or imgkit.scheduler.AdaptiveScheduler
+        bounding concurrent renders
+    :param priority: (optional) queue priority with an AdaptiveScheduler, e.g.
+        imgkit.scheduler.INTERACTIVE
+    """
+    rtn = IMGKit(
+        string,
+        string_type(config),
+        options=options,
+        toc=toc,
+        cover=cover,
+        css=css,
+        config=config,
+        cover_first=cover_first,
+        cache=cache,
+        timeout=timeout,
+        memory_limit=memory_limit,
+        cpu_limit=cpu_limit,
+        manifest=manifest,
+        assets=assets,
+        priority=priority,
+    )
+    return await to_img_async(rtn, output_path, semaphore=semaphore)
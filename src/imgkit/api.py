@@ -1,8 +1,17 @@
 # -*- coding: utf-8 -*-
+from .batch import fan_out, is_fan_out
 from .config import Config
 from .imgkit import IMGKit
 
 
+def string_type(config):
+    """Source type of strings: "served" with ``Config(asset_server=...)``, "string" otherwise"""
+
+    if config is not None and config.asset_server is not None:
+        return "served"
+    return "string"
+
+
 def from_url(
     url,
     output_path,
@@ -11,19 +20,55 @@ def from_url(
     cover=None,
     config=None,
     cover_first=None,
+    cache=None,
+    timeout=None,
+    memory_limit=None,
+    cpu_limit=None,
+    workers=None,
+    derivatives=None,
 ):
     """
     Convert URL/URLs to IMG file/files
 
     :param url: URL or list of URLs to be saved
-    :param output_path: path to output image file/files. False means file will be returned as string
+    :param output_path: path to output image file/files. False means file will be returned as string,
+        a writable file-like object or socket receives the image while it is rendered.
+        With a list of URLs, a list of paths or a template such as "out/{index}-{name}.jpg"
+        renders one image per URL, see :func:`imgkit.batch.fan_out`
     :param options: (optional) dict with wkhtmltopdf global and page options, with or w/o '--'
     :param toc: (optional) dict with toc-specific wkhtmltopdf options, with or w/o '--'
     :param cover: (optional) string with url/filename with a cover html page
     :param configuration: (optional) instance of imgkit.config.Config()
     :param cover_first: (optional) if True, cover always precedes TOC
-    :return: True when success
+    :param cache: (optional) instance of imgkit.cache.CacheBackend, hits skip wkhtmltoimage
+    :param timeout: (optional) seconds after which wkhtmltoimage and the processes it started
+        are killed and IMGKit.RenderTimeout is raised
+    :param memory_limit: (optional) max address space of wkhtmltoimage in bytes
+    :param cpu_limit: (optional) max CPU time of wkhtmltoimage in seconds
+    :param workers: (optional) max number of concurrent renders of a fan-out, defaults to the CPU count
+    :param derivatives: (optional) list of imgkit.derivatives.Derivative, see :meth:`IMGKit.to_img`
+    :return: True when success, list of imgkit.batch.RenderResult for a fan-out,
+        list of derivative results with derivatives
     """
+    if is_fan_out(url, output_path):
+        if derivatives:
+            raise ValueError("derivatives can't be made for a fan-out")
+        return fan_out(
+            url,
+            "url",
+            output_path,
+            workers,
+            options=options,
+            config=config,
+            toc=toc,
+            cover=cover,
+            cover_first=cover_first,
+            cache=cache,
+            timeout=timeout,
+            memory_limit=memory_limit,
+            cpu_limit=cpu_limit,
+        )
+
     rtn = IMGKit(
         url,
         "url",
@@ -32,8 +77,12 @@ def from_url(
         cover=cover,
         config=config,
         cover_first=cover_first,
+        cache=cache,
+        timeout=timeout,
+        memory_limit=memory_limit,
+        cpu_limit=cpu_limit,
     )
-    return rtn.to_img(output_path)
+    return rtn.to_img(output_path, derivatives)
 
 
 def from_file(
@@ -45,20 +94,65 @@ def from_file(
     css=None,
     config=None,
     cover_first=None,
+    cache=None,
+    timeout=None,
+    memory_limit=None,
+    cpu_limit=None,
+    manifest=None,
+    assets=None,
+    workers=None,
+    derivatives=None,
 ):
     """
     Convert HTML file/files to IMG file/files
 
     :param filename: path of HTML file or list with paths or file-like object
-    :param output_path: path to output image file/files. False means file will be returned as string
+    :param output_path: path to output image file/files. False means file will be returned as string,
+        a writable file-like object or socket receives the image while it is rendered.
+        With a list of paths, a list of output paths or a template such as "out/{name}.jpg"
+        renders one image per file, see :func:`imgkit.batch.fan_out`
     :param options: (optional) dict with wkhtmltopdf global and page options, with or w/o '--'
     :param toc: (optional) dict with toc-specific wkhtmltopdf options, with or w/o '--'
     :param cover: (optional) string with url/filename with a cover html page
     :param css: style of input
     :param configuration: (optional) instance of imgkit.config.Config()
     :param cover_first: (optional) if True, cover always precedes TOC
-    :return: True when success
+    :param cache: (optional) instance of imgkit.cache.CacheBackend, hits skip wkhtmltoimage
+    :param timeout: (optional) seconds after which wkhtmltoimage and the processes it started
+        are killed and IMGKit.RenderTimeout is raised
+    :param memory_limit: (optional) max address space of wkhtmltoimage in bytes
+    :param cpu_limit: (optional) max CPU time of wkhtmltoimage in seconds
+    :param manifest: (optional) instance of imgkit.incremental.RenderManifest, renders to
+        output paths whose inputs didn't change are skipped
+    :param assets: (optional) instance of imgkit.assets.AssetCache, asset references are
+        pointed at local copies before rendering
+    :param workers: (optional) max number of concurrent renders of a fan-out, defaults to the CPU count
+    :param derivatives: (optional) list of imgkit.derivatives.Derivative, see :meth:`IMGKit.to_img`
+    :return: True when success, list of imgkit.batch.RenderResult for a fan-out,
+        list of derivative results with derivatives
     """
+    if is_fan_out(filename, output_path):
+        if derivatives:
+            raise ValueError("derivatives can't be made for a fan-out")
+        return fan_out(
+            filename,
+            "file",
+            output_path,
+            workers,
+            options=options,
+            config=config,
+            toc=toc,
+            cover=cover,
+            css=css,
+            cover_first=cover_first,
+            cache=cache,
+            timeout=timeout,
+            memory_limit=memory_limit,
+            cpu_limit=cpu_limit,
+            manifest=manifest,
+            assets=assets,
+        )
+
     rtn = IMGKit(
         filename,
         "file",
@@ -68,8 +162,14 @@ def from_file(
         css=css,
         config=config,
         cover_first=cover_first,
+        cache=cache,
+        timeout=timeout,
+        memory_limit=memory_limit,
+        cpu_limit=cpu_limit,
+        manifest=manifest,
+        assets=assets,
     )
-    return rtn.to_img(output_path)
+    return rtn.to_img(output_path, derivatives)
 
 
 def from_string(
@@ -81,31 +181,55 @@ def from_string(
     css=None,
     config=None,
     cover_first=None,
+    cache=None,
+    timeout=None,
+    memory_limit=None,
+    cpu_limit=None,
+    manifest=None,
+    assets=None,
+    derivatives=None,
 ):
     """
     Convert given string/strings to IMG file
 
     :param string:
-    :param output_path: path to output PDF file/files. False means file will be returned as string
+    :param output_path: path to output PDF file/files. False means file will be returned as string,
+        a writable file-like object or socket receives the image while it is rendered
     :param options: (optional) dict with wkhtmltopdf global and page options, with or w/o '--'
     :param toc: (optional) dict with toc-specific wkhtmltopdf options, with or w/o '--'
     :param cover: (optional) string with url/filename with a cover html page
     :param css: style of input
     :param configuration: (optional) instance of imgkit.config.Config()
     :param cover_first: (optional) if True, cover always precedes TOC
-    :return: True when success
+    :param cache: (optional) instance of imgkit.cache.CacheBackend, hits skip wkhtmltoimage
+    :param timeout: (optional) seconds after which wkhtmltoimage and the processes it started
+        are killed and IMGKit.RenderTimeout is raised
+    :param memory_limit: (optional) max address space of wkhtmltoimage in bytes
+    :param cpu_limit: (optional) max CPU time of wkhtmltoimage in seconds
+    :param manifest: (optional) instance of imgkit.incremental.RenderManifest, renders to
+        output paths whose inputs didn't change are skipped
+    :param assets: (optional) instance of imgkit.assets.AssetCache, asset references are
+        pointed at local copies before rendering
+    :param derivatives: (optional) list of imgkit.derivatives.Derivative, see :meth:`IMGKit.to_img`
+    :return: True when success, list of derivative results with derivatives
     """
     rtn = IMGKit(
         string,
-        "string",
+        string_type(config),
         options=options,
         toc=toc,
         cover=cover,
         css=css,
         config=config,
         cover_first=cover_first,
+        cache=cache,
+        timeout=timeout,
+        memory_limit=memory_limit,
+        cpu_limit=cpu_limit,
+        manifest=manifest,
+        assets=assets,
     )
-    return rtn.to_img(output_path)
+    return rtn.to_img(output_path, derivatives)
 
 
 def config(**kwargs):
@@ -114,6 +238,7 @@ def config(**kwargs):
 
     :param wkhtmltopdf: path to binary
     :param meta_tag_prefix: the prefix for ``imgkit`` specific meta tags
+    :param validate_once: check binaries are readable only once per process
     """
 
     return Config(**kwargs)
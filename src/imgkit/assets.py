@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+import threading
+
+from six.moves.urllib.parse import urljoin, urlparse
+from six.moves.urllib.request import pathname2url, url2pathname, urlopen
+
+_replace = getattr(os, "replace", os.rename)
+
+# script and style contents first: CSS is only rewritten in style elements and
+# attributes, never in scripts or text
+_MARKUP = re.compile(
+    r"(<script\b[^>]*>)(.*?</script\s*>)"
+    r"|(<style\b[^>]*>)(.*?)(</style\s*>)"
+    r"|<([a-z][\w:-]*)\b[^>]*>",
+    re.I | re.S,
+)
+_ASSET_TAGS = ("img", "script", "link")
+_STYLE_ATTR = re.compile(r"""(?<=\s)(style\s*=\s*)(["'])(.*?)\2""", re.I | re.S)
+_ATTR = re.compile(r"""(\b(?:src|href)\s*=\s*)(["'])(.*?)\2""", re.I | re.S)
+_REL = re.compile(r"""\brel\s*=\s*["']?[^"'>]*\b(?:stylesheet|icon)\b""", re.I)
+_CSS_URL = re.compile(r"""url\(\s*(["']?)([^"')]+?)\1\s*\)""", re.I)
+_CSS_IMPORT = re.compile(r"""(@import\s+)(["'])(.*?)\2""", re.I)
+_CSS_CHARSET = re.compile(br"""^@charset\s+"([^"]+)"\s*;""")
+
+# references that are not fetched
+_SKIP = ("data:", "#", "javascript:", "about:", "mailto:")
+
+
+def _stamp(url):
+    """Modification time and size of the file at file ``url``, None for other urls"""
+
+    parsed = urlparse(url)
+    if parsed.scheme != "file":
+        return None
+    try:
+        stat = os.stat(url2pathname(parsed.path))
+    except OSError:
+        return None
+    return getattr(stat, "st_mtime_ns", stat.st_mtime), stat.st_size
+
+
+def file_url(path):
+    """file:// url of local ``path``"""
+
+    return urljoin("file:", pathname2url(os.path.abspath(path)))
+
+
+class AssetCache:
+
+    """
+    Local copies of the images, fonts, scripts and stylesheets that HTML sources reference
+
+    :meth:`rewrite` points ``<img>``, ``<script>``, stylesheet ``<link>``, CSS
+    ``url()`` (``@font-face`` sources among them) and ``@import`` references at
+    local copies, fetched once per process (local files again once they changed):
+    data URIs for small assets and files in ``directory`` for the others. Stylesheets are rewritten the same way
+    before they are stored. wkhtmltoimage then reads them without network or disk
+    access. References that can't be fetched are left to wkhtmltoimage, made
+    absolute when they are relative. One cache can be shared between threads.
+    """
+
+    def __init__(self, directory=None, inline_limit=64 * 1024, timeout=10):
+        """
+        :param directory: (optional) directory for copies of remote assets larger than
+            ``inline_limit``, without it every asset becomes a data URI
+        :param inline_limit: size in bytes up to which assets become data URIs
+        :param timeout: seconds to wait for a remote asset
+        """
+        self.directory = directory
+        self.inline_limit = inline_limit
+        self.timeout = timeout
+        self.fetches = 0
+        self._references = {}
+        self._lock = threading.Lock()
+        # urls whose stylesheet this thread is rewriting, for @import cycles
+        self._rewriting = threading.local()
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _fetch(self, url):
+        """:return: tuple (bytes, mime type, True if ``url`` is a local file)"""
+
+        parsed = urlparse(url)
+        mime = mimetypes.guess_type(parsed.path)[0]
+        if parsed.scheme == "file":
+            with open(url2pathname(parsed.path), "rb") as f:
+                return f.read(), mime, True
+        response = urlopen(url, timeout=self.timeout)
+        try:
+            data = response.read()
+            content_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+        finally:
+            response.close()
+        return data, content_type or mime, False
+
+    def _store(self, url, data, mime, local):
+        if len(data) <= self.inline_limit or (self.directory is None and not local):
+            encoded = base64.b64encode(data).decode("ascii")
+            return "data:{};base64,{}".format(mime or "application/octet-stream", encoded)
+        if local:
+            # a large local file is read from where it is
+            return url
+
+        name = hashlib.sha256(url.encode("utf-8")).hexdigest()[:32]
+        path = os.path.join(self.directory, name + os.path.splitext(urlparse(url).path)[1])
+        if not os.path.exists(path):
+            fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".imgkit-")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            _replace(tmp, path)
+        return file_url(path)
+
+    def reference(self, url):
+        """
+        Local reference to the asset at ``url``, fetched on first use
+
+        :param url: absolute http, https or file url
+        :return: data URI or file url, None when the asset can't be fetched
+        """
+        # local files are fetched again once their modification time or size changed
+        stamp = _stamp(url)
+        with self._lock:
+            cached = self._references.get(url)
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+
+        rewriting = self._rewriting.__dict__.setdefault("urls", set())
+        if url in rewriting:
+            # a stylesheet importing itself, directly or not
+            return None
+        rewriting.add(url)
+        try:
+            data, mime, local = self._fetch(url)
+            if mime == "text/css":
+                data = self._rewrite_stylesheet(data, url)
+        except (IOError, OSError, ValueError):
+            # not retried, a broken reference costs one fetch per process
+            reference = None
+        else:
+            reference = self._store(url, data, mime, local)
+        finally:
+            rewriting.discard(url)
+        with self._lock:
+            self.fetches += 1
+            self._references[url] = (stamp, reference)
+        return reference
+
+    def _rewrite_stylesheet(self, data, url):
+        """Stylesheet bytes with local references, ValueError when they can't be decoded"""
+
+        match = _CSS_CHARSET.match(data)
+        charset = match.group(1).decode("ascii", "replace") if match else "utf-8"
+        try:
+            return self.rewrite_css(data.decode(charset), url).encode(charset)
+        except LookupError:
+            raise ValueError("unknown charset {} of {}".format(charset, url))
+
+    @staticmethod
+    def _resolve(reference, base):
+        reference = reference.strip().replace("&amp;", "&")
+        if not reference or reference.startswith(_SKIP):
+            return None
+        if base:
+            url = urljoin(base, reference)
+        elif reference.startswith("//"):
+            url = "https:" + reference
+        else:
+            url = reference
+        scheme = urlparse(url).scheme
+        if scheme in ("http", "https", "file"):
+            return url
+        if not scheme and os.path.isabs(url):
+            return file_url(url)
+        return None
+
+    def _local(self, reference, base):
+        url = self._resolve(reference, base)
+        if url is None:
+            return reference
+        return self.reference(url) or url
+
+    def rewrite_css(self, css, base=None):
+        """
+        Point the ``url()`` and ``@import`` references of ``css`` at local copies
+
+        :param css: str with CSS
+        :param base: (optional) url relative references are resolved against,
+            without it they are left alone
+        """
+        css = _CSS_URL.sub(
+            lambda m: "url({0}{1}{0})".format(m.group(1), self._local(m.group(2), base)),
+            css,
+        )
+        return _CSS_IMPORT.sub(
+            lambda m: m.group(1) + m.group(2) + self._local(m.group(3), base) + m.group(2),
+            css,
+        )
+
+    def rewrite(self, html, base=None):
+        """
+        Point the asset references of ``html`` at local copies
+
+        Tag attributes, ``<style>`` elements and ``style`` attributes are rewritten,
+        script code and text are left as they are.
+
+        :param html: str with HTML
+        :param base: (optional) url relative references are resolved against,
+            e.g. :func:`file_url` of the HTML file; without it they are left alone
+        """
+
+        def tag(text, name):
+            if name in _ASSET_TAGS and (name != "link" or _REL.search(text)):
+                text = _ATTR.sub(
+                    lambda m: m.group(1) + m.group(2) + self._local(m.group(3), base) + m.group(2),
+                    text,
+                )
+            return _STYLE_ATTR.sub(
+                lambda m: m.group(1) + m.group(2) + self.rewrite_css(m.group(3), base) + m.group(2),
+                text,
+            )
+
+        def markup(match):
+            if match.group(1) is not None:
+                return tag(match.group(1), "script") + match.group(2)
+            if match.group(3) is not None:
+                return (
+                    tag(match.group(3), "style")
+                    + self.rewrite_css(match.group(4), base)
+                    + match.group(5)
+                )
+            return tag(match.group(0), match.group(6).lower())
+
+        return _MARKUP.sub(markup, html)
+
+    def clear(self):
+        """Forget the fetched assets, files in ``directory`` are kept"""
+
+        with self._lock:
+            self._references.clear()
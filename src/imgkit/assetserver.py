@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import atexit
+import email.utils
+import hashlib
+import mimetypes
+import os
+import posixpath
+import shutil
+import threading
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import unquote, urlparse
+
+# pages are served from the root so that their relative references hit ``directory``
+PAGE_PREFIX = "/.imgkit-"
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # keep-alive: WebKit loads every asset of a page over a few connections
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _headers(self, status, content_type, length, last_modified=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(length))
+        self.send_header("Cache-Control", "max-age={}".format(self.server.owner.max_age))
+        if last_modified is not None:
+            self.send_header("Last-Modified", email.utils.formatdate(last_modified, usegmt=True))
+        self.end_headers()
+
+    def _not_found(self):
+        self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self, body=True):
+        path = unquote(urlparse(self.path).path)
+        if path.startswith(PAGE_PREFIX):
+            page = self.server.owner._pages.get(path[len(PAGE_PREFIX) :])
+            if page is None:
+                return self._not_found()
+            self._headers(200, "text/html; charset=utf-8", len(page[0]))
+            if body:
+                self.wfile.write(page[0])
+            return
+
+        filename = self.server.owner.translate(path)
+        if filename is None or not os.path.isfile(filename):
+            return self._not_found()
+        with open(filename, "rb") as f:
+            stat = os.fstat(f.fileno())
+            content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            self._headers(200, content_type, stat.st_size, stat.st_mtime)
+            if body:
+                shutil.copyfileobj(f, self.wfile)
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+
+class _HTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class AssetServer:
+
+    """
+    Local HTTP server thread for the ``served`` source type
+
+    HTML of ``served`` sources is published under a url of the server while it
+    renders, and wkhtmltoimage loads it from there instead of reading it from
+    stdin. Everything else is served from ``directory``, so relative asset
+    references of the HTML resolve to its files. Responses carry ``Cache-Control``
+    and connections are kept alive. One server is meant to be shared by all renders
+    of a process, see :func:`shared_server` and ``Config(asset_server=...)``.
+    """
+
+    def __init__(self, directory=None, host="127.0.0.1", port=0, max_age=3600):
+        """
+        :param directory: (optional) directory of the assets, without it only pages are served
+        :param host: address to listen on, keep it local
+        :param port: port to listen on, a free one by default
+        :param max_age: seconds the responses may be cached for
+        """
+        self.directory = os.path.abspath(directory) if directory else None
+        self.host = host
+        self.port = port
+        self.max_age = max_age
+        self._pages = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._exit_registered = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        """Start the server thread, called on first publish if not called explicitly"""
+
+        with self._lock:
+            if self._server is not None:
+                return
+            self._server = _HTTPServer((self.host, self.port), _Handler)
+            self._server.owner = self
+            self.port = self._server.server_address[1]
+            thread = threading.Thread(target=self._server.serve_forever, name="imgkit-assets")
+            thread.daemon = True
+            thread.start()
+            if not self._exit_registered:
+                atexit.register(self.close)
+                self._exit_registered = True
+
+    @property
+    def url(self):
+        """Root url of the server"""
+
+        return "http://{}:{}/".format(self.host, self.port)
+
+    def translate(self, path):
+        """Path of the file for url ``path`` in ``directory``, None without directory"""
+
+        if self.directory is None:
+            return None
+        path = posixpath.normpath(path)
+        # ".." can't leave the directory
+        parts = [part for part in path.split("/") if part and part not in (".", "..")]
+        return os.path.join(self.directory, *parts)
+
+    def publish(self, html):
+        """
+        Serve ``html`` until :meth:`unpublish` is called as often as ``publish``
+
+        Pages are addressed by their content, the same HTML gets the same url.
+
+        :param html: str or bytes of the page, str is encoded as UTF-8
+        :return: url of the page
+        """
+        self.start()
+        if not isinstance(html, bytes):
+            html = html.encode("utf-8")
+        name = hashlib.sha256(html).hexdigest()[:32] + ".html"
+        with self._lock:
+            data, count = self._pages.get(name, (html, 0))
+            self._pages[name] = (data, count + 1)
+        return self.url + PAGE_PREFIX[1:] + name
+
+    def unpublish(self, url):
+        """Stop serving the page at ``url`` returned by :meth:`publish`"""
+
+        name = url.rsplit(PAGE_PREFIX, 1)[-1]
+        with self._lock:
+            data, count = self._pages.get(name, (None, 0))
+            if count > 1:
+                self._pages[name] = (data, count - 1)
+            else:
+                self._pages.pop(name, None)
+
+    def close(self):
+        """Stop the server"""
+
+        with self._lock:
+            server, self._server = self._server, None
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+
+def shared_server():
+    """Process-wide AssetServer without asset directory, started on first use"""
+
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = AssetServer()
+        return _shared
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from six import string_types
+
+from .config import Config
+from .imgkit import IMGKit
+from .scheduler import BULK
+
+
+class RenderResult:
+
+    """Outcome of a single job rendered by :func:`render_many`"""
+
+    def __init__(self, index, job, output=None, error=None, stats=None):
+        """
+        :param index: position of the job in the input sequence
+        :param job: the job dict as it was passed in
+        :param output: value returned by ``IMGKit.to_img`` (True or image bytes)
+        :param error: exception raised while rendering, if any
+        :param stats: imgkit.stats.RenderStats of the render, None if it didn't start
+        """
+        self.index = index
+        self.job = job
+        self.output = output
+        self.error = error
+        self.stats = stats
+
+    @property
+    def ok(self):
+        """True when the job rendered without raising"""
+
+        return self.error is None
+
+    def __repr__(self):
+        state = "ok" if self.ok else "error={!r}".format(self.error)
+        return "<RenderResult #{} {}>".format(self.index, state)
+
+
+def _job_imgkit(job, options, config):
+    """:return: tuple (IMGKit for ``job``, its output path)"""
+
+    params = dict(job)
+    source = params.pop("source")
+    source_type = params.pop("type", "string")
+    output_path = params.pop("output_path", False)
+
+    job_options = dict(options or {})
+    job_options.update(params.pop("options", None) or {})
+
+    rtn = IMGKit(
+        source,
+        source_type,
+        options=job_options,
+        config=params.pop("config", None) or config,
+        **params
+    )
+    return rtn, output_path
+
+
+def _run_job(index, job, options, config, scheduler=None):
+    result = RenderResult(index, job)
+    rtn = None
+    try:
+        rtn, output_path = _job_imgkit(job, options, config)
+        if scheduler is None:
+            result.output = rtn.to_img(output_path)
+        else:
+            with scheduler.slot(rtn):
+                result.output = rtn.to_img(output_path)
+    except Exception as error:
+        result.error = error
+    if rtn is not None:
+        result.stats = rtn.stats
+    return result
+
+
+def render_many(jobs, max_workers=None, options=None, config=None, scheduler=None):
+    """
+    Render many sources concurrently with a bounded pool of wkhtmltoimage processes
+
+    Each job is a dict with a ``source`` key and optionally ``type`` ("url", "file"
+    or "string", defaults to "string"), ``output_path`` (defaults to False, i.e. return
+    the image), ``options``, ``toc``, ``cover``, ``css``, ``config``, ``cover_first`` and
+    ``priority`` (see ``scheduler``).
+
+    :param jobs: iterable of job dicts
+    :param max_workers: (optional) max number of concurrent renders, defaults to the CPU count
+    :param options: (optional) dict with options shared by all jobs, per-job options take precedence
+    :param config: (optional) instance of imgkit.config.Config() used by jobs without their own
+    :param scheduler: (optional) instance of imgkit.scheduler.AdaptiveScheduler, it decides
+        how many jobs render at a time (``max_workers`` defaults to its ``max_workers``)
+        and jobs are started by priority
+    :return: list of :class:`RenderResult` in the same order as ``jobs``
+    """
+    jobs = list(jobs)
+    if not jobs:
+        return []
+
+    config = config or Config()
+    order = list(range(len(jobs)))
+    if scheduler is not None:
+        max_workers = max_workers or scheduler.max_workers
+        order.sort(key=lambda index: _priority(jobs[index]))
+    max_workers = max_workers or multiprocessing.cpu_count()
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+        futures = dict(
+            (index, executor.submit(_run_job, index, jobs[index], options, config, scheduler))
+            for index in order
+        )
+        return [futures[index].result() for index in range(len(jobs))]
+
+
+def _priority(job):
+    priority = job.get("priority")
+    return BULK if priority is None else priority
+
+
+def _output_name(source, source_type):
+    if source_type == "url":
+        name = source.split("://", 1)[-1]
+    else:
+        name = os.path.splitext(os.path.basename(source))[0]
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", name).strip("_") or "image"
+
+
+def is_fan_out(sources, output_path):
+    """True when ``sources`` are rendered one image each, see :func:`fan_out`"""
+
+    if not isinstance(sources, (list, tuple)):
+        return False
+    if isinstance(output_path, (list, tuple)):
+        return True
+    return isinstance(output_path, string_types) and "{" in output_path
+
+
+def fan_out(
+    sources,
+    source_type,
+    output_path,
+    workers=None,
+    options=None,
+    config=None,
+    scheduler=None,
+    **kwargs
+):
+    """
+    Render every source to its own image, in parallel
+
+    :param sources: list of urls or paths of HTML files
+    :param source_type: "url" or "file"
+    :param output_path: list with one output path (or False) per source, or a template
+        formatted with ``index`` (position of the source) and ``name`` (file name
+        without extension, or the url made file name safe), e.g. "out/{index}-{name}.jpg"
+    :param workers: (optional) max number of concurrent renders, defaults to the CPU count
+    :param options: (optional) dict with wkhtmltoimage options for all sources
+    :param config: (optional) instance of imgkit.config.Config()
+    :param scheduler: (optional) instance of imgkit.scheduler.AdaptiveScheduler, see
+        :func:`render_many`
+    :param kwargs: other IMGKit arguments (toc, cover, css, cache, timeout, ...) for all sources
+    :return: list of :class:`RenderResult` in the same order as ``sources``
+    """
+    if isinstance(output_path, (list, tuple)):
+        if len(output_path) != len(sources):
+            raise ValueError(
+                "{} sources need as many output paths, got {}".format(
+                    len(sources), len(output_path)
+                )
+            )
+        outputs = list(output_path)
+    else:
+        outputs = [
+            output_path.format(index=index, name=_output_name(source, source_type))
+            for index, source in enumerate(sources)
+        ]
+
+    jobs = [
+        dict(kwargs, source=source, type=source_type, output_path=output)
+        for source, output in zip(sources, outputs)
+    ]
+    return render_many(
+        jobs, max_workers=workers, options=options, config=config, scheduler=scheduler
+    )
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+_replace = getattr(os, "replace", os.rename)
+
+
+def cache_key(args, payload=None, files=None):
+    """
+    Content address of a render
+
+    :param args: wkhtmltoimage argv, without the output path
+    :param payload: (optional) bytes piped to wkhtmltoimage stdin
+    :param files: (optional) paths of input files read by wkhtmltoimage itself
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    for arg in args:
+        digest.update(arg.encode("utf-8"))
+        digest.update(b"\0")
+    if payload is not None:
+        digest.update(b"\1")
+        digest.update(payload)
+    for path in files or ():
+        digest.update(b"\2")
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CacheBackend:
+
+    """
+    Base class for render caches
+
+    Subclasses implement :meth:`get` and :meth:`set`; IMGKit calls :meth:`lookup`
+    and :meth:`store` which also keep the hit/miss counters.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get(self, key):
+        """Return cached image bytes for ``key`` or None"""
+
+        raise NotImplementedError
+
+    def set(self, key, data):
+        """Store image bytes under ``key``"""
+
+        raise NotImplementedError
+
+    def lookup(self, key):
+        data = self.get(key)
+        with self._stats_lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def store(self, key, data):
+        self.set(key, data)
+
+    def stats(self):
+        """dict with ``hits`` and ``misses`` counters"""
+
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class MemoryCache(CacheBackend):
+
+    """In-process LRU cache bounded by entry count and total size"""
+
+    def __init__(self, max_entries=1024, max_bytes=None):
+        """
+        :param max_entries: max number of cached images
+        :param max_bytes: (optional) max total size of cached images
+        """
+        CacheBackend.__init__(self)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.pop(key, None)
+            if data is not None:
+                self._entries[key] = data
+            return data
+
+    def set(self, key, data):
+        if self.max_bytes is not None and len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = data
+            self.size += len(data)
+            while len(self._entries) > self.max_entries or (
+                self.max_bytes is not None and self.size > self.max_bytes
+            ):
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class DiskCache(CacheBackend):
+
+    """Directory of cached images, least recently used files are evicted past ``max_bytes``"""
+
+    def __init__(self, directory, max_bytes=None):
+        """
+        :param directory: cache directory, created if missing
+        :param max_bytes: (optional) max total size of the cache directory
+        """
+        CacheBackend.__init__(self)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # index existing entries, oldest access first
+        self._entries = OrderedDict()
+        stats = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and not name.startswith("."):
+                stat = os.stat(path)
+                stats.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(stats):
+            self._entries[name] = size
+            self.size += size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except IOError:
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries[key] = self._entries.pop(key)
+        try:
+            os.utime(self._path(key), None)
+        except OSError:
+            pass
+        return data
+
+    def set(self, key, data):
+        if self.max_bytes is not None and len(data) > self.max_bytes:
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        _replace(tmp, self._path(key))
+
+        evicted = []
+        with self._lock:
+            self.size -= self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self.size += len(data)
+            while self.max_bytes is not None and self.size > self.max_bytes:
+                name, size = self._entries.popitem(last=False)
+                self.size -= size
+                evicted.append(name)
+        for name in evicted:
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
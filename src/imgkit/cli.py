@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+imgkit command line: render the jobs of a JSONL manifest
+
+Each manifest line is a JSON object with ``source``, ``output`` and optionally
+``type`` ("url", "file" or "string", defaults to "url"), ``options`` and other
+IMGKit arguments (``css``, ``toc``, ``cover``, ``timeout``, ...)::
+
+    {"source": "http://google.com", "output": "google.jpg", "options": {"width": 800}}
+
+One JSON line per job is written to the results log, in the order jobs finish.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .batch import _run_job
+from .config import Config
+from .incremental import RenderManifest
+from .retry import RetryPolicy
+from .stats import timer
+
+
+def read_manifest(f):
+    """
+    Generator of tuples (line number, job dict or None, error message or None)
+
+    :param f: file object of the JSONL manifest
+    """
+    for number, line in enumerate(f, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError as error:
+            yield number, None, "invalid JSON: {}".format(error)
+            continue
+        if not isinstance(entry, dict) or "source" not in entry or "output" not in entry:
+            yield number, None, "a job needs 'source' and 'output'"
+            continue
+        job = dict(entry)
+        job["output_path"] = job.pop("output")
+        job.setdefault("type", "url")
+        yield number, job, None
+
+
+def _parse_option(text):
+    name, _, value = text.partition("=")
+    return name, value
+
+
+def _record(number, job, status, **fields):
+    record = {"line": number, "status": status}
+    if job is not None:
+        record["source"] = job["source"] if job["type"] != "string" else None
+        record["output"] = job["output_path"]
+    record.update(fields)
+    return record
+
+
+def _result_record(number, result, seconds):
+    stats = result.stats
+    if not result.ok:
+        status = "error"
+    elif stats is not None and stats.skipped:
+        status = "unchanged"
+    else:
+        status = "ok"
+    record = _record(number, result.job, status, seconds=seconds)
+    if not result.ok:
+        record["error"] = str(result.error).strip()
+        record["error_class"] = type(result.error).__name__
+    if stats is not None:
+        record.update(
+            retries=stats.retries,
+            stages=stats.stages,
+            exit_code=stats.exit_code,
+            bytes_out=stats.bytes_out,
+            max_rss=stats.max_rss,
+        )
+    return record
+
+
+def _timed_job(number, job, options, config):
+    started = timer()
+    result = _run_job(number, job, options, config)
+    return _result_record(number, result, timer() - started)
+
+
+def _rendered(path):
+    return os.path.isfile(path) and os.path.getsize(path) > 0
+
+
+def _jobs(manifest, resume, render_manifest):
+    """Jobs to render and records of the ones that are not, in manifest order"""
+
+    for number, job, error in read_manifest(manifest):
+        if job is None:
+            yield number, None, _record(number, None, "invalid", error=error)
+        elif resume and _rendered(job["output_path"]):
+            yield number, None, _record(number, job, "skipped")
+        else:
+            if render_manifest is not None:
+                job["manifest"] = render_manifest
+            yield number, job, None
+
+
+def run(
+    manifest,
+    log,
+    concurrency=None,
+    resume=False,
+    options=None,
+    config=None,
+    render_manifest=None,
+):
+    """
+    Render the jobs of ``manifest`` and write a record of each to ``log``
+
+    :param manifest: file object of the JSONL manifest
+    :param log: file object receiving the JSONL results
+    :param concurrency: (optional) max number of concurrent renders, defaults to the CPU count
+    :param resume: skip jobs whose output exists already
+    :param options: (optional) dict with options shared by all jobs
+    :param config: (optional) instance of imgkit.config.Config()
+    :param render_manifest: (optional) instance of imgkit.incremental.RenderManifest,
+        jobs whose inputs didn't change since their last render are skipped; it is
+        saved before returning
+    :return: dict counting the records by status
+    """
+    config = config or Config()
+    concurrency = concurrency or multiprocessing.cpu_count()
+    counts = {"ok": 0, "unchanged": 0, "error": 0, "skipped": 0, "invalid": 0}
+
+    def emit(record):
+        counts[record["status"]] += 1
+        log.write(json.dumps(record, sort_keys=True) + "\n")
+        log.flush()
+
+    # keep a bounded number of jobs in flight so that huge manifests are streamed
+    pending = set()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for number, job, record in _jobs(manifest, resume, render_manifest):
+                if record is not None:
+                    emit(record)
+                    continue
+                pending.add(executor.submit(_timed_job, number, job, options, config))
+                if len(pending) >= concurrency * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        emit(future.result())
+            for future in pending:
+                emit(future.result())
+    finally:
+        if render_manifest is not None:
+            render_manifest.save()
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="imgkit",
+        description="Render the jobs of a JSONL manifest with wkhtmltoimage.",
+        epilog='manifest line: {"source": "http://google.com", "output": "google.jpg", '
+        '"type": "url", "options": {"width": 800}}',
+    )
+    parser.add_argument(
+        "manifest", nargs="?", default="-", help="JSONL manifest, stdin by default"
+    )
+    parser.add_argument(
+        "-j",
+        "--concurrency",
+        type=int,
+        default=None,
+        help="number of concurrent renders (default: CPU count)",
+    )
+    parser.add_argument(
+        "-r", "--resume", action="store_true", help="skip jobs whose output exists"
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        metavar="MANIFEST",
+        help="render manifest file, skip jobs whose inputs didn't change since it was saved",
+    )
+    parser.add_argument("-l", "--log", help="results log, stdout by default")
+    parser.add_argument(
+        "-O",
+        "--option",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="wkhtmltoimage option for all jobs, e.g. -O width=800 (--quiet is always set)",
+    )
+    parser.add_argument("--wkhtmltoimage", default="", help="path of wkhtmltoimage")
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=0,
+        help="render jobs again up to this many times after network, X server or crash failures",
+    )
+    args = parser.parse_args(argv)
+
+    # wkhtmltoimage progress would end up in the results log on stdout
+    options = {"quiet": ""}
+    options.update(_parse_option(option) for option in args.option)
+    retry = RetryPolicy(attempts=args.retries + 1) if args.retries else None
+    config = Config(wkhtmltoimage=args.wkhtmltoimage, validate_once=True, retry=retry)
+    render_manifest = RenderManifest(args.incremental) if args.incremental else None
+
+    manifest = sys.stdin if args.manifest == "-" else open(args.manifest)
+    log = open(args.log, "a") if args.log else sys.stdout
+    try:
+        counts = run(
+            manifest,
+            log,
+            args.concurrency,
+            args.resume,
+            options,
+            config,
+            render_manifest,
+        )
+    finally:
+        if manifest is not sys.stdin:
+            manifest.close()
+        if log is not sys.stdout:
+            log.close()
+
+    sys.stderr.write(
+        "{ok} rendered, {unchanged} unchanged, {skipped} skipped, {error} failed, "
+        "{invalid} invalid\n".format(**counts)
+    )
+    return 1 if counts["error"] or counts["invalid"] else 0
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Client of the imgkit render server, see :mod:`imgkit.server`
+
+Messages are a JSON header and a binary body, framed as::
+
+    4 bytes header length | 4 bytes body length | header | body
+
+lengths being unsigned big-endian integers. A request header holds the source
+``type`` and the IMGKit arguments, its body is the url, path or HTML string. The
+reply header holds ``ok`` and ``stats``, or ``error`` and ``class`` on failure,
+its body is the image.
+"""
+import json
+import os
+import socket
+import struct
+
+from six import string_types
+
+from . import errors
+from .imgkit import IMGKit
+
+_LENGTHS = struct.Struct(">II")
+
+# upper bound of a header or body, a corrupt length must not allocate gigabytes
+MAX_MESSAGE = 512 * 1024 ** 2
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            raise EOFError("connection closed in the middle of a message")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_message(sock, header, body=b""):
+    """
+    Send one message
+
+    :param sock: connected socket
+    :param header: JSON serializable dict
+    :param body: bytes
+    """
+    data = json.dumps(header).encode("utf-8")
+    sock.sendall(_LENGTHS.pack(len(data), len(body)) + data)
+    if body:
+        sock.sendall(body)
+
+
+def recv_message(sock):
+    """
+    Receive one message
+
+    :param sock: connected socket
+    :return: tuple (header dict, body bytes), None when the peer closed the connection
+    """
+    first = sock.recv(_LENGTHS.size)
+    if not first:
+        return None
+    lengths = first + _recv_exactly(sock, _LENGTHS.size - len(first))
+    header_size, body_size = _LENGTHS.unpack(lengths)
+    if header_size > MAX_MESSAGE or body_size > MAX_MESSAGE:
+        raise ValueError("message of {} bytes is too large".format(header_size + body_size))
+    header = json.loads(_recv_exactly(sock, header_size).decode("utf-8"))
+    return header, _recv_exactly(sock, body_size)
+
+
+class Client:
+
+    """
+    Renders through an imgkit render server instead of starting wkhtmltoimage here
+
+    Methods mirror :func:`imgkit.from_url`, :func:`imgkit.from_file` and
+    :func:`imgkit.from_string`. The server runs on the same host, so file and css
+    paths are sent as absolute paths and read by the server. A Client can be
+    shared between threads, each call uses its own connection.
+    """
+
+    def __init__(self, path, timeout=None):
+        """
+        :param path: path of the server Unix socket
+        :param timeout: (optional) seconds to wait for the server, on top of the render
+        """
+        self.path = path
+        self.timeout = timeout
+
+    @staticmethod
+    def _options(options, output_path):
+        """``options`` with the format of the extension of ``output_path`` unless they set one"""
+
+        options = dict(options or {})
+        if isinstance(output_path, string_types) and not any(
+            key.lstrip("-").lower() == "format" for key in options
+        ):
+            extension = os.path.splitext(output_path)[1][1:].lower()
+            if extension:
+                # the server renders to stdout, where there is no extension to go by
+                options["format"] = extension
+        return options or None
+
+    def _render(self, source_type, source, output_path, params):
+        params["options"] = self._options(params.get("options"), output_path)
+        header = dict((name, value) for name, value in params.items() if value is not None)
+        header["type"] = source_type
+        if params.get("timeout") is not None and self.timeout is not None:
+            wait = params["timeout"] + self.timeout
+        else:
+            wait = self.timeout
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(wait)
+            sock.connect(self.path)
+            send_message(sock, header, source.encode("utf-8"))
+            reply = recv_message(sock)
+        finally:
+            sock.close()
+        if reply is None:
+            raise OSError("imgkit server closed the connection without a reply")
+        reply, image = reply
+
+        if not reply.get("ok"):
+            error = reply.get("error", "unknown error")
+            if reply.get("class") == "RenderTimeout":
+                raise IMGKit.RenderTimeout(error)
+            error_class = getattr(errors, reply.get("class", ""), None)
+            if isinstance(error_class, type) and issubclass(error_class, errors.RenderError):
+                raise error_class(error)
+            raise OSError(error)
+        if not output_path:
+            return image
+        write = getattr(output_path, "write", None)
+        if write is not None:
+            write(image)
+            return True
+        with open(output_path, "wb") as f:
+            f.write(image)
+        return True
+
+    @staticmethod
+    def _paths(value):
+        if not value:
+            return value
+        if isinstance(value, string_types):
+            return os.path.abspath(value)
+        return [os.path.abspath(path) for path in value]
+
+    def from_url(
+        self,
+        url,
+        output_path,
+        options=None,
+        toc=None,
+        cover=None,
+        cover_first=None,
+        timeout=None,
+        memory_limit=None,
+        cpu_limit=None,
+    ):
+        """
+        Convert URL to IMG file or bytes, see :func:`imgkit.from_url`
+
+        :return: True when saved to ``output_path``, image bytes when it is False
+        """
+        return self._render(
+            "url",
+            url,
+            output_path,
+            dict(
+                options=options,
+                toc=toc,
+                cover=cover,
+                cover_first=cover_first,
+                timeout=timeout,
+                memory_limit=memory_limit,
+                cpu_limit=cpu_limit,
+            ),
+        )
+
+    def from_file(
+        self,
+        filename,
+        output_path,
+        options=None,
+        toc=None,
+        cover=None,
+        css=None,
+        cover_first=None,
+        timeout=None,
+        memory_limit=None,
+        cpu_limit=None,
+    ):
+        """
+        Convert HTML file to IMG file or bytes, see :func:`imgkit.from_file`
+
+        :return: True when saved to ``output_path``, image bytes when it is False
+        """
+        return self._render(
+            "file",
+            os.path.abspath(filename),
+            output_path,
+            dict(
+                options=options,
+                toc=toc,
+                cover=cover,
+                css=self._paths(css),
+                cover_first=cover_first,
+                timeout=timeout,
+                memory_limit=memory_limit,
+                cpu_limit=cpu_limit,
+            ),
+        )
+
+    def from_string(
+        self,
+        string,
+        output_path,
+        options=None,
+        toc=None,
+        cover=None,
+        css=None,
+        cover_first=None,
+        timeout=None,
+        memory_limit=None,
+        cpu_limit=None,
+    ):
+        """
+        Convert given string to IMG file or bytes, see :func:`imgkit.from_string`
+
+        :return: True when saved to ``output_path``, image bytes when it is False
+        """
+        return self._render(
+            "string",
+            string,
+            output_path,
+            dict(
+                options=options,
+                toc=toc,
+                cover=cover,
+                css=self._paths(css),
+                cover_first=cover_first,
+                timeout=timeout,
+                memory_limit=memory_limit,
+                cpu_limit=cpu_limit,
+            ),
+        )
@@ -1,44 +1,137 @@
 # -*- coding: utf-8 -*-
+import os
 import subprocess
+import threading
 from subprocess import CalledProcessError
 
 from six import raise_from
 
+# get binaries in *nix/windows server
+# see https://github.com/jarrekk/imgkit/issues/57 for windows condition
+FIND_COMMANDS = ("where", "which") if os.name == "nt" else ("which", "where")
+
+# process-wide caches shared by all Config instances:
+# (binary name, PATH) -> resolved path, and paths that passed validation
+_resolved = {}
+_validated = set()
+_lock = threading.Lock()
+
+
+def _find_binary(name):
+    """Resolve ``name`` on PATH with where/which, cached per PATH value"""
+
+    key = (name, os.environ.get("PATH", ""))
+    path = _resolved.get(key)
+    if path:
+        return path
+
+    path = "command not found"
+    for find_cmd in FIND_COMMANDS:
+        try:
+            path = subprocess.check_output([find_cmd, name]).strip().decode("utf-8")
+            # `where` lists every match, one per line
+            path = path.splitlines()[0] if path else "command not found"
+            break
+        except CalledProcessError:
+            pass
+        except OSError:
+            pass
+
+    # failed lookups are not cached so that a later install is picked up
+    if path != "command not found":
+        with _lock:
+            _resolved[key] = path
+    return path
+
 
 class Config:
 
     """Config class to configure wkhtmltoimage, xvfb-run and meta tag prefix"""
 
-    def __init__(self, wkhtmltoimage="", xvfb="", meta_tag_prefix="imgkit-"):
+    def __init__(
+        self,
+        wkhtmltoimage="",
+        xvfb="",
+        meta_tag_prefix="imgkit-",
+        validate_once=False,
+        xvfb_pool=None,
+        scan_meta_tags=True,
+        engine=None,
+        hooks=None,
+        single_flight=None,
+        atomic_writes=False,
+        asset_server=None,
+        retry=None,
+    ):
         """
         Configure wkhtmltoimage, xvfb, meta_tag_prefix.
 
         :param wkhtmltoimage: wkhtmltoimage path
         :param xvfb: xvfb path
         :param meta_tag_prefix: the prefix for `imgkit` specific meta tags - by default this is `imgkit-`
+        :param validate_once: check that a binary is readable only the first time
+            its path is seen in this process instead of on every lookup
+        :param xvfb_pool: (optional) instance of imgkit.xvfb.XvfbPool, renders with the
+            ``xvfb`` option then lease one of its displays instead of running xvfb-run
+        :param scan_meta_tags: look for options in the meta tags of string sources,
+            disable it to skip the scan when no meta tag options are used
+        :param engine: (optional) instance of imgkit.libwkhtmltox.LibEngine, renders it
+            supports then run in its worker processes instead of a new wkhtmltoimage
+        :param hooks: (optional) callables called as ``hook(imgkit, stats)`` after each
+            render, successful or not, with its imgkit.stats.RenderStats; exceptions
+            they raise are logged to the "imgkit.imgkit" logger, not raised
+        :param single_flight: (optional) instance of imgkit.singleflight.SingleFlight,
+            concurrent identical renders through ``to_img`` then share one wkhtmltoimage
+        :param atomic_writes: write output paths through a temporary file in the same
+            directory that is checked to hold an image and then renamed into place
+        :param asset_server: (optional) instance of imgkit.assetserver.AssetServer for
+            ``served`` sources; ``from_string`` then loads strings through it
+        :param retry: (optional) instance of imgkit.retry.RetryPolicy, renders failing with
+            a transient imgkit.errors.RenderError are done again
         """
         self.wkhtmltoimage = wkhtmltoimage
         self.xvfb = xvfb
         self.meta_tag_prefix = meta_tag_prefix
+        self.validate_once = validate_once
+        self.xvfb_pool = xvfb_pool
+        self.scan_meta_tags = scan_meta_tags
+        self.engine = engine
+        self.hooks = list(hooks or ())
+        self.single_flight = single_flight
+        self.atomic_writes = atomic_writes
+        self.asset_server = asset_server
+        self.retry = retry
+
+    @staticmethod
+    def clear_cache():
+        """Forget resolved and validated binary paths, e.g. after installing wkhtmltopdf"""
+
+        with _lock:
+            _resolved.clear()
+            _validated.clear()
+
+    def _validate(self, path, error):
+        if path == "command not found":
+            raise OSError(error)
+
+        if self.validate_once and path in _validated:
+            return
+
+        try:
+            with open(path):
+                pass
+        except IOError as io_error:
+            raise_from(OSError(error), io_error)
+
+        if self.validate_once:
+            with _lock:
+                _validated.add(path)
 
     def get_wkhtmltoimage(self):
         """Get wkhtmltoimage binary path"""
 
         if not self.wkhtmltoimage:
-            # get wkhtmltoimage in *nix/windows server
-            # see https://github.com/jarrekk/imgkit/issues/57 for windows condition
-            for find_cmd in ("where", "which"):
-                try:
-                    self.wkhtmltoimage = (
-                        subprocess.check_output([find_cmd, "wkhtmltoimage"])
-                        .strip()
-                        .decode("utf-8")
-                    )
-                    break
-                except CalledProcessError:
-                    self.wkhtmltoimage = "command not found"
-                except OSError:
-                    self.wkhtmltoimage = "command not found"
+            self.wkhtmltoimage = _find_binary("wkhtmltoimage")
 
         wkhtmltoimage_error = """
 No wkhtmltoimage executable found: "{0}"\nIf this file exists please check that this process can read it.
@@ -47,35 +140,14 @@ Otherwise please install wkhtmltopdf - http://wkhtmltopdf.org\n
             self.wkhtmltoimage
         )
 
-        if self.wkhtmltoimage != "command not found":
-            try:
-                with open(self.wkhtmltoimage):
-                    pass
-            except IOError as io_error:
-                raise_from(OSError(wkhtmltoimage_error), io_error)
-        else:
-            raise OSError(wkhtmltoimage_error)
-
+        self._validate(self.wkhtmltoimage, wkhtmltoimage_error)
         return self.wkhtmltoimage
 
     def get_xvfb(self):
         """Get xvfb-run binary path"""
 
         if not self.xvfb:
-            # get xvfb in *nix/windows server
-            # see https://github.com/jarrekk/imgkit/issues/57 for windows condition
-            for find_cmd in ("where", "which"):
-                try:
-                    self.xvfb = (
-                        subprocess.check_output([find_cmd, "xvfb-run"])
-                        .strip()
-                        .decode("utf-8")
-                    )
-                    break
-                except CalledProcessError:
-                    self.xvfb = "command not found"
-                except OSError:
-                    self.xvfb = "command not found"
+            self.xvfb = _find_binary("xvfb-run")
 
         xvfb_error = """
 No xvfb executable found: "{0}"\nIf this file exists please check that this process can read it.
@@ -84,12 +156,5 @@ Otherwise please install xvfb.\n
             self.xvfb
         )
 
-        if self.xvfb != "command not found":
-            try:
-                with open(self.xvfb):
-                    pass
-            except IOError as io_error:
-                raise_from(OSError(xvfb_error), io_error)
-        else:
-            raise OSError(xvfb_error)
+        self._validate(self.xvfb, xvfb_error)
         return self.xvfb
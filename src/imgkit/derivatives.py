@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Resized and re-encoded copies of a render, made with Pillow (pip install imgkit[pillow])"""
+import io
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+from six import string_types
+
+FITS = ("thumbnail", "resize")
+
+
+def _pillow():
+    try:
+        from PIL import Image, ImageFile
+    except ImportError:
+        raise ImportError(
+            "Derivatives need Pillow, install it with: pip install imgkit[pillow]"
+        )
+    return Image, ImageFile
+
+
+class Derivative:
+
+    """One image made from a render: resized and/or re-encoded with Pillow"""
+
+    def __init__(self, output=None, size=None, format=None, fit="thumbnail", **options):
+        """
+        :param output: (optional) path or writable file object, None returns the image bytes
+        :param size: (optional) tuple (width, height), the rendered size by default
+        :param format: (optional) Pillow format name such as "WEBP" or "PNG", by default
+            taken from the extension of ``output`` or the format of the render
+        :param fit: "thumbnail" fits the image into ``size`` keeping its aspect ratio,
+            "resize" scales it to exactly ``size``
+        :param options: passed to ``PIL.Image.Image.save``, e.g. quality=80
+        """
+        if fit not in FITS:
+            raise ValueError("fit must be one of {}".format(", ".join(FITS)))
+        self.output = output
+        self.size = tuple(size) if size else None
+        self.format = format
+        self.fit = fit
+        self.options = options
+
+    def _format(self, image):
+        if self.format:
+            return self.format.upper()
+        if isinstance(self.output, string_types):
+            Image, _ = _pillow()
+            Image.init()
+            extension = self.output.rsplit(".", 1)[-1].lower()
+            return Image.EXTENSION.get("." + extension, image.format)
+        return image.format
+
+    def make(self, image):
+        """
+        Write the derivative of decoded ``image``
+
+        :param image: PIL.Image.Image of the render, left unchanged
+        :return: image bytes when ``output`` is None, True otherwise
+        """
+        fmt = self._format(image)
+        derived = image.copy()
+        if self.size and self.fit == "thumbnail":
+            derived.thumbnail(self.size)
+        elif self.size:
+            derived = derived.resize(self.size)
+        if fmt == "JPEG" and derived.mode not in ("RGB", "L", "CMYK"):
+            derived = derived.convert("RGB")
+
+        if self.output is None:
+            buffer = io.BytesIO()
+            derived.save(buffer, fmt, **self.options)
+            return buffer.getvalue()
+        derived.save(self.output, fmt, **self.options)
+        return True
+
+    def __repr__(self):
+        return "<Derivative {} {} {}>".format(
+            self.format or "auto", "x".join(map(str, self.size or ())) or "full", self.fit
+        )
+
+
+class Decoder:
+
+    """Decodes an image while its chunks arrive"""
+
+    def __init__(self):
+        _, ImageFile = _pillow()
+        self._parser = ImageFile.Parser()
+
+    def feed(self, chunk):
+        self._parser.feed(chunk)
+
+    def close(self):
+        """:return: the decoded PIL.Image.Image"""
+
+        image = self._parser.close()
+        image.load()
+        return image
+
+
+def make_all(image, derivatives, max_workers=None):
+    """
+    Make every derivative of ``image``, encoding them in a thread pool
+
+    :param image: decoded PIL.Image.Image
+    :param derivatives: list of :class:`Derivative`
+    :param max_workers: (optional) max number of encoding threads, defaults to the CPU count
+    :return: list with the result of each :meth:`Derivative.make`, in order
+    """
+    if len(derivatives) == 1:
+        return [derivatives[0].make(image)]
+
+    max_workers = min(max_workers or multiprocessing.cpu_count(), len(derivatives))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(derivative.make, image) for derivative in derivatives]
+        return [future.result() for future in futures]
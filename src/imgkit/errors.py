@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Classified wkhtmltoimage failures
+
+All of them are OSError, what imgkit raised before they existed. ``transient``
+tells failures worth rendering again (network, X server, killed process) from
+the ones that fail the same way every time (missing content, bad options,
+resource limits).
+"""
+import signal
+
+
+class RenderError(OSError):
+
+    """wkhtmltoimage failed, see :func:`classify`"""
+
+    transient = False
+
+    def __init__(self, message, exit_code=None, stderr=""):
+        """
+        :param message: error message
+        :param exit_code: (optional) exit code of wkhtmltoimage, negative when killed by a signal
+        :param stderr: (optional) what wkhtmltoimage wrote to stderr
+        """
+        OSError.__init__(self, message)
+        self.exit_code = exit_code
+        self.stderr = stderr
+
+
+class TransientError(RenderError):
+
+    """Failure that may not happen again"""
+
+    transient = True
+
+
+class NetworkError(TransientError):
+
+    """The page or one of its resources couldn't be loaded over the network"""
+
+
+class DisplayError(TransientError):
+
+    """wkhtmltoimage couldn't connect to an X server"""
+
+
+class CrashError(TransientError):
+
+    """wkhtmltoimage was killed by a signal, e.g. by the OOM killer"""
+
+
+class ResourceLimitError(RenderError):
+
+    """wkhtmltoimage went over its ``memory_limit`` or ``cpu_limit``, it would again"""
+
+
+class InputError(RenderError):
+
+    """The source can't be rendered: missing file, unknown protocol, denied access"""
+
+
+class OptionError(RenderError):
+
+    """wkhtmltoimage didn't accept an option"""
+
+
+# markers in wkhtmltoimage stderr, most specific first; network errors are
+# reported with their Qt QNetworkReply::NetworkError name
+_MARKERS = (
+    (
+        DisplayError,
+        ("cannot connect to X server", "QXcbConnection", "could not connect to display"),
+    ),
+    (
+        InputError,
+        (
+            "ContentNotFoundError",
+            "ContentAccessDenied",
+            "ContentOperationNotPermittedError",
+            "ProtocolUnknownError",
+            "ProtocolInvalidOperationError",
+            "AuthenticationRequiredError",
+        ),
+    ),
+    (
+        NetworkError,
+        (
+            "HostNotFoundError",
+            "ConnectionRefusedError",
+            "RemoteHostClosedError",
+            "TimeoutError",
+            "TemporaryNetworkFailureError",
+            "NetworkSessionFailedError",
+            "ProxyConnectionRefusedError",
+            "ProxyConnectionClosedError",
+            "ProxyNotFoundError",
+            "ProxyTimeoutError",
+            "UnknownNetworkError",
+            "SslHandshakeFailedError",
+        ),
+    ),
+    (OptionError, ("Unknown long argument", "Unknown switch", "Unknown option")),
+)
+
+# failed allocations under RLIMIT_AS end in an abort with one of these on stderr
+_MEMORY_MARKERS = ("bad_alloc", "Cannot allocate memory", "Out of memory", "out of memory")
+
+# signals are missing on Windows
+_SIGABRT = getattr(signal, "SIGABRT", None)
+_SIGKILL = getattr(signal, "SIGKILL", None)
+_SIGXCPU = getattr(signal, "SIGXCPU", None)
+
+
+def _over_limit(stderr, exit_code, memory_limit, cpu_limit):
+    if exit_code is None or exit_code >= 0:
+        return False
+    signum = -exit_code
+    # RLIMIT_CPU sends SIGXCPU at the soft limit and SIGKILL at the hard one
+    if signum == _SIGXCPU or (cpu_limit and signum == _SIGKILL):
+        return True
+    return bool(memory_limit) and (
+        signum == _SIGABRT or any(marker in stderr for marker in _MEMORY_MARKERS)
+    )
+
+
+def classify(message, stderr="", exit_code=None, memory_limit=None, cpu_limit=None):
+    """
+    Exception for a failed render, picked from the stderr and exit code of wkhtmltoimage
+
+    :param message: error message
+    :param stderr: what wkhtmltoimage wrote to stderr
+    :param exit_code: (optional) exit code of wkhtmltoimage
+    :param memory_limit: (optional) max address space wkhtmltoimage ran with
+    :param cpu_limit: (optional) max CPU time wkhtmltoimage ran with
+    :return: instance of a :class:`RenderError` subclass, RenderError itself when unknown
+    """
+    for error_class, markers in _MARKERS:
+        if any(marker in stderr for marker in markers):
+            return error_class(message, exit_code, stderr)
+    if _over_limit(stderr, exit_code, memory_limit, cpu_limit):
+        return ResourceLimitError(message, exit_code, stderr)
+    if exit_code is not None and exit_code < 0:
+        return CrashError(message, exit_code, stderr)
+    return RenderError(message, exit_code, stderr)
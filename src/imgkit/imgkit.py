@@ -1,14 +1,34 @@
 # -*- coding: utf-8 -*-
 import codecs
 import io
+import logging
+import os
 import re
-import subprocess
 import sys
+import time
 
 from six import raise_from, string_types
 
+from .assets import file_url
+from .assetserver import shared_server
+from .cache import cache_key
 from .config import Config
+from .errors import DisplayError, TransientError, classify
+from .output import AtomicFile
+from .process import CHUNK_SIZE, Child
 from .source import Source
+from .stats import RenderStats, timer
+from .stylesheets import style_block
+
+
+_META_TAG = re.compile(r"<meta\s([^>]*)>", re.IGNORECASE)
+_META_ATTR = re.compile(
+    r"""([^\s"'=<>/]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'=<>`]+))"""
+)
+_HEAD_END = re.compile(r"</head\s*>", re.IGNORECASE)
+
+
+logger = logging.getLogger(__name__)
 
 
 class IMGKit:
@@ -25,31 +45,75 @@ class IMGKit:
             Exception.__init__(self)
             self.message = message
 
+    class RenderTimeout(TransientError):
+
+        """wkhtmltoimage didn't finish in time and was killed"""
+
     def __init__(self, url_or_file, source_type, options=None, config=None, **kwargs):
         """Deliver parameters into IMGkit"""
 
-        params = ["toc", "cover", "cover_first", "css"]
+        params = [
+            "toc",
+            "cover",
+            "cover_first",
+            "css",
+            "cache",
+            "timeout",
+            "memory_limit",
+            "cpu_limit",
+            "manifest",
+            "assets",
+            "priority",
+        ]
         for param in params:
             setattr(self, param, kwargs.get(param, None))
         self.source = Source(url_or_file, source_type)
         self.config = Config() if not config else config
-        self.wkhtmltoimage = self.config.get_wkhtmltoimage()
+        # measurements of the latest render, see imgkit.stats.RenderStats
+        self.stats = RenderStats()
 
         self.options = {}
-        if self.source.isString():
-            self.options.update(self._find_options_in_meta(url_or_file))
+        if self.source.isString() or self.source.isServed():
+            with self.stats.stage("meta_scan"):
+                self.options.update(self._find_options_in_meta(url_or_file))
+
+        # a prebuilt command prefix (see imgkit.Renderer) already holds the
+        # resolved binaries and options, unless the source has meta tag options
+        self.args_prefix = None if self.options else kwargs.get("args_prefix")
+        if self.args_prefix is None:
+            with self.stats.stage("config"):
+                self.wkhtmltoimage = self.config.get_wkhtmltoimage()
+        else:
+            self.wkhtmltoimage = self.config.wkhtmltoimage
 
         if options:
             self.options.update(options)
 
+        # with a pool of running Xvfb displays renders lease one of them
+        # instead of starting a new X server through xvfb-run
+        self.xvfb_pool = None
         if options and "xvfb" in options:
-            self.xvfb = self.config.get_xvfb()
+            if self.config.xvfb_pool is not None:
+                self.xvfb_pool = self.config.xvfb_pool
+            elif self.args_prefix is None:
+                with self.stats.stage("config"):
+                    self.xvfb = self.config.get_xvfb()
+            else:
+                self.xvfb = self.config.xvfb
 
         self.toc = self.toc if self.toc else {}
         self.cover = self.cover
         self.cover_first = self.cover_first
         self.css = self.css
         self.stylesheets = []
+        self.head_style = None
+        self.unstyled_source = None
+        self._assets_inlined = False
+        self.served_url = None
+        self._served_by = None
+        # --format of the latest command writing to stdout, see command(output=...)
+        self.output_format = None
+        self._setup_stages = dict(self.stats.stages)
 
     def _gegetate_args(self, options):
         """Generator of args parts based on options specification."""
@@ -66,20 +130,19 @@ class IMGKit:
             else:
                 yield optval
 
-    def _command(self, path=None):
-        """Generator of all command parts"""
+    def _command_prefix(self):
+        """Generator of the command parts that don't depend on source and output"""
 
         options = self._gegetate_args(self.options)
         options = [x for x in options]
-        if self.css:
-            self._prepend_css(self.css)
 
         if "--xvfb" in options:
             options.remove("--xvfb")
-            yield self.xvfb
-            # auto servernum option to prevent failure on concurrent runs
-            # https://bugs.launchpad.net/ubuntu/+source/xorg-server/+bug/348052
-            yield "-a"
+            if self.xvfb_pool is None:
+                yield self.xvfb
+                # auto servernum option to prevent failure on concurrent runs
+                # https://bugs.launchpad.net/ubuntu/+source/xorg-server/+bug/348052
+                yield "-a"
 
         yield self.wkhtmltoimage
 
@@ -101,9 +164,33 @@ class IMGKit:
             yield "cover"
             yield self.cover
 
+    def _command(self, path=None, fmt=None):
+        """Generator of all command parts"""
+
+        if self.args_prefix is not None:
+            prefix = self.args_prefix
+        else:
+            prefix = self._command_prefix()
+        for argpart in prefix:
+            yield argpart
+
+        # images written to stdout have no extension to take the format from
+        if fmt is not None and not path:
+            yield "--format"
+            yield fmt
+
         # If the source is a string then we will pipe it into wkhtmltoimage
         # If the source is file-like then we will read from it and pipe it in
-        if self.source.isString() or self.source.isFileObj():
+        # as well as files that get stylesheets injected
+        # Served sources are loaded from the asset server while they render
+        if self.served_url is not None:
+            yield self.served_url
+        elif (
+            self.source.isString()
+            or self.source.isServed()
+            or self.source.isFileObj()
+            or self.head_style is not None
+        ):
             yield "-"
         else:
             if isinstance(self.source.source, string_types):
@@ -119,10 +206,39 @@ class IMGKit:
         else:
             yield "-"
 
-    def command(self, path=None):
-        """Generate command"""
+    def command(self, path=None, output=None):
+        """
+        Generate command
+
+        :param path: output path given to wkhtmltoimage, stdout when None
+        :param output: (optional) path the image written to stdout is saved to,
+            its extension is the format like it would be for ``path``
+        """
+
+        if self.assets is not None and not self._assets_inlined:
+            with self.stats.stage("assets"):
+                self._inline_assets()
+        if self.css:
+            with self.stats.stage("css"):
+                self._prepend_css(self.css)
+        with self.stats.stage("argv"):
+            self.output_format = None if path else self._output_format(output)
+            return list(self._command(path, self.output_format))
 
-        return list(self._command(path))
+    def _has_format(self):
+        """True when the options set ``--format``"""
+
+        return any(key == "--format" for key, _ in self._normalize_options(self.options))
+
+    def _output_format(self, path):
+        """
+        Format wkhtmltoimage takes from the extension of ``path``, None when it is the
+        format of stdout anyway (jpg) or given by ``--format``
+        """
+        if not path or not isinstance(path, string_types) or self._has_format():
+            return None
+        fmt = os.path.splitext(path)[1][1:].lower()
+        return fmt if fmt not in ("", "jpg", "jpeg") else None
 
     def _normalize_options(self, options):
         """
@@ -153,9 +269,29 @@ class IMGKit:
     def _normalize_arg(arg):
         return arg.lower()
 
-    @staticmethod
-    def _style_tag(stylesheet):
-        return "<style>{}</style>".format(stylesheet)
+    def _inline_assets(self):
+        """Point the asset references of the source at the local copies of ``self.assets``"""
+
+        if self.source.isUrl() or isinstance(self.source.source, list):
+            raise self.SourceError(
+                "Assets can be inlined only for a single file or string"
+            )
+
+        if self.source.isString() or self.source.isServed():
+            self.source.source = self.assets.rewrite(self.source.to_s())
+        else:
+            # the rewritten file is piped into wkhtmltoimage as a string
+            base = None
+            if self.source.isFileObj():
+                html = self.source.source.read()
+            else:
+                base = file_url(self.source.source)
+                with open(self.source.source, "rb") as f:
+                    html = f.read()
+            if isinstance(html, bytes):
+                html = html.decode("utf-8")
+            self.source = Source(self.assets.rewrite(html, base), "string")
+        self._assets_inlined = True
 
     def _prepend_css(self, path):
         if self.source.isUrl() or isinstance(self.source.source, list):
@@ -166,104 +302,208 @@ class IMGKit:
         if not isinstance(path, list):
             path = [path]
 
-        css_data = []
-        for css_file in path:
-            with codecs.open(css_file, encoding="UTF-8") as f:
-                css_data.append(f.read())
-        css_data = "\n".join(css_data)
+        style, style_bytes = style_block(path)
 
         if self.source.isFile():
-            with codecs.open(self.source.to_s(), encoding="UTF-8") as f:
-                inp = f.read()
-            self.source = Source(
-                inp.replace("</head>", self._style_tag(css_data) + "</head>"), "string"
-            )
-
-        elif self.source.isString():
-            if "</head>" in self.source.to_s():
-                self.source.source = self.source.to_s().replace(
-                    "</head>", self._style_tag(css_data) + "</head>"
-                )
+            # injected while the file is streamed into wkhtmltoimage's stdin
+            self.head_style = style_bytes
+
+        elif self.source.isString() or self.source.isServed():
+            # splice into the original string, command() may run more than once
+            if self.unstyled_source is None:
+                self.unstyled_source = self.source.to_s()
+            html = self.unstyled_source
+            index = html.find("</head>")
+            if index == -1:
+                self.source.source = style + html
             else:
-                self.source.source = self._style_tag(css_data) + self.source.to_s()
+                self.source.source = html[:index] + style + html[index:]
+
+    def _publish(self):
+        """
+        Put the HTML of a ``served`` source on the asset server until :meth:`_finish`
+
+        Only renders publish: outside of them :meth:`command` pipes the HTML in.
+        """
+        if not self.source.isServed() or self.served_url is not None:
+            return
+        # the page is the HTML with its assets and stylesheets
+        self.command()
+        with self.stats.stage("serve"):
+            self._served_by = self.config.asset_server or shared_server()
+            self.served_url = self._served_by.publish(self.source.to_s())
 
     def _find_options_in_meta(self, content):
         """Reads 'content' and extracts options encoded in HTML meta tags
 
+        Only the document head is scanned, up to the first ``</head>``.
+
         :param content: str or file-like object - contains HTML to parse
 
         returns:
           dict: {config option: value}
         """
 
+        prefix = self.config.meta_tag_prefix
+        if not self.config.scan_meta_tags:
+            return {}
+
         if (
             isinstance(content, io.IOBase)
             or content.__class__.__name__ == "StreamReaderWriter"
         ):
-            content = content.read()
+            content = self._read_head(content)
 
-        found = {}
+        head_end = _HEAD_END.search(content)
+        end = head_end.start() if head_end else len(content)
 
-        for con in re.findall("<meta [^>]*>", content):
-            if re.search("name=[\"']{}".format(self.config.meta_tag_prefix), con):
-                name = re.findall(
-                    "name=[\"']{}([^\"']*)".format(self.config.meta_tag_prefix), con
-                )[0]
-                found[name] = re.findall("content=[\"']([^\"']*)", con)[0]
+        found = {}
+        for tag in _META_TAG.finditer(content, 0, end):
+            attrs = {}
+            for attr in _META_ATTR.finditer(tag.group(1)):
+                value = attr.group(2)
+                if value is None:
+                    value = attr.group(3) if attr.group(3) is not None else attr.group(4)
+                attrs.setdefault(attr.group(1).lower(), value)
+
+            name = attrs.get("name", "")
+            if name.startswith(prefix) and "content" in attrs:
+                found[name[len(prefix) :]] = attrs["content"]
 
         return found
 
-    def to_img(self, path=None):
-        """Generate image to path"""
+    @staticmethod
+    def _read_head(f):
+        """Read ``f`` up to the end of its head, then rewind it if possible"""
+
+        start = f.tell() if f.seekable() else None
+        chunks = []
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if isinstance(chunk, bytes):
+                chunk = chunk.decode("utf-8", "ignore")
+            chunks.append(chunk)
+            if _HEAD_END.search(chunks[-1] if len(chunks) == 1 else "".join(chunks[-2:])):
+                break
+        if start is not None:
+            f.seek(start)
+        return "".join(chunks)
 
-        args = self.command(path)
+    @staticmethod
+    def _iter_html(f, head_style=None, prefix=b""):
+        """
+        Yield the content of ``f`` as utf-8 encoded chunks
 
-        result = subprocess.Popen(
-            args,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
+        :param f: file object, opened in binary or text mode
+        :param head_style: (optional) bytes inserted before the first ``</head>``,
+            or at the start of the document if it has none, like for strings
+        :param prefix: (optional) bytes yielded first
+        """
+
+        marker = b"</head>"
+        # with a style, the content is held back until the marker tells where it goes
+        pending = bytearray()
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode("utf-8")
+            if head_style is None:
+                yield prefix + chunk if prefix else chunk
+                prefix = b""
+                continue
+
+            # the marker may start in the previous chunk
+            start = max(0, len(pending) - len(marker) + 1)
+            pending += chunk
+            idx = pending.find(marker, start)
+            if idx != -1:
+                yield prefix + bytes(pending[:idx]) + head_style + bytes(pending[idx:])
+                prefix = b""
+                pending = bytearray()
+                head_style = None
+
+        if head_style is not None:
+            prefix += head_style
+        if prefix or pending:
+            yield prefix + bytes(pending)
+
+    def _iter_file(self, path, head_style):
+        with open(path, "rb") as f:
+            for chunk in self._iter_html(f, head_style, b'<meta charset="UTF-8">'):
+                yield chunk
+
+    def _stdin_payload(self):
+        """
+        What to pipe into wkhtmltoimage: bytes, an iterator of byte chunks for
+        file sources, or None when it reads the source itself
+        """
 
         # If the source is a string then we will pipe it into wkhtmltoimage.
-        # If we want to add custom CSS to file then we read input file to
-        # string and prepend css to it and then pass it to stdin.
+        # If we want to add custom CSS to file then we stream the input file
+        # and insert the css on the way.
         # This is a workaround for a bug in wkhtmltoimage (look closely in README)
-        if self.source.isString() or (self.source.isFile() and self.css):
+        if self.source.isString() or (self.source.isServed() and self.served_url is None):
             # HTML charset should be UTF-8 as encoding via utf-8
             charset_meta = '<meta charset="UTF-8">'
-            string = (charset_meta + self.source.to_s()).encode("utf-8")
+            return (charset_meta + self.source.to_s()).encode("utf-8")
         elif self.source.isFileObj():
-            string = self.source.source.read().encode("utf-8")
-        else:
-            string = None
-        stdout, stderr = result.communicate(input=string)
+            return self._iter_html(self.source.source, self.head_style)
+        elif self.source.isFile() and self.head_style is not None:
+            return self._iter_file(self.source.source, self.head_style)
+        return None
+
+    def _buffered_payload(self):
+        """:meth:`_stdin_payload` read into bytes, for callers that need all of it"""
+
+        payload = self._stdin_payload()
+        if payload is None or isinstance(payload, bytes):
+            return payload
+        return b"".join(payload)
+
+    def _handle_result(self, args, path, stdout, stderr, exit_code):
+        """Check the finished wkhtmltoimage process and return the to_img result"""
+
         stderr = stderr or stdout
-        try: 
-            stderr = stderr.decode("utf-8") 
-        except UnicodeDecodeError: 
+        try:
+            stderr = stderr.decode("utf-8")
+        except UnicodeDecodeError:
             stderr = ""
-        exit_code = result.returncode
 
         if "cannot connect to X server" in stderr:
-            raise OSError(
+            raise DisplayError(
                 "{}\n"
                 'You will need to run wkhtmltoimage within a "virtual" X server.\n'
                 "Go to the link below for more information\n"
-                "http://wkhtmltopdf.org".format(stderr)
+                "http://wkhtmltopdf.org".format(stderr),
+                exit_code,
+                stderr,
             )
 
         if "Error" in stderr:
-            raise OSError("wkhtmltoimage reported an error:\n" + stderr)
+            raise classify(
+                "wkhtmltoimage reported an error:\n" + stderr,
+                stderr,
+                exit_code,
+                self.memory_limit,
+                self.cpu_limit,
+            )
 
         if exit_code != 0:
             xvfb_error = ""
             if "QXcbConnection" in stderr:
                 xvfb_error = 'You need to install xvfb(sudo apt-get install xvfb, yum install xorg-x11-server-Xvfb, etc), then add option: {"xvfb": ""}.'
-            raise OSError(
+            raise classify(
                 "wkhtmltoimage exited with non-zero code {0}. error:\n{1}\n\n{2}".format(
                     exit_code, stderr, xvfb_error
-                )
+                ),
+                stderr,
+                exit_code,
+                self.memory_limit,
+                self.cpu_limit,
             )
 
         # Since wkhtmltoimage sends its output to stderr we will capture it
@@ -276,7 +516,7 @@ class IMGKit:
         try:
             with codecs.open(path, mode="rb") as f:
                 text = f.read(4)
-                if text == "":
+                if not text:
                     raise OSError(
                         "Command failed: {}\n"
                         "Check whhtmltoimage output without "
@@ -292,3 +532,379 @@ class IMGKit:
                 ),
                 io_error,
             )
+
+    def _cache_key(self, args, payload):
+        """Content address of the render described by ``args`` and ``payload``"""
+
+        if self.served_url is not None:
+            # the url holds the port of this process' server, the page is the input
+            args = ["-" if arg == self.served_url else arg for arg in args]
+            payload = self.source.to_s().encode("utf-8")
+        files = None
+        if payload is None and self.source.isFile() and not self.source.isFileObj():
+            files = self.source.source
+            if not isinstance(files, list):
+                files = [files]
+        return cache_key(args[:-1], payload, files)
+
+    def _write_output(self, path, data):
+        """Return image data rendered out of process the way to_img would have"""
+
+        if not path:
+            return data
+        write = getattr(path, "write", None) or getattr(path, "sendall", None)
+        if write is not None:
+            write(data)
+            return True
+        if self._atomic(path):
+            output = self._atomic_file(path)
+            output.write(data)
+            output.commit()
+            return True
+        with open(path, "wb") as f:
+            f.write(data)
+        return True
+
+    def _atomic(self, path):
+        """True when ``path`` is written through a temporary file, see Config(atomic_writes=...)"""
+
+        return self.config.atomic_writes and isinstance(path, string_types) and bool(path)
+
+    def _open_output(self, path):
+        return self._atomic_file(path) if self._atomic(path) else open(path, "wb")
+
+    def _atomic_file(self, path):
+        return AtomicFile(path, check_format=not self._has_format())
+
+    @staticmethod
+    def _display_env(display):
+        """Environment for a wkhtmltoimage child rendering on X display ``display``"""
+
+        env = dict(os.environ)
+        env["DISPLAY"] = display
+        return env
+
+    def _source_size(self):
+        """Size of file sources wkhtmltoimage reads itself, 0 for other sources"""
+
+        if not self.source.isFile() or self.source.isFileObj():
+            return 0
+        paths = self.source.source
+        if not isinstance(paths, list):
+            paths = [paths]
+        try:
+            return sum(os.path.getsize(p) for p in paths)
+        except OSError:
+            return 0
+
+    def _stream(self, args, path, payload, chunk_size=CHUNK_SIZE):
+        """Run wkhtmltoimage, yield its stdout as it is produced, then check the result"""
+
+        stats = self.stats
+        engine = self.config.engine
+        if engine is not None and engine.supports(self, path):
+            if payload is not None and not isinstance(payload, bytes):
+                payload = b"".join(payload)
+            stats.bytes_in = len(payload) if payload else self._source_size()
+            with stats.stage("engine"):
+                image = engine.render(self, payload, path)
+            stats.bytes_out = len(image)
+            if not path:
+                yield image
+                return
+            with stats.stage("result"):
+                with open(path, "wb") as f:
+                    f.write(image)
+            return
+
+        env = None
+        if self.xvfb_pool is not None:
+            with stats.stage("xvfb"):
+                display = self.xvfb_pool.acquire()
+            env = self._display_env(display)
+        try:
+            started = timer()
+            with stats.stage("spawn"):
+                child = Child(
+                    args, payload, env, self.timeout, self.memory_limit, self.cpu_limit
+                )
+            try:
+                for chunk in child.chunks(chunk_size):
+                    yield chunk
+            except BaseException:
+                # consumer went away (or failed) mid-render, don't leave the child behind
+                child.kill()
+                raise
+            stderr, exit_code = child.wait()
+            stats.stages["process"] = timer() - started
+        finally:
+            if self.xvfb_pool is not None:
+                self.xvfb_pool.release(display)
+
+        stats.exit_code = exit_code
+        if child.timed_out:
+            raise self._timeout_error(args)
+        stats.bytes_in = child.bytes_in if payload is not None else self._source_size()
+        stats.bytes_out = child.bytes_out
+        if child.rusage is not None:
+            stats.add_usage(child.rusage)
+        with stats.stage("result"):
+            self._handle_result(args, path, b"", stderr, exit_code)
+        if path:
+            # wkhtmltoimage wrote the image itself
+            stats.bytes_out = os.path.getsize(path)
+
+    def _timeout_error(self, args):
+        return self.RenderTimeout(
+            "wkhtmltoimage did not finish within {} seconds and was killed: {}".format(
+                self.timeout, " ".join(args)
+            )
+        )
+
+    def _render(self, args, path, payload):
+        stdout = b"".join(self._stream(args, path, payload))
+        return True if path else stdout
+
+    def _begin(self):
+        """Start measuring a render, :return: its start time"""
+
+        self.stats = RenderStats(self._setup_stages)
+        return timer()
+
+    def _finish(self, started, error=None):
+        """Complete :attr:`stats` and pass it to the hooks of the config"""
+
+        self.stats.total = timer() - started
+        self.stats.error = error
+        if self.served_url is not None:
+            self._served_by.unpublish(self.served_url)
+            self.served_url = None
+        for hook in self.config.hooks:
+            # a broken exporter must not replace the render result or its error
+            try:
+                hook(self, self.stats)
+            except Exception:
+                logger.exception("imgkit stats hook %r failed", hook)
+
+    def _lookup(self, key):
+        with self.stats.stage("cache"):
+            data = self.cache.lookup(key)
+        if data is not None:
+            self.stats.cached = True
+            self.stats.bytes_out = len(data)
+        return data
+
+    def iter_img(self, chunk_size=CHUNK_SIZE):
+        """
+        Generate image and yield it in chunks while wkhtmltoimage is still writing it
+
+        Errors are raised once the output is exhausted, after chunks may already
+        have been yielded. Closing the generator early kills wkhtmltoimage.
+
+        :param chunk_size: max size of the yielded byte strings
+        """
+
+        started = self._begin()
+        error = None
+        try:
+            self._publish()
+            for chunk in self._iter_img(chunk_size):
+                yield chunk
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._finish(started, error)
+
+    def _iter_img(self, chunk_size, output=None):
+        args = self.command(output=output)
+        if self.cache is None:
+            for chunk in self._stream(args, None, self._stdin_payload(), chunk_size):
+                yield chunk
+            return
+
+        payload = self._buffered_payload()
+
+        key = self._cache_key(args, payload)
+        data = self._lookup(key)
+        if data is None:
+            chunks = []
+            for chunk in self._stream(args, None, payload, chunk_size):
+                chunks.append(chunk)
+                yield chunk
+            self.cache.store(key, b"".join(chunks))
+        else:
+            for offset in range(0, len(data), chunk_size):
+                yield data[offset : offset + chunk_size]
+
+    def to_img(self, path=None, derivatives=None):
+        """
+        Generate image to path
+
+        Measurements of the render are left in :attr:`stats`, an instance of
+        imgkit.stats.RenderStats, and passed to the hooks of the config.
+        Renders running longer than the ``timeout`` given to IMGKit raise
+        :class:`RenderTimeout`.
+
+        :param path: path to output image file. False means image will be returned as bytes
+        :param derivatives: (optional) list of imgkit.derivatives.Derivative made from the
+            render with Pillow. The image is decoded while wkhtmltoimage writes it, the
+            derivatives are encoded in a thread pool and a list with the result of each
+            is returned; the render itself is written only if ``path`` is given
+        """
+
+        started = self._begin()
+        error = None
+        attempt = 1
+        try:
+            self._publish()
+            while True:
+                try:
+                    if derivatives:
+                        return self._derive(path, derivatives)
+                    return self._to_img(path)
+                except Exception as e:
+                    delay = self._retry_delay(e, path, attempt)
+                    if delay is None:
+                        raise
+                time.sleep(delay)
+                attempt += 1
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._finish(started, error)
+
+    def _retry_delay(self, error, path, attempt):
+        """Seconds to wait before rendering again after ``error``, None to give up"""
+
+        policy = self.config.retry
+        if policy is None or not policy.should_retry(error, attempt):
+            return None
+        # file objects were consumed by the failed render
+        if self.source.isFileObj() or (path and not isinstance(path, string_types)):
+            return None
+        self.stats.retries += 1
+        return policy.delay(attempt)
+
+    def _derive(self, path, derivatives):
+        from .derivatives import Decoder, make_all
+
+        decoder = Decoder()
+        write = getattr(path, "write", None) or getattr(path, "sendall", None)
+        output = self._open_output(path) if path and write is None else None
+        try:
+            for chunk in self._iter_img(CHUNK_SIZE, path):
+                decoder.feed(chunk)
+                if output is not None:
+                    output.write(chunk)
+                elif write is not None:
+                    write(chunk)
+        except BaseException:
+            if isinstance(output, AtomicFile):
+                output.abort()
+            elif output is not None:
+                output.close()
+            raise
+        if isinstance(output, AtomicFile):
+            output.commit()
+        elif output is not None:
+            output.close()
+
+        with self.stats.stage("derivatives"):
+            return make_all(decoder.close(), derivatives)
+
+    def _check_manifest(self, path):
+        """
+        Look ``path`` up in the manifest given to IMGKit
+
+        :return: tuple (True if the render can be skipped, fingerprint to record or None)
+        """
+        if self.manifest is None or not path or not isinstance(path, string_types):
+            return False, None
+        with self.stats.stage("manifest"):
+            current, fingerprint = self.manifest.check(path, self)
+        self.stats.skipped = current
+        return current, fingerprint
+
+    def _to_img(self, path):
+        skip, fingerprint = self._check_manifest(path)
+        if skip:
+            return True
+        result = self._write_img(path)
+        if fingerprint is not None:
+            self.manifest.record(path, fingerprint)
+        return result
+
+    def _write_img(self, path):
+        flight = self.config.single_flight
+
+        # file-like objects and sockets receive the image while it is rendered
+        write = getattr(path, "write", None) or getattr(path, "sendall", None)
+        if write is not None and flight is None:
+            for chunk in self._iter_img(CHUNK_SIZE):
+                write(chunk)
+            return True
+
+        if self.cache is None and flight is None:
+            if self._atomic(path):
+                return self._render_atomic(path)
+            args = self.command(path)
+            return self._render(args, path, self._stdin_payload())
+
+        # render to stdout so that the image can be cached or shared
+        args = self.command(output=path)
+        payload = self._buffered_payload()
+        key = self._cache_key(args, payload)
+        if flight is None:
+            data = self._cached_render(key, args, payload)
+        else:
+            data, shared = flight.do(
+                key, lambda: self._cached_render(key, args, payload)
+            )
+            self._shared_result(data, shared)
+        with self.stats.stage("result"):
+            return self._write_output(path, data)
+
+    def _render_atomic(self, path):
+        """Render to stdout into a temporary file that replaces ``path`` once checked"""
+
+        args = self.command(output=path)
+        output = self._atomic_file(path)
+        try:
+            for chunk in self._stream(args, None, self._stdin_payload()):
+                output.write(chunk)
+            with self.stats.stage("result"):
+                output.commit()
+        except BaseException:
+            output.abort()
+            raise
+        return True
+
+    def _cached_render(self, key, args, payload):
+        if self.cache is None:
+            return self._render(args, None, payload)
+        data = self._lookup(key)
+        if data is None:
+            data = self._render(args, None, payload)
+            self.cache.store(key, data)
+        return data
+
+    def _shared_result(self, data, shared):
+        """Note in :attr:`stats` that ``data`` came from another caller's render"""
+
+        if shared:
+            self.stats.shared = True
+            self.stats.bytes_out = len(data)
+
+    def to_img_async(self, path=None, semaphore=None):
+        """
+        Coroutine version of :meth:`to_img`, see :func:`imgkit.aio.to_img_async`
+
+        :param path: path to output image file. False means image will be returned as bytes
+        :param semaphore: (optional) asyncio.Semaphore bounding concurrent renders
+        """
+
+        from .aio import to_img_async
+
+        return to_img_async(self, path, semaphore=semaphore)
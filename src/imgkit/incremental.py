@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from six import string_types
+
+_replace = getattr(os, "replace", os.rename)
+
+VERSION = 1
+
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _paths(value):
+    if not value:
+        return []
+    return [value] if isinstance(value, string_types) else list(value)
+
+
+class RenderManifest:
+
+    """
+    Remembers what every output was rendered from, so that renders whose inputs
+    didn't change can be skipped
+
+    For each output path the manifest keeps a digest of the wkhtmltoimage command
+    (binary, options, toc and cover), of string sources, and the mtime, size and
+    sha256 of the source files and ``css`` stylesheets. Files whose mtime and size
+    are unchanged are not read again. Url and file object sources can't be
+    checked and are always rendered.
+
+    Renders record into memory; call :meth:`save` or use the manifest as a
+    context manager to write it to disk. One manifest can be shared between threads.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: JSON file holding the manifest, created by :meth:`save`
+        """
+        self.path = path
+        self.outputs = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if data.get("version") == VERSION:
+            self.outputs = data.get("outputs", {})
+
+    @staticmethod
+    def _command_digest(imgkit):
+        prefix = imgkit.args_prefix
+        if prefix is None:
+            prefix = imgkit._command_prefix()
+        digest = hashlib.sha256()
+        for arg in prefix:
+            digest.update(arg.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _file_entry(self, path, previous):
+        stat = os.stat(path)
+        if (
+            previous
+            and previous["mtime"] == stat.st_mtime
+            and previous["size"] == stat.st_size
+        ):
+            return previous
+        return {"mtime": stat.st_mtime, "size": stat.st_size, "sha256": _sha256_file(path)}
+
+    def check(self, output_path, imgkit):
+        """
+        Compare ``output_path`` with what ``imgkit`` would render now
+
+        :param output_path: path of the image file
+        :param imgkit: instance of imgkit.IMGKit about to render to ``output_path``
+        :return: tuple (True if the output is up to date, fingerprint to pass to
+            :meth:`record` after rendering or None if the render can't be tracked)
+        """
+        source = imgkit.source
+        if source.isUrl() or source.isFileObj():
+            return False, None
+
+        key = os.path.abspath(output_path)
+        with self._lock:
+            previous = self.outputs.get(key) or {}
+        previous_files = previous.get("files", {})
+
+        fingerprint = {"command": self._command_digest(imgkit), "string": None, "files": {}}
+        if source.isString() or source.isServed():
+            text = imgkit.unstyled_source
+            if text is None:
+                text = source.to_s()
+            text = text.encode("utf-8")
+            fingerprint["string"] = hashlib.sha256(text).hexdigest()
+        inputs = _paths(imgkit.css)
+        if source.isFile():
+            inputs = _paths(source.source) + inputs
+        try:
+            for path in inputs:
+                path = os.path.abspath(path)
+                fingerprint["files"][path] = self._file_entry(path, previous_files.get(path))
+        except (IOError, OSError):
+            # missing input, let the render report it
+            return False, None
+
+        current = (
+            os.path.exists(output_path)
+            and previous.get("command") == fingerprint["command"]
+            and previous.get("string") == fingerprint["string"]
+            and self._same_files(previous_files, fingerprint["files"])
+        )
+        if current and previous_files != fingerprint["files"]:
+            # touched but unchanged files: remember their new mtime
+            self.record(output_path, fingerprint)
+        return current, fingerprint
+
+    @staticmethod
+    def _same_files(previous, files):
+        if set(previous) != set(files):
+            return False
+        return all(previous[path]["sha256"] == files[path]["sha256"] for path in files)
+
+    def record(self, output_path, fingerprint):
+        """Remember that ``output_path`` was rendered from ``fingerprint``, see :meth:`check`"""
+
+        with self._lock:
+            self.outputs[os.path.abspath(output_path)] = fingerprint
+            self._dirty = True
+
+    def save(self):
+        """Write the manifest to its file, atomically"""
+
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps({"version": VERSION, "outputs": self.outputs}, sort_keys=True)
+            self._dirty = False
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".imgkit-manifest-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(data)
+            _replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.save()
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""Render through the libwkhtmltox shared library in long-lived worker processes"""
+import ctypes
+import ctypes.util
+import multiprocessing
+import os
+import threading
+
+from six import string_types
+from six.moves import queue
+
+from .stats import maxrss_bytes
+
+# wkhtmltoimage command line options and their libwkhtmltox image settings,
+# None as setting value means "use the option value"
+OPTION_SETTINGS = {
+    "--format": ("fmt", None),
+    "--width": ("screenWidth", None),
+    "--height": ("screenHeight", None),
+    "--quality": ("quality", None),
+    "--crop-x": ("crop.left", None),
+    "--crop-y": ("crop.top", None),
+    "--crop-w": ("crop.width", None),
+    "--crop-h": ("crop.height", None),
+    "--transparent": ("transparent", "true"),
+    "--disable-smart-width": ("smartWidth", "false"),
+    "--encoding": ("web.defaultEncoding", None),
+    "--minimum-font-size": ("web.minimumFontSize", None),
+    "--user-style-sheet": ("web.userStyleSheet", None),
+    "--images": ("web.loadImages", "true"),
+    "--no-images": ("web.loadImages", "false"),
+    "--enable-javascript": ("web.enableJavascript", "true"),
+    "--disable-javascript": ("web.enableJavascript", "false"),
+    "--enable-plugins": ("web.enablePlugins", "true"),
+    "--disable-plugins": ("web.enablePlugins", "false"),
+    "--javascript-delay": ("load.jsdelay", None),
+    "--zoom": ("load.zoomFactor", None),
+    "--username": ("load.username", None),
+    "--password": ("load.password", None),
+    "--proxy": ("load.proxy", None),
+    "--window-status": ("load.windowStatus", None),
+    "--stop-slow-scripts": ("load.stopSlowScripts", "true"),
+    "--no-stop-slow-scripts": ("load.stopSlowScripts", "false"),
+    "--debug-javascript": ("load.debugJavascript", "true"),
+    "--no-debug-javascript": ("load.debugJavascript", "false"),
+    "--load-error-handling": ("load.loadErrorHandling", None),
+    "--load-media-error-handling": ("load.mediaLoadErrorHandling", None),
+    "--enable-local-file-access": ("load.blockLocalFileAccess", "false"),
+    "--disable-local-file-access": ("load.blockLocalFileAccess", "true"),
+}
+
+# options that only affect the command line tool's own output
+IGNORED_OPTIONS = ("--quiet", "--log-level")
+
+
+_STR_CALLBACK = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_char_p)
+
+
+def find_library():
+    """Path of libwkhtmltox, None when it isn't installed"""
+
+    return ctypes.util.find_library("wkhtmltox")
+
+
+def _load(path):
+    lib = ctypes.CDLL(path)
+    lib.wkhtmltoimage_init.argtypes = [ctypes.c_int]
+    lib.wkhtmltoimage_create_global_settings.restype = ctypes.c_void_p
+    lib.wkhtmltoimage_set_global_setting.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_char_p,
+        ctypes.c_char_p,
+    ]
+    lib.wkhtmltoimage_create_converter.restype = ctypes.c_void_p
+    lib.wkhtmltoimage_create_converter.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+    lib.wkhtmltoimage_set_error_callback.argtypes = [ctypes.c_void_p, _STR_CALLBACK]
+    lib.wkhtmltoimage_convert.argtypes = [ctypes.c_void_p]
+    lib.wkhtmltoimage_get_output.restype = ctypes.c_long
+    lib.wkhtmltoimage_get_output.argtypes = [
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.POINTER(ctypes.c_char)),
+    ]
+    lib.wkhtmltoimage_destroy_converter.argtypes = [ctypes.c_void_p]
+    return lib
+
+
+def _peak_rss():
+    """Peak resident set size of this process in bytes, None if unknown"""
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    return maxrss_bytes(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def _convert(lib, settings, data):
+    errors = []
+
+    @_STR_CALLBACK
+    def on_error(converter, message):
+        errors.append(message.decode("utf-8", "replace"))
+
+    global_settings = lib.wkhtmltoimage_create_global_settings()
+    for name, value in settings:
+        lib.wkhtmltoimage_set_global_setting(
+            global_settings, name.encode("utf-8"), value.encode("utf-8")
+        )
+    # the converter takes ownership of the settings
+    converter = lib.wkhtmltoimage_create_converter(global_settings, data)
+    try:
+        lib.wkhtmltoimage_set_error_callback(converter, on_error)
+        if not lib.wkhtmltoimage_convert(converter):
+            raise OSError(
+                "libwkhtmltox reported an error:\n" + "\n".join(errors or ["unknown"])
+            )
+        output = ctypes.POINTER(ctypes.c_char)()
+        size = lib.wkhtmltoimage_get_output(converter, ctypes.byref(output))
+        return ctypes.string_at(output, size)
+    finally:
+        lib.wkhtmltoimage_destroy_converter(converter)
+
+
+def _worker(conn, library, max_renders, max_memory):
+    """Worker process main loop, renders until it has to be recycled"""
+
+    lib = _load(library)
+    lib.wkhtmltoimage_init(0)
+    renders = 0
+    try:
+        while True:
+            try:
+                settings, data = conn.recv()
+            except EOFError:
+                return
+            renders += 1
+            try:
+                image = _convert(lib, settings, data)
+                reply = ("ok", image)
+            except Exception as error:
+                reply = ("error", str(error))
+            rss = _peak_rss()
+            recycle = renders >= max_renders or (
+                max_memory is not None and rss is not None and rss >= max_memory
+            )
+            conn.send(reply + (recycle,))
+            if recycle:
+                return
+    finally:
+        lib.wkhtmltoimage_deinit()
+        conn.close()
+
+
+class _Worker:
+    def __init__(self, context, library, max_renders, max_memory):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker, args=(child_conn, library, max_renders, max_memory)
+        )
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def render(self, settings, data):
+        """:return: tuple (image bytes, recycle flag)"""
+
+        try:
+            self.conn.send((settings, data))
+            status, result, recycle = self.conn.recv()
+        except (EOFError, IOError, OSError):
+            self.close()
+            raise OSError(
+                "libwkhtmltox worker exited with code {}".format(self.process.exitcode)
+            )
+        if status != "ok":
+            return OSError(result), recycle
+        return result, recycle
+
+    def close(self):
+        self.conn.close()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+
+class LibEngine:
+
+    """
+    Renders through libwkhtmltox instead of starting a wkhtmltoimage process per image
+
+    The library is loaded in worker processes that stay alive between renders
+    and are replaced after ``max_renders`` images or once their peak RSS reaches
+    ``max_memory``. Renders the library can't do (missing library, toc/cover,
+    options without a library setting, lists of sources) use the command line tool.
+    """
+
+    def __init__(self, workers=1, max_renders=1000, max_memory=None, library=None):
+        """
+        :param workers: number of worker processes
+        :param max_renders: renders after which a worker is replaced
+        :param max_memory: (optional) peak RSS in bytes after which a worker is replaced
+        :param library: (optional) path of libwkhtmltox, looked up by default
+        """
+        self.workers = workers
+        self.max_renders = max_renders
+        self.max_memory = max_memory
+        self.library = library or find_library()
+        self.recycled = 0
+        get_context = getattr(multiprocessing, "get_context", None)
+        self._context = get_context("spawn") if get_context else multiprocessing
+        self._idle = queue.Queue()
+        self._slots = threading.Semaphore(workers)
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        """True when libwkhtmltox was found"""
+
+        # the library itself is only ever loaded in the workers
+        if not self.library:
+            return False
+        return not os.path.isabs(self.library) or os.path.exists(self.library)
+
+    def settings(self, imgkit, path=None):
+        """
+        libwkhtmltox global settings for ``imgkit``, None when it needs the CLI
+
+        :param imgkit: instance of imgkit.IMGKit
+        :param path: (optional) output path given to wkhtmltoimage, without ``--format``
+            its extension is the image format like for the command line tool; renders
+            to stdout use the ``--format`` of the latest ``imgkit.command(output=...)``
+        """
+
+        if imgkit.toc or imgkit.cover or "xvfb" in imgkit.options:
+            return None
+        # timeouts and resource limits apply to a wkhtmltoimage process
+        if imgkit.timeout or imgkit.memory_limit or imgkit.cpu_limit:
+            return None
+        if isinstance(imgkit.source.source, list):
+            return None
+
+        settings = []
+        fmt = imgkit.output_format or "jpg"
+        for key, value in imgkit._normalize_options(imgkit.options):
+            if key in IGNORED_OPTIONS:
+                continue
+            if key == "--format":
+                fmt = None
+            if key not in OPTION_SETTINGS or isinstance(value, (list, tuple)):
+                return None
+            name, fixed = OPTION_SETTINGS[key]
+            if fixed is None and not value:
+                return None
+            settings.append((name, fixed or value))
+        if fmt is not None:
+            if isinstance(path, string_types):
+                fmt = os.path.splitext(path)[1][1:].lower() or fmt
+            settings.insert(0, ("fmt", fmt))
+
+        if imgkit.source.isUrl():
+            settings.append(("in", imgkit.source.to_s()))
+        elif imgkit.source.isServed():
+            if imgkit.served_url is None:
+                return None
+            settings.append(("in", imgkit.served_url))
+        elif imgkit.source.isFile() and not imgkit.source.isFileObj():
+            if imgkit.head_style is None:
+                settings.append(("in", os.path.abspath(imgkit.source.to_s())))
+        return settings
+
+    def supports(self, imgkit, path=None):
+        """True when ``imgkit`` can be rendered by the library, see :meth:`settings`"""
+
+        return self.available and self.settings(imgkit, path) is not None
+
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return _Worker(self._context, self.library, self.max_renders, self.max_memory)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, worker, recycle=False):
+        if recycle:
+            worker.close()
+            with self._lock:
+                self.recycled += 1
+        else:
+            self._idle.put(worker)
+        self._slots.release()
+
+    def render(self, imgkit, payload=None, path=None):
+        """
+        Render ``imgkit`` in a worker process
+
+        :param imgkit: instance of imgkit.IMGKit, see :meth:`supports`
+        :param payload: (optional) HTML bytes, see ``IMGKit._stdin_payload``
+        :param path: (optional) output path, see :meth:`settings`
+        :return: image bytes
+        """
+        settings = self.settings(imgkit, path)
+        if payload is not None and not isinstance(payload, bytes):
+            payload = b"".join(payload)
+
+        worker = self._acquire()
+        try:
+            result, recycle = worker.render(settings, payload)
+        except OSError:
+            # the worker died mid-render, it has been closed already
+            self._release(worker, recycle=True)
+            raise
+        self._release(worker, recycle)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def close(self):
+        """Stop idle worker processes"""
+
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            worker.close()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import errno
+import os
+import struct
+import uuid
+
+_replace = getattr(os, "replace", os.rename)
+
+# bytes of the image kept to find its format and size
+HEADER_SIZE = 64 * 1024
+
+# the kernel applies the umask to the mode, like for files opened with open(path, "wb")
+_TMP_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+
+# formats sniff_image reports for the output extensions
+_EXTENSIONS = {"jpg": "jpg", "jpeg": "jpg", "png": "png", "bmp": "bmp", "gif": "gif", "svg": "svg"}
+
+# JPEG start of frame markers, the ones that hold the image size
+_JPEG_SOF = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def _jpeg_size(header):
+    offset = 2
+    while offset + 9 <= len(header):
+        if header[offset : offset + 1] != b"\xff":
+            return None
+        marker = ord(header[offset + 1 : offset + 2])
+        if marker == 0xFF:
+            # fill byte
+            offset += 1
+            continue
+        if marker in _JPEG_SOF:
+            height, width = struct.unpack(">HH", header[offset + 5 : offset + 9])
+            return width, height
+        length = struct.unpack(">H", header[offset + 2 : offset + 4])[0]
+        offset += 2 + length
+    return None
+
+
+def sniff_image(header):
+    """
+    Format and size of an image from its first bytes
+
+    :param header: bytes at the start of the image, see ``HEADER_SIZE``
+    :return: tuple (format, width, height) with None for a size that isn't in
+        ``header``, or None when ``header`` isn't an image wkhtmltoimage writes
+    """
+    if header.startswith(b"\x89PNG\r\n\x1a\n") and len(header) >= 24:
+        width, height = struct.unpack(">II", header[16:24])
+        return "png", width, height
+    if header.startswith(b"\xff\xd8"):
+        size = _jpeg_size(header) or (None, None)
+        return ("jpg",) + size
+    if header.startswith(b"BM") and len(header) >= 26:
+        width, height = struct.unpack("<ii", header[18:26])
+        return "bmp", width, abs(height)
+    if header.startswith(b"GIF8") and len(header) >= 10:
+        width, height = struct.unpack("<HH", header[6:10])
+        return "gif", width, height
+    if header.lstrip().startswith(b"<") and b"<svg" in header:
+        return "svg", None, None
+    return None
+
+
+class AtomicFile:
+
+    """
+    Image output written to a temporary file next to ``path``
+
+    The file appears at ``path`` only once it is complete and looks like an image:
+    :meth:`commit` checks the format and size from the bytes written, without
+    reading the file back, and renames it into place. Readers of ``path`` see the
+    previous file or the new one, never a partial one.
+    """
+
+    def __init__(self, path, check_format=True):
+        """
+        :param path: final path of the image
+        :param check_format: the image must have the format of the extension of ``path``,
+            when it is a known one; off when wkhtmltoimage got a ``--format``
+        """
+        self.path = path
+        extension = os.path.splitext(path)[1][1:].lower()
+        self.format = _EXTENSIONS.get(extension) if check_format else None
+        directory = os.path.dirname(os.path.abspath(path))
+        while True:
+            self.tmp = os.path.join(directory, ".imgkit-" + uuid.uuid4().hex)
+            try:
+                fd = os.open(self.tmp, _TMP_FLAGS, 0o666)
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self._file = os.fdopen(fd, "wb")
+        self._header = []
+        self._header_size = 0
+
+    def write(self, chunk):
+        if self._header_size < HEADER_SIZE:
+            self._header.append(chunk[: HEADER_SIZE - self._header_size])
+            self._header_size += len(self._header[-1])
+        self._file.write(chunk)
+
+    def commit(self):
+        """
+        Check the image and move it to its path
+
+        :return: tuple (format, width, height), see :func:`sniff_image`
+        """
+        self._file.close()
+        info = sniff_image(b"".join(self._header))
+        if info is None or 0 in info[1:]:
+            self.abort()
+            raise OSError(
+                "No valid image was rendered for {}\n"
+                "Check wkhtmltoimage output without 'quiet' option".format(self.path)
+            )
+        if self.format is not None and info[0] != self.format:
+            self.abort()
+            raise OSError(
+                "A {} image was rendered for {}, its extension needs {}".format(
+                    info[0], self.path, self.format
+                )
+            )
+        _replace(self.tmp, self.path)
+        return info
+
+    def abort(self):
+        """Remove the temporary file"""
+
+        self._file.close()
+        try:
+            os.remove(self.tmp)
+        except OSError:
+            pass
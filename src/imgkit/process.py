@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+import errno
+import os
+import signal
+import subprocess
+import sys
+import threading
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _setrlimit(kind, limit):
+    # an unprivileged process can't raise its hard limit
+    _, hard = resource.getrlimit(kind)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(kind, (limit, hard))
+
+
+def popen_options(new_session=False, memory_limit=None, cpu_limit=None):
+    """
+    Popen keyword arguments that start the child in its own process group
+    and with resource limits
+
+    :param new_session: start the child in a new session, so that it can be killed
+        with everything it started (e.g. xvfb-run and its Xvfb) through :func:`kill_group`
+    :param memory_limit: (optional) max address space of the child in bytes
+    :param cpu_limit: (optional) max CPU time of the child in seconds
+    """
+    if (memory_limit or cpu_limit) and resource is None:
+        raise OSError("memory_limit and cpu_limit are not supported on this platform")
+
+    options = {}
+    new_session = new_session and os.name != "nt"
+    setsid = new_session and sys.version_info < (3, 2)
+    if new_session and not setsid:
+        options["start_new_session"] = True
+    if setsid or memory_limit or cpu_limit:
+
+        def preexec():
+            if setsid:
+                os.setsid()
+            if memory_limit:
+                _setrlimit(resource.RLIMIT_AS, memory_limit)
+            if cpu_limit:
+                _setrlimit(resource.RLIMIT_CPU, cpu_limit)
+
+        options["preexec_fn"] = preexec
+    return options
+
+
+def kill_group(pid):
+    """SIGKILL the process group led by ``pid``, see :func:`popen_options`"""
+
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        # already gone
+        pass
+
+
+class Child:
+
+    """
+    A running wkhtmltoimage process whose stdout is read incrementally
+
+    stdin is fed and stderr is drained on background threads so that reading
+    stdout chunk by chunk can never deadlock on a full pipe.
+    """
+
+    def __init__(
+        self, args, payload=None, env=None, timeout=None, memory_limit=None, cpu_limit=None
+    ):
+        """
+        :param args: command to run
+        :param payload: (optional) bytes or iterable of bytes written to the child's stdin
+        :param env: (optional) environment of the child
+        :param timeout: (optional) seconds after which the child and every process
+            it started are killed, :attr:`timed_out` tells whether that happened
+        :param memory_limit: (optional) max address space of the child in bytes
+        :param cpu_limit: (optional) max CPU time of the child in seconds
+        """
+        self.args = args
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # resource usage of the exited child, where os.wait4 is available
+        self.rusage = None
+        self.timed_out = False
+        self._feed_error = None
+        self._group = timeout is not None and os.name != "nt"
+        self._lock = threading.Lock()
+        self._reaped = False
+        self.process = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+            **popen_options(self._group, memory_limit, cpu_limit)
+        )
+        self._stderr = []
+        self._threads = [
+            self._thread(self._feed, payload),
+            self._thread(self._drain_stderr),
+        ]
+        self._timer = None
+        if timeout is not None:
+            self._timer = threading.Timer(timeout, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    @staticmethod
+    def _thread(target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _feed(self, payload):
+        chunks = [payload] if isinstance(payload, bytes) else payload or ()
+        try:
+            for chunk in chunks:
+                self.process.stdin.write(chunk)
+                self.bytes_in += len(chunk)
+        except (IOError, OSError) as error:
+            # the child may exit without reading all its input
+            if error.errno not in (errno.EPIPE, errno.EINVAL):
+                self._feed_error = error
+        except Exception as error:
+            self._feed_error = error
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+            try:
+                self.process.stdin.close()
+            except (IOError, OSError):
+                pass
+
+    def _drain_stderr(self):
+        self._stderr.append(self.process.stderr.read())
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        """Yield stdout as it is produced, in pieces of at most ``chunk_size`` bytes"""
+
+        fd = self.process.stdout.fileno()
+        while True:
+            chunk = os.read(fd, chunk_size)
+            if not chunk:
+                break
+            self.bytes_out += len(chunk)
+            yield chunk
+
+    def read(self):
+        """Read the whole stdout"""
+
+        return b"".join(self.chunks())
+
+    def wait(self):
+        """
+        Wait for the child to exit
+
+        Errors raised while producing the stdin payload are re-raised here.
+
+        :return: tuple (stderr bytes, exit code)
+        """
+        self._reap()
+        if self._feed_error is not None:
+            raise self._feed_error
+        return b"".join(self._stderr), self.process.returncode
+
+    def _expire(self):
+        with self._lock:
+            if self._reaped:
+                return
+            self.timed_out = True
+            self._signal()
+
+    def _signal(self):
+        if self._group:
+            kill_group(self.process.pid)
+        elif self.process.poll() is None:
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+
+    def _reap(self):
+        self.process.stdout.close()
+        if self.process.returncode is None and hasattr(os, "wait4"):
+            self._wait4()
+        self.process.wait()
+        with self._lock:
+            self._reaped = True
+        if self._timer is not None:
+            self._timer.cancel()
+        for thread in self._threads:
+            thread.join()
+        self.process.stderr.close()
+
+    def _wait4(self):
+        try:
+            _, status, self.rusage = os.wait4(self.process.pid, 0)
+        except OSError:
+            # already reaped elsewhere, Popen.wait() knows the exit code
+            return
+        if os.WIFSIGNALED(status):
+            self.process.returncode = -os.WTERMSIG(status)
+        else:
+            self.process.returncode = os.WEXITSTATUS(status)
+
+    def kill(self):
+        """Kill the child (with its process group, if it has one) and reap it"""
+
+        with self._lock:
+            self._signal()
+        self._reap()
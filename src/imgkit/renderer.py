@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from .config import Config
+from .imgkit import IMGKit
+
+
+class Renderer:
+
+    """
+    Reusable render profile
+
+    Options are validated and turned into the wkhtmltoimage command prefix once,
+    each render only appends its source and output. A Renderer holds no per-render
+    state and can be shared between threads.
+    """
+
+    def __init__(
+        self,
+        options=None,
+        config=None,
+        toc=None,
+        cover=None,
+        cover_first=None,
+        cache=None,
+        timeout=None,
+        memory_limit=None,
+        cpu_limit=None,
+    ):
+        """
+        :param options: (optional) dict with wkhtmltoimage global and page options, with or w/o '--'
+        :param config: (optional) instance of imgkit.config.Config()
+        :param toc: (optional) dict with toc-specific wkhtmltoimage options, with or w/o '--'
+        :param cover: (optional) string with url/filename with a cover html page
+        :param cover_first: (optional) if True, cover always precedes TOC
+        :param cache: (optional) instance of imgkit.cache.CacheBackend, hits skip wkhtmltoimage
+        :param timeout: (optional) seconds after which a render is killed, see :func:`imgkit.from_url`
+        :param memory_limit: (optional) max address space of wkhtmltoimage in bytes
+        :param cpu_limit: (optional) max CPU time of wkhtmltoimage in seconds
+        """
+        self.options = dict(options or {})
+        self.config = config or Config()
+        self.toc = toc
+        self.cover = cover
+        self.cover_first = cover_first
+        self.cache = cache
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.cpu_limit = cpu_limit
+
+        template = IMGKit(
+            "",
+            "url",
+            options=self.options,
+            config=self.config,
+            toc=toc,
+            cover=cover,
+            cover_first=cover_first,
+        )
+        self.args_prefix = tuple(template._command_prefix())
+
+    def imgkit(self, url_or_file, source_type, css=None):
+        """
+        IMGKit for one source, using the prebuilt command prefix
+
+        :param url_or_file: url, path of HTML file or list with paths or file-like object, or string
+        :param source_type: "url", "file" or "string"
+        :param css: (optional) style of input
+        """
+        return IMGKit(
+            url_or_file,
+            source_type,
+            options=self.options,
+            config=self.config,
+            toc=self.toc,
+            cover=self.cover,
+            cover_first=self.cover_first,
+            css=css,
+            cache=self.cache,
+            timeout=self.timeout,
+            memory_limit=self.memory_limit,
+            cpu_limit=self.cpu_limit,
+            args_prefix=self.args_prefix,
+        )
+
+    def from_url(self, url, output_path):
+        """Convert URL/URLs to IMG file/files, see :func:`imgkit.from_url`"""
+
+        return self.imgkit(url, "url").to_img(output_path)
+
+    def from_file(self, filename, output_path, css=None):
+        """Convert HTML file/files to IMG file/files, see :func:`imgkit.from_file`"""
+
+        return self.imgkit(filename, "file", css=css).to_img(output_path)
+
+    def from_string(self, string, output_path, css=None):
+        """Convert given string/strings to IMG file, see :func:`imgkit.from_string`"""
+
+        return self.imgkit(string, "string", css=css).to_img(output_path)
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import random
+
+from .errors import TransientError
+
+
+class RetryPolicy:
+
+    """
+    When and how long to wait before rendering again, see ``Config(retry=...)``
+
+    Failures of the ``retry_on`` classes (transient ones by default, timeouts
+    included) are rendered again up to ``attempts`` renders in total. The wait
+    doubles from ``backoff`` up to ``max_backoff`` seconds and is shortened by a
+    random part of up to ``jitter`` of it, so that renders that failed together
+    don't all come back at the same time.
+    """
+
+    def __init__(
+        self, attempts=3, backoff=0.5, max_backoff=30.0, jitter=0.5, retry_on=(TransientError,)
+    ):
+        """
+        :param attempts: max number of renders, the first one included
+        :param backoff: seconds to wait after the first failure
+        :param max_backoff: max seconds to wait between two renders
+        :param jitter: fraction of the wait, between 0 and 1, that is random
+        :param retry_on: exception classes worth rendering again
+        """
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_on = tuple(retry_on)
+
+    def should_retry(self, error, attempt):
+        """
+        :param error: exception raised by render number ``attempt``
+        :param attempt: number of renders done so far, starting at 1
+        """
+        return attempt < self.attempts and isinstance(error, self.retry_on)
+
+    def delay(self, attempt):
+        """Seconds to wait after render number ``attempt`` failed"""
+
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def __repr__(self):
+        return "<RetryPolicy attempts={} backoff={}>".format(self.attempts, self.backoff)
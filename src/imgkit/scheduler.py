@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import heapq
+import itertools
+import multiprocessing
+import os
+import threading
+
+from .stats import timer
+
+# priorities, lower ones are started first
+INTERACTIVE = 0
+BULK = 10
+
+
+def _load():
+    """1 minute load average, None where it isn't available"""
+
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+
+class AdaptiveScheduler:
+
+    """
+    Bounds concurrent wkhtmltoimage processes by measured cost instead of a fixed count
+
+    Renders wait for a slot in a priority queue, :data:`INTERACTIVE` ones before
+    :data:`BULK` ones. The number of slots moves between ``min_workers`` and
+    ``max_workers``, at most one step per ``interval``:
+
+    - it never exceeds ``memory_budget`` divided by the estimated child RSS, which
+      follows the peak RSS of finished renders (``RenderStats.max_rss``);
+    - it shrinks while the 1 minute load average is above ``max_load``;
+    - it grows while renders are waiting for longer than ``target_latency`` on average.
+
+    Pass it as ``scheduler`` to :func:`imgkit.render_many` or as ``semaphore`` to the
+    async functions; one scheduler can be shared by threads and event loops.
+    """
+
+    def __init__(
+        self,
+        min_workers=1,
+        max_workers=None,
+        memory_budget=None,
+        rss_estimate=None,
+        max_load=None,
+        target_latency=0.0,
+        interval=1.0,
+    ):
+        """
+        :param min_workers: slots kept whatever the measurements say
+        :param max_workers: (optional) upper bound of slots, defaults to twice the CPU count
+        :param memory_budget: (optional) bytes all wkhtmltoimage processes may use together
+        :param rss_estimate: (optional) peak RSS in bytes expected of a render until
+            one was measured; renders without ``os.wait4`` (e.g. async ones) aren't measured
+        :param max_load: (optional) load average above which slots are removed,
+            defaults to the CPU count
+        :param target_latency: seconds renders may wait on average before slots are added
+        :param interval: min seconds between two changes of the number of slots
+        """
+        cpus = multiprocessing.cpu_count()
+        self.min_workers = min_workers
+        self.max_workers = max_workers or cpus * 2
+        self.memory_budget = memory_budget
+        self.rss_estimate = rss_estimate
+        self.max_load = max_load if max_load is not None else float(cpus)
+        self.target_latency = target_latency
+        self.interval = interval
+        self.running = 0
+        self.latency = 0.0
+        self._waiting = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._adjusted = timer()
+        self.limit = max(min_workers, min(cpus, self._cap()))
+
+    @property
+    def waiting(self):
+        """Number of renders waiting for a slot"""
+
+        with self._lock:
+            return sum(1 for entry in self._waiting if entry[3] is not None)
+
+    def _cap(self):
+        cap = self.max_workers
+        if self.memory_budget and self.rss_estimate:
+            cap = min(cap, int(self.memory_budget // self.rss_estimate))
+        return max(cap, self.min_workers)
+
+    def _adjust(self):
+        limit = self.limit
+        now = timer()
+        if now - self._adjusted >= self.interval:
+            load = _load()
+            if load is not None and load > self.max_load:
+                limit -= 1
+            elif self._waiting and self.latency >= self.target_latency:
+                limit += 1
+            if limit != self.limit:
+                self._adjusted = now
+        # the memory bound applies at once
+        self.limit = max(self.min_workers, min(self._cap(), limit))
+
+    def _dispatch(self):
+        """Hand free slots to the first waiters, called with the lock held"""
+
+        while self._waiting and self.running < self.limit:
+            entry = heapq.heappop(self._waiting)
+            wake = entry[3]
+            if wake is None:
+                # cancelled
+                continue
+            entry[3] = None
+            self.running += 1
+            self.latency = 0.8 * self.latency + 0.2 * (timer() - entry[2])
+            wake()
+
+    def _enqueue(self, priority, wake):
+        """
+        Queue a waiter, ``wake`` is called with the lock held once it got a slot
+
+        :return: entry to pass to :meth:`_cancel`
+        """
+        entry = [priority, next(self._counter), timer(), wake]
+        with self._lock:
+            heapq.heappush(self._waiting, entry)
+            self._dispatch()
+        return entry
+
+    def _cancel(self, entry):
+        """Take a waiter out of the queue, :return: False if it got a slot already"""
+
+        with self._lock:
+            if entry[3] is None:
+                return False
+            entry[3] = None
+            return True
+
+    def acquire(self, priority=BULK, timeout=None):
+        """
+        Wait for a slot
+
+        :param priority: :data:`INTERACTIVE`, :data:`BULK` or another number, lower first
+        :param timeout: (optional) seconds to wait before raising OSError
+        """
+        granted = threading.Event()
+        entry = self._enqueue(priority, granted.set)
+        if not granted.wait(timeout) and self._cancel(entry):
+            raise OSError("No render slot after {} seconds".format(timeout))
+
+    def release(self, stats=None):
+        """
+        Give a slot back
+
+        :param stats: (optional) imgkit.stats.RenderStats of the render that used it
+        """
+        with self._lock:
+            self.running -= 1
+            rss = stats.max_rss if stats is not None else None
+            if rss:
+                # follows heavier pages at once and lighter ones slowly
+                previous = self.rss_estimate or rss
+                self.rss_estimate = max(rss, 0.9 * previous + 0.1 * rss)
+            self._adjust()
+            self._dispatch()
+
+    @contextlib.contextmanager
+    def slot(self, imgkit):
+        """
+        Context manager holding a slot while ``imgkit`` renders
+
+        :param imgkit: instance of imgkit.IMGKit, its ``priority`` (:data:`BULK` when
+            None) orders the queue and its stats feed the measurements
+        """
+        self.acquire(BULK if imgkit.priority is None else imgkit.priority)
+        try:
+            yield
+        finally:
+            self.release(imgkit.stats)
+
+    def __repr__(self):
+        return "<AdaptiveScheduler limit={} running={} waiting={}>".format(
+            self.limit, self.running, self.waiting
+        )
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Long-running render server on a Unix socket
+
+Application processes send render requests with :class:`imgkit.Client` instead of
+starting wkhtmltoimage themselves. The server keeps what is expensive to set up
+warm for every request: resolved and validated binaries, prebuilt options and,
+with ``--xvfb``, a pool of running Xvfb displays. Requests from all clients share
+one bounded set of render slots. Start it with::
+
+    python -m imgkit.server /run/imgkit.sock -j 8 -O width=1024
+
+The protocol is described in :mod:`imgkit.client`.
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import stat
+import sys
+import threading
+
+from six.moves import socketserver
+
+from .batch import _job_imgkit
+from .client import recv_message, send_message
+from .config import Config
+from .xvfb import XvfbPool
+
+# IMGKit arguments a request may set, the rest is decided by the server
+PARAMS = ("options", "css", "toc", "cover", "cover_first", "timeout", "memory_limit", "cpu_limit")
+TYPES = ("url", "file", "string")
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # a connection may carry several requests, one after the other
+        while True:
+            try:
+                message = recv_message(self.request)
+            except (EOFError, ValueError, socket.error):
+                return
+            if message is None:
+                return
+            reply, image = self.server.render(*message)
+            try:
+                send_message(self.request, reply, image)
+            except socket.error:
+                return
+
+
+class RenderServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    """
+    Serves renders to :class:`imgkit.Client` on a Unix socket
+
+    Each connection is handled in its own thread, at most ``workers`` wkhtmltoimage
+    processes run at a time. Images are sent back in the reply, the client writes
+    its output file.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, workers=None, options=None, config=None):
+        """
+        :param path: path of the Unix socket, a stale socket left there is replaced
+        :param workers: (optional) max number of concurrent renders, defaults to the CPU count
+        :param options: (optional) dict with wkhtmltoimage options for every render,
+            request options override them
+        :param config: (optional) instance of imgkit.config.Config(), binaries are
+            validated once
+        """
+        self.path = path
+        self.workers = workers or multiprocessing.cpu_count()
+        self.options = dict(options or {})
+        self.config = config or Config(validate_once=True)
+        self._slots = threading.BoundedSemaphore(self.workers)
+
+        # fail at startup rather than on the first request
+        self.config.get_wkhtmltoimage()
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+        socketserver.UnixStreamServer.__init__(self, path, _Handler)
+
+    def render(self, header, body):
+        """
+        Render one request
+
+        :param header: request header dict
+        :param body: request body bytes
+        :return: tuple (reply header dict, image bytes)
+        """
+        source_type = header.get("type", "string")
+        if source_type not in TYPES:
+            return {"ok": False, "error": "unknown source type {!r}".format(source_type)}, b""
+
+        job = dict((name, header[name]) for name in PARAMS if name in header)
+        job.update(source=body.decode("utf-8"), type=source_type, output_path=False)
+        rtn = None
+        try:
+            rtn, _ = _job_imgkit(job, self.options, self.config)
+            with self._slots:
+                image = rtn.to_img(False)
+        except Exception as error:
+            reply = {"ok": False, "error": str(error), "class": type(error).__name__}
+            if rtn is not None:
+                reply["stats"] = rtn.stats.as_dict()
+            return reply, b""
+        return {"ok": True, "stats": rtn.stats.as_dict()}, image
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def _parse_option(text):
+    name, _, value = text.partition("=")
+    return name, value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m imgkit.server",
+        description="Serve wkhtmltoimage renders to imgkit.Client on a Unix socket.",
+    )
+    parser.add_argument("socket", help="path of the Unix socket")
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=None,
+        help="number of concurrent renders (default: CPU count)",
+    )
+    parser.add_argument(
+        "-O",
+        "--option",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="wkhtmltoimage option for all renders, e.g. -O width=800",
+    )
+    parser.add_argument("--wkhtmltoimage", default="", help="path of wkhtmltoimage")
+    parser.add_argument(
+        "--xvfb",
+        action="store_true",
+        help="run wkhtmltoimage on a pool of Xvfb displays, one per worker",
+    )
+    args = parser.parse_args(argv)
+
+    # wkhtmltoimage progress would go to the server log for every render
+    options = {"quiet": ""}
+    options.update(_parse_option(option) for option in args.option)
+    pool = XvfbPool(size=args.workers) if args.xvfb else None
+    if pool is not None:
+        options["xvfb"] = ""
+        pool.start()
+    config = Config(wkhtmltoimage=args.wkhtmltoimage, validate_once=True, xvfb_pool=pool)
+
+    server = RenderServer(args.socket, args.workers, options, config)
+    sys.stderr.write("imgkit server listening on {}\n".format(args.socket))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if pool is not None:
+            pool.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import threading
+
+
+class _Call:
+
+    """A render in flight, shared by its leader and the callers waiting for it"""
+
+    def __init__(self):
+        self.result = None
+        self.error = None
+        # the leader went away (cancelled, interrupted) without an outcome
+        self.abandoned = False
+        self.done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def add_done_callback(self, callback):
+        """Call ``callback(call)`` once the render finished, right away if it has"""
+
+        with self._lock:
+            if not self.done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def finish(self, result=None, error=None, abandoned=False):
+        with self._lock:
+            self.result = result
+            self.error = error
+            self.abandoned = abandoned
+            self.done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def outcome(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+
+    """
+    Shares one render between concurrent identical requests
+
+    While a render is running, the same render requested from other threads
+    or coroutines doesn't start another wkhtmltoimage but waits for the running
+    one and gets the same image, or the same exception. Renders are identical
+    when their command line (without output path) and input are, see
+    ``imgkit.cache.cache_key``. Nothing is kept once a render finished, combine
+    it with a cache for that.
+    """
+
+    def __init__(self):
+        self.leaders = 0
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key):
+        """:return: tuple (call for ``key``, True if the caller has to run it)"""
+
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.shared += 1
+                return call, False
+            call = self._calls[key] = _Call()
+            self.leaders += 1
+            return call, True
+
+    def _leave(self, key, call, result=None, error=None, abandoned=False):
+        """
+        Hand the outcome of the leader to the waiters
+
+        An ``abandoned`` call has no outcome, its waiters join again and one of
+        them runs the render: the cancellation of one caller must not fail the others.
+        """
+        with self._lock:
+            del self._calls[key]
+        call.finish(result, error, abandoned)
+
+    def do(self, key, render):
+        """
+        Run ``render()`` unless a call with the same ``key`` is in flight
+
+        :param key: render identity, e.g. a cache key
+        :param render: callable returning the image bytes
+        :return: tuple (image bytes, True if they came from another caller's render)
+        """
+        while True:
+            call, leader = self._join(key)
+            if leader:
+                break
+            call.done.wait()
+            if not call.abandoned:
+                return call.outcome(), True
+
+        try:
+            result = render()
+        except Exception as error:
+            self._leave(key, call, error=error)
+            raise
+        except BaseException:
+            self._leave(key, call, abandoned=True)
+            raise
+        self._leave(key, call, result)
+        return result, False
+
+    def stats(self):
+        """dict with the number of renders run (``leaders``) and shared (``shared``)"""
+
+        return {"leaders": self.leaders, "shared": self.shared}
@@ -26,6 +26,11 @@ class Source:
 
         return "string" == self.type
 
+    def isServed(self):
+        """String type loaded from the asset server"""
+
+        return "served" == self.type
+
     def isFile(self, path=None):
         # dirty hack to check where file is opened with codecs module
         # (because it returns 'instance' type when encoding is specified
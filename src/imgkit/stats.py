@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import sys
+import time
+from contextlib import contextmanager
+
+timer = getattr(time, "perf_counter", time.time)
+
+
+def maxrss_bytes(ru_maxrss):
+    """``ru_maxrss`` of a resource usage in bytes, it is in kilobytes except on macOS"""
+
+    return ru_maxrss if sys.platform == "darwin" else ru_maxrss * 1024
+
+
+class RenderStats:
+
+    """
+    Measurements of one render, see ``IMGKit.stats`` and ``Config(hooks=...)``
+
+    ``stages`` maps stage names to durations in seconds. Stages that didn't run
+    are missing; they are, in order:
+
+    - ``config``: resolving and checking the wkhtmltoimage (and xvfb-run) binaries
+    - ``meta_scan``: looking for options in meta tags of string sources
+    - ``assets``: pointing asset references at the copies of ``assets``
+    - ``css``: reading stylesheets and preparing their injection
+    - ``serve``: publishing ``served`` sources on the asset server
+    - ``argv``: building the command line
+    - ``manifest``: checking whether the inputs of the output changed, see ``skipped``
+    - ``cache``: looking the render up in the cache
+    - ``xvfb``: waiting for a display of ``Config(xvfb_pool=...)``
+    - ``spawn``: starting wkhtmltoimage
+    - ``process``: from start to exit of wkhtmltoimage, with its input and output
+    - ``engine``: rendering through ``Config(engine=...)`` instead of the command line tool
+    - ``result``: checking the outcome and writing cached or engine output
+    - ``derivatives``: making the derivatives passed to ``to_img``
+
+    ``config`` and ``meta_scan`` are measured when the IMGKit is created, ``total``
+    is the time spent in the render call itself. ``bytes_in`` counts the HTML piped
+    into wkhtmltoimage or the size of the files it reads, ``bytes_out`` the image.
+    ``max_rss`` (bytes), ``user_time`` and ``system_time`` (seconds) of the
+    wkhtmltoimage child need ``os.wait4`` and are None without it.
+    """
+
+    def __init__(self, stages=None):
+        """
+        :param stages: (optional) dict of durations already measured
+        """
+        self.stages = dict(stages or {})
+        self.total = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.exit_code = None
+        self.max_rss = None
+        self.user_time = None
+        self.system_time = None
+        self.cached = False
+        self.shared = False
+        # the output was up to date in the render manifest, nothing was rendered
+        self.skipped = False
+        # renders done again after a transient failure, see Config(retry=...)
+        self.retries = 0
+        self.error = None
+
+    @contextmanager
+    def stage(self, name):
+        """Add the time spent in the ``with`` block to stage ``name``"""
+
+        start = timer()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + timer() - start
+
+    def add_usage(self, rusage):
+        """Take peak RSS and CPU times of the wkhtmltoimage child from its resource usage"""
+
+        self.max_rss = maxrss_bytes(rusage.ru_maxrss)
+        self.user_time = rusage.ru_utime
+        self.system_time = rusage.ru_stime
+
+    def as_dict(self):
+        """Plain dict of the measurements, e.g. for a metrics system"""
+
+        return {
+            "stages": dict(self.stages),
+            "total": self.total,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "exit_code": self.exit_code,
+            "max_rss": self.max_rss,
+            "user_time": self.user_time,
+            "system_time": self.system_time,
+            "cached": self.cached,
+            "shared": self.shared,
+            "skipped": self.skipped,
+            "retries": self.retries,
+            "error": repr(self.error) if self.error is not None else None,
+        }
+
+    def __repr__(self):
+        total = "{:.3f}s".format(self.total) if self.total is not None else "running"
+        return "<RenderStats {} in={} out={} exit_code={}>".format(
+            total, self.bytes_in, self.bytes_out, self.exit_code
+        )
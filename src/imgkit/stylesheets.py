@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import codecs
+import os
+import threading
+
+# process-wide cache: tuple of absolute stylesheet paths ->
+# (their (mtime, size) stamps, (style block str, style block UTF-8 bytes))
+_blocks = {}
+_lock = threading.Lock()
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return getattr(stat, "st_mtime_ns", stat.st_mtime), stat.st_size
+
+
+def style_block(paths):
+    """
+    ``<style>`` block with the content of the ``paths`` stylesheets
+
+    Blocks are cached for the whole process and rebuilt when the mtime or size of
+    one of the files changes, so a render only stats its stylesheets.
+
+    :param paths: list of paths of CSS files, read as UTF-8
+    :return: tuple (block str, block UTF-8 bytes)
+    """
+    key = tuple(os.path.abspath(path) for path in paths)
+    stamps = tuple(_stamp(path) for path in key)
+    cached = _blocks.get(key)
+    if cached is not None and cached[0] == stamps:
+        return cached[1]
+
+    css_data = []
+    for path in key:
+        with codecs.open(path, encoding="UTF-8") as f:
+            css_data.append(f.read())
+    text = "<style>{}</style>".format("\n".join(css_data))
+    block = (text, text.encode("utf-8"))
+    with _lock:
+        _blocks[key] = (stamps, block)
+    return block
+
+
+def clear_cache():
+    """Forget the cached style blocks"""
+
+    with _lock:
+        _blocks.clear()
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+import atexit
+import contextlib
+import os
+import subprocess
+import threading
+import time
+from multiprocessing import cpu_count
+
+from six.moves import queue
+
+from .config import _find_binary
+
+
+class XvfbPool:
+
+    """
+    Pool of long-lived Xvfb displays shared by renders with the ``xvfb`` option
+
+    Instead of starting a new X server with ``xvfb-run -a`` for every image, each
+    render leases a free display and runs wkhtmltoimage with ``DISPLAY`` pointing
+    at it. Displays that died are restarted the next time they are leased.
+    """
+
+    def __init__(
+        self,
+        size=None,
+        xvfb="",
+        first_display=99,
+        screen="1280x1024x24",
+        startup_timeout=10,
+    ):
+        """
+        :param size: number of displays, defaults to the CPU count
+        :param xvfb: path to the Xvfb binary, looked up on PATH by default
+        :param first_display: lowest display number to use
+        :param screen: geometry and depth of screen 0
+        :param startup_timeout: seconds to wait for a display to accept connections
+        """
+        self.size = size or cpu_count()
+        self.xvfb = xvfb
+        self.first_display = first_display
+        self.screen = screen
+        self.startup_timeout = startup_timeout
+        self.restarts = 0
+        self._displays = {}
+        self._free = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+        self._exit_registered = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _binary(self):
+        if not self.xvfb:
+            self.xvfb = _find_binary("Xvfb")
+        if self.xvfb == "command not found":
+            raise OSError(
+                "No Xvfb executable found. Please install xvfb "
+                "(sudo apt-get install xvfb, yum install xorg-x11-server-Xvfb, etc)."
+            )
+        return self.xvfb
+
+    @staticmethod
+    def _socket(number):
+        return "/tmp/.X11-unix/X{}".format(number)
+
+    def _in_use(self, number):
+        return (
+            number in self._displays
+            or os.path.exists("/tmp/.X{}-lock".format(number))
+            or os.path.exists(self._socket(number))
+        )
+
+    def _spawn(self, number):
+        """Start Xvfb on display ``number``, None if it didn't come up"""
+
+        with open(os.devnull, "wb") as devnull:
+            process = subprocess.Popen(
+                [
+                    self._binary(),
+                    ":{}".format(number),
+                    "-screen",
+                    "0",
+                    self.screen,
+                    "-nolisten",
+                    "tcp",
+                ],
+                stdout=devnull,
+                stderr=devnull,
+            )
+        deadline = time.time() + self.startup_timeout
+        while time.time() < deadline:
+            if process.poll() is not None:
+                # display number grabbed by someone else in the meantime
+                return None
+            if os.path.exists(self._socket(number)):
+                return process
+            time.sleep(0.05)
+        process.kill()
+        process.wait()
+        return None
+
+    def _start_display(self, number=None):
+        """Start a display, trying the next free numbers when ``number`` is taken"""
+
+        candidate = self.first_display if number is None else number
+        for _ in range(100):
+            if number is not None or not self._in_use(candidate):
+                process = self._spawn(candidate)
+                if process is not None:
+                    self._displays[candidate] = process
+                    return candidate
+            number = None
+            candidate += 1
+        raise OSError("Could not start an Xvfb display")
+
+    def start(self):
+        """Start all displays, called on first lease if not called explicitly"""
+
+        with self._lock:
+            if self._started:
+                return
+            for _ in range(self.size):
+                self._free.put(self._start_display())
+            self._started = True
+            if not self._exit_registered:
+                atexit.register(self.close)
+                self._exit_registered = True
+
+    def is_healthy(self, number):
+        """True when display ``number`` is running and accepting connections"""
+
+        process = self._displays.get(number)
+        return (
+            process is not None
+            and process.poll() is None
+            and os.path.exists(self._socket(number))
+        )
+
+    def _restart(self, number):
+        process = self._displays.pop(number, None)
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait()
+        self.restarts += 1
+        return self._start_display(number)
+
+    def acquire(self, timeout=None):
+        """
+        Take a free display out of the pool, blocking until one is available
+
+        :param timeout: (optional) seconds to wait for a free display
+        :return: value for the ``DISPLAY`` environment variable, e.g. ``":99"``
+        """
+        self.start()
+        try:
+            number = self._free.get(timeout=timeout)
+        except queue.Empty:
+            raise OSError("No free Xvfb display after {} seconds".format(timeout))
+        try:
+            if not self.is_healthy(number):
+                number = self._restart(number)
+        except Exception:
+            self._free.put(number)
+            raise
+        return ":{}".format(number)
+
+    def release(self, display):
+        """Return a display taken with :meth:`acquire` to the pool"""
+
+        self._free.put(int(display.lstrip(":")))
+
+    @contextlib.contextmanager
+    def lease(self, timeout=None):
+        """Context manager around :meth:`acquire`/:meth:`release`"""
+
+        display = self.acquire(timeout)
+        try:
+            yield display
+        finally:
+            self.release(display)
+
+    def close(self):
+        """Stop all displays"""
+
+        with self._lock:
+            for process in self._displays.values():
+                if process.poll() is None:
+                    process.terminate()
+            for process in self._displays.values():
+                process.wait()
+            self._displays.clear()
+            self._free = queue.Queue()
+            self._started = False
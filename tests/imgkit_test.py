@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import codecs
 import io
+import logging
 import os
 import sys
 import unittest
@@ -400,7 +401,7 @@ class TestCIMGKitGeneration(unittest.TestCase):
         result = imgkit.IMGKit("fixtures/example.html", "file", css=css)
         self.assertEqual(result.css, css)
         result._prepend_css(css)
-        self.assertIn("font-size", result.source.to_s())
+        self.assertIn(b"font-size", result._buffered_payload())
 
     def test_wkhtmltoimage_error_handling(self):
         result = imgkit.IMGKit("clearlywrongurl.asdf", "url")
@@ -448,6 +449,1675 @@ class TestDIMGKitAPI(unittest.TestCase):
         self.assertTrue(pic)
 
 
+class TestDBatchRendering(unittest.TestCase):
+    def test_results_keep_input_order(self):
+        jobs = [{"source": "<h1>{}</h1>".format(i)} for i in range(4)]
+        results = imgkit.render_many(jobs, max_workers=2)
+        self.assertEqual([r.index for r in results], [0, 1, 2, 3])
+        for r in results:
+            self.assertTrue(r.ok, r.error)
+            self.assertEqual(r.output[:4], b"\xff\xd8\xff\xe0")
+
+    def test_per_job_errors_do_not_stop_batch(self):
+        jobs = [
+            {"source": "html"},
+            {"source": "wrongpath.html", "type": "file"},
+            {"source": "html", "options": {"bad-option": None}},
+        ]
+        results = imgkit.render_many(jobs)
+        self.assertTrue(results[0].ok)
+        self.assertIsInstance(results[1].error, OSError)
+        self.assertIsInstance(results[2].error, OSError)
+
+    def test_empty_jobs(self):
+        self.assertEqual(imgkit.render_many([]), [])
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "asyncio.run requires Python 3.7+")
+class TestDAsyncAPI(unittest.TestCase):
+    def tearDown(self):
+        if os.path.exists("out.jpg"):
+            os.remove("out.jpg")
+
+    def test_from_string_async(self):
+        import asyncio
+
+        output = asyncio.run(imgkit.from_string_async("hello imgkit!", False))
+        self.assertEqual(output[:4], b"\xff\xd8\xff\xe0")
+
+    def test_from_file_async_with_semaphore(self):
+        import asyncio
+
+        async def render():
+            semaphore = asyncio.Semaphore(1)
+            return await asyncio.gather(
+                imgkit.from_file_async("fixtures/example.html", False, semaphore=semaphore),
+                imgkit.from_file_async("fixtures/example.html", "out.jpg", semaphore=semaphore),
+            )
+
+        output, pic = asyncio.run(render())
+        self.assertEqual(output[:4], b"\xff\xd8\xff\xe0")
+        self.assertTrue(pic)
+
+    def test_async_to_file_object(self):
+        import asyncio
+
+        output = io.BytesIO()
+        self.assertTrue(asyncio.run(imgkit.from_string_async("hello imgkit!", output)))
+        self.assertEqual(output.getvalue()[:4], b"\xff\xd8\xff\xe0")
+
+    def test_preparation_off_the_event_loop(self):
+        import asyncio
+        import threading
+
+        threads = []
+
+        class Assets(imgkit.AssetCache):
+            def rewrite(self, html, base=None):
+                threads.append(threading.current_thread())
+                return html
+
+        async def render():
+            threads.append(threading.current_thread())
+            for cache in (None, imgkit.MemoryCache()):
+                await imgkit.from_string_async("html", False, assets=Assets(), cache=cache)
+
+        asyncio.run(render())
+        self.assertEqual(len(threads), 3)
+        self.assertNotIn(threads[0], threads[1:])
+
+    def test_async_error_handling(self):
+        import asyncio
+
+        with self.assertRaises(OSError):
+            asyncio.run(imgkit.from_url_async("clearlywrongurl.asdf", False))
+
+    @unittest.skipIf(os.name != "posix", "requires a POSIX shell")
+    def test_cancel_kills_process(self):
+        import asyncio
+        import tempfile
+
+        tmpdir = tempfile.mkdtemp()
+        pidfile = os.path.join(tmpdir, "pid")
+        script = os.path.join(tmpdir, "wkhtmltoimage")
+        with open(script, "w") as f:
+            f.write("#!/bin/sh\necho $$ > {}\nexec sleep 30\n".format(pidfile))
+        os.chmod(script, 0o755)
+        config = imgkit.config(wkhtmltoimage=script)
+
+        async def render():
+            task = asyncio.ensure_future(
+                imgkit.from_string_async("html", False, config=config)
+            )
+            while not os.path.exists(pidfile):
+                await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(render())
+        with open(pidfile) as f:
+            pid = int(f.read())
+        with self.assertRaises(OSError):
+            os.kill(pid, 0)
+
+
+@unittest.skipIf(sys.version_info < (3, 3), "unittest.mock requires Python 3.3+")
+class TestDBinaryResolution(unittest.TestCase):
+    def setUp(self):
+        imgkit.Config.clear_cache()
+
+    def test_lookup_is_cached_across_configs(self):
+        from unittest import mock
+
+        path = imgkit.config().get_wkhtmltoimage()
+        with mock.patch("subprocess.check_output") as check_output:
+            self.assertEqual(imgkit.config().get_wkhtmltoimage(), path)
+            imgkit.IMGKit("html", "string")
+        self.assertFalse(check_output.called)
+
+    def test_lookup_is_keyed_on_path(self):
+        imgkit.config().get_wkhtmltoimage()
+        old_path = os.environ["PATH"]
+        os.environ["PATH"] = os.path.dirname(sys.executable)
+        try:
+            with self.assertRaises(OSError):
+                imgkit.config().get_wkhtmltoimage()
+        finally:
+            os.environ["PATH"] = old_path
+
+    def test_validate_once(self):
+        from unittest import mock
+
+        path = imgkit.config().get_wkhtmltoimage()
+        imgkit.config(validate_once=True).get_wkhtmltoimage()
+        config_module = sys.modules["imgkit.config"]
+        with mock.patch.object(config_module, "open", create=True) as open_:
+            config = imgkit.config(wkhtmltoimage=path, validate_once=True)
+            self.assertEqual(config.get_wkhtmltoimage(), path)
+        self.assertFalse(open_.called)
+
+
+class TestDRenderCache(unittest.TestCase):
+    def tearDown(self):
+        if os.path.exists("out.jpg"):
+            os.remove("out.jpg")
+
+    @unittest.skipIf(sys.version_info < (3, 3), "unittest.mock requires Python 3.3+")
+    def test_cache_hit_does_not_spawn(self):
+        from unittest import mock
+
+        cache = imgkit.MemoryCache()
+        first = imgkit.from_string("<h1>cached</h1>", False, cache=cache)
+        with mock.patch("subprocess.Popen") as popen:
+            second = imgkit.from_string("<h1>cached</h1>", False, cache=cache)
+            self.assertTrue(imgkit.from_string("<h1>cached</h1>", "out.jpg", cache=cache))
+        self.assertFalse(popen.called)
+        self.assertEqual(first, second)
+        with open("out.jpg", "rb") as f:
+            self.assertEqual(f.read(), first)
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 1})
+
+    def test_cache_key_depends_on_options_and_input(self):
+        cache = imgkit.MemoryCache()
+        imgkit.from_string("<h1>a</h1>", False, cache=cache)
+        imgkit.from_string("<h1>b</h1>", False, cache=cache)
+        imgkit.from_string("<h1>a</h1>", False, options={"quality": 50}, cache=cache)
+        imgkit.from_file("fixtures/example.html", False, cache=cache)
+        self.assertEqual(len(cache), 4)
+        self.assertEqual(cache.hits, 0)
+
+    def test_memory_cache_lru_eviction(self):
+        cache = imgkit.MemoryCache(max_entries=2, max_bytes=10)
+        cache.set("a", b"1234")
+        cache.set("b", b"1234")
+        cache.get("a")
+        cache.set("c", b"1234")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"1234")
+        cache.set("d", b"12345678")
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, 8)
+
+    def test_disk_cache_eviction(self):
+        import shutil
+        import tempfile
+
+        directory = tempfile.mkdtemp()
+        try:
+            cache = imgkit.DiskCache(directory, max_bytes=10)
+            cache.set("a", b"1234")
+            cache.set("b", b"1234")
+            cache.get("a")
+            cache.set("c", b"1234")
+            self.assertEqual(sorted(os.listdir(directory)), ["a", "c"])
+            reopened = imgkit.DiskCache(directory, max_bytes=10)
+            self.assertEqual(reopened.size, 8)
+            self.assertEqual(reopened.get("c"), b"1234")
+        finally:
+            shutil.rmtree(directory)
+
+    def test_custom_backend(self):
+        class DictCache(imgkit.CacheBackend):
+            def __init__(self):
+                imgkit.CacheBackend.__init__(self)
+                self.data = {}
+
+            def get(self, key):
+                return self.data.get(key)
+
+            def set(self, key, data):
+                self.data[key] = data
+
+        cache = DictCache()
+        imgkit.from_string("html", False, cache=cache)
+        imgkit.from_string("html", False, cache=cache)
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1})
+
+
+class TestDXvfbPool(unittest.TestCase):
+    def test_command_skips_xvfb_run_with_pool(self):
+        config = imgkit.config(xvfb_pool=imgkit.XvfbPool(size=1))
+        r = imgkit.IMGKit("html", "string", options={"xvfb": ""}, config=config)
+        command = r.command()
+        self.assertEqual(command[0], r.wkhtmltoimage)
+        self.assertNotIn("--xvfb", command)
+        self.assertNotIn("-a", command)
+
+    def test_img_generation_with_pool(self):
+        with imgkit.XvfbPool(size=2) as pool:
+            config = imgkit.config(xvfb_pool=pool)
+            results = imgkit.render_many(
+                [{"source": "html", "options": {"xvfb": ""}}] * 4, config=config
+            )
+            self.assertTrue(all(r.ok for r in results))
+            self.assertEqual(pool.restarts, 0)
+
+    def test_crashed_display_is_restarted(self):
+        with imgkit.XvfbPool(size=1) as pool:
+            display = pool.acquire()
+            number = int(display[1:])
+            pool._displays[number].kill()
+            pool._displays[number].wait()
+            pool.release(display)
+            with pool.lease() as display:
+                self.assertTrue(pool.is_healthy(int(display[1:])))
+            self.assertEqual(pool.restarts, 1)
+
+    def test_exit_handler_registered_once(self):
+        from imgkit import xvfb
+
+        registered = []
+        register = xvfb.atexit.register
+        xvfb.atexit.register = registered.append
+        try:
+            pool = imgkit.XvfbPool(size=1)
+            for _ in range(3):
+                pool.start()
+                pool.close()
+        finally:
+            xvfb.atexit.register = register
+        self.assertEqual(registered, [pool.close])
+
+
+class TestDStreamingOutput(unittest.TestCase):
+    def test_stream_to_file_object(self):
+        output = io.BytesIO()
+        self.assertTrue(imgkit.from_string("hello imgkit!", output))
+        self.assertEqual(output.getvalue(), imgkit.from_string("hello imgkit!", False))
+
+    def test_iter_img(self):
+        r = imgkit.IMGKit("fixtures/example.html", "file")
+        chunks = list(r.iter_img(chunk_size=16))
+        self.assertTrue(all(len(chunk) <= 16 for chunk in chunks))
+        self.assertEqual(b"".join(chunks)[:4], b"\xff\xd8\xff\xe0")
+
+    def test_iter_img_raises_after_output(self):
+        r = imgkit.IMGKit("clearlywrongurl.asdf", "url")
+        with self.assertRaises(OSError):
+            list(r.iter_img())
+
+    def test_stream_from_cache(self):
+        cache = imgkit.MemoryCache()
+        rendered = b"".join(imgkit.IMGKit("html", "string", cache=cache).iter_img())
+        output = io.BytesIO()
+        imgkit.from_string("html", output, cache=cache)
+        self.assertEqual(output.getvalue(), rendered)
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1})
+
+
+class TestDStreamingInput(unittest.TestCase):
+    def test_binary_file_object(self):
+        with open("fixtures/example.html", "rb") as f:
+            output = imgkit.from_file(f, False)
+        self.assertEqual(output[:4], b"\xff\xd8\xff\xe0")
+
+    def test_css_injected_while_streaming(self):
+        r = imgkit.IMGKit("fixtures/example.html", "file", css="fixtures/example.css")
+        command = r.command()
+        self.assertEqual(command[-2:], ["-", "-"])
+        self.assertEqual(r.source.source, "fixtures/example.html")
+
+        with open("fixtures/example.css") as f:
+            style = "<style>{}</style></head>".format(f.read()).encode("utf-8")
+        payload = r._buffered_payload()
+        self.assertEqual(payload.count(style), 1)
+        self.assertTrue(payload.startswith(b'<meta charset="UTF-8">'))
+
+    def test_head_marker_split_across_chunks(self):
+        html = io.BytesIO(b"<html><head><title>t</title></head><body>x</body></html>")
+        read = html.read
+        html.read = lambda size: read(5)
+        chunks = list(imgkit.IMGKit._iter_html(html, b"<style></style>"))
+        self.assertEqual(
+            b"".join(chunks),
+            b"<html><head><title>t</title><style></style></head><body>x</body></html>",
+        )
+
+    def test_css_prepended_without_head(self):
+        html = io.StringIO(u"<html><body>x</body></html>")
+        payload = b"".join(imgkit.IMGKit._iter_html(html, b"<style></style>", b"<meta>"))
+        self.assertEqual(payload, b"<meta><style></style><html><body>x</body></html>")
+
+    def test_file_without_head_like_string(self):
+        import tempfile
+
+        html = u"<html><body>x</body></html>"
+        fd, path = tempfile.mkstemp(suffix=".html")
+        with os.fdopen(fd, "w") as f:
+            f.write(html)
+        try:
+            from_file = imgkit.IMGKit(path, "file", css="fixtures/example.css")
+            from_file.command()
+            from_string = imgkit.IMGKit(html, "string", css="fixtures/example.css")
+            from_string.command()
+            self.assertEqual(from_file._buffered_payload(), from_string._buffered_payload())
+        finally:
+            os.remove(path)
+
+    def test_file_with_css_render(self):
+        output = imgkit.from_file(
+            "fixtures/example.html", False, css="fixtures/example.css"
+        )
+        self.assertEqual(output[:4], b"\xff\xd8\xff\xe0")
+
+
+class TestDMetaOptions(unittest.TestCase):
+    def test_attribute_order_and_quoting(self):
+        body = """
+        <html>
+          <head>
+            <META content='jpg' NAME='imgkit-format'>
+            <meta data-x="1" content=80 name=imgkit-quality />
+            <meta name="imgkit-orientation" content="Landscape"/>
+          </head>
+        """
+        r = imgkit.IMGKit(body, "string")
+        self.assertEqual(
+            r.options, {"format": "jpg", "quality": "80", "orientation": "Landscape"}
+        )
+
+    def test_scan_stops_at_head_end(self):
+        body = """
+        <html>
+          <head><meta name="imgkit-format" content="jpg"/></head>
+          <body><meta name="imgkit-quality" content="10"/></body>
+        </html>
+        """
+        r = imgkit.IMGKit(body, "string")
+        self.assertEqual(r.options, {"format": "jpg"})
+
+    def test_custom_prefix(self):
+        body = '<meta name="imgkit-format" content="jpg"><meta name="x-format" content="png">'
+        r = imgkit.IMGKit(body, "string", config=imgkit.config(meta_tag_prefix="x-"))
+        self.assertEqual(r.options, {"format": "png"})
+
+    def test_scan_opt_out(self):
+        body = '<meta name="imgkit-format" content="jpg">'
+        config = imgkit.config(scan_meta_tags=False)
+        r = imgkit.IMGKit(body, "string", config=config)
+        self.assertEqual(r.options, {})
+
+    def test_file_object_is_rewound(self):
+        r = imgkit.IMGKit("html", "string")
+        with io.open("fixtures/example.html") as f:
+            r._find_options_in_meta(f)
+            self.assertEqual(f.tell(), 0)
+
+
+class TestDRenderer(unittest.TestCase):
+    options = {"format": "jpg", "quality": 80, "custom-header": [("Accept", "*/*")]}
+
+    def test_command_matches_imgkit(self):
+        renderer = imgkit.Renderer(options=self.options, cover="test.html")
+        for source, source_type in (
+            ("html", "string"),
+            ("http://ya.ru", "url"),
+            ("fixtures/example.html", "file"),
+        ):
+            expected = imgkit.IMGKit(
+                source, source_type, options=self.options, cover="test.html"
+            ).command("out.jpg")
+            command = renderer.imgkit(source, source_type).command("out.jpg")
+            self.assertEqual(command, expected)
+
+    def test_options_are_not_rebuilt(self):
+        renderer = imgkit.Renderer(options=self.options)
+        r = renderer.imgkit("html", "string")
+        r._command_prefix = None  # would fail if the argv was generated again
+        self.assertEqual(r.command()[: len(renderer.args_prefix)], list(renderer.args_prefix))
+
+    def test_meta_options_rebuild_command(self):
+        renderer = imgkit.Renderer(options={"quality": 80})
+        r = renderer.imgkit('<meta name="imgkit-format" content="png">', "string")
+        command = r.command()
+        self.assertEqual(command[command.index("--format") + 1], "png")
+        self.assertEqual(command[command.index("--quality") + 1], "80")
+
+    def test_render_from_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        renderer = imgkit.Renderer(options={"format": "jpg"})
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            outputs = list(executor.map(
+                lambda i: renderer.from_string("<h1>{}</h1>".format(i), False), range(8)
+            ))
+        self.assertTrue(all(output[:4] == b"\xff\xd8\xff\xe0" for output in outputs))
+        self.assertEqual(
+            renderer.from_file("fixtures/example.html", False, css="fixtures/example.css")[:4],
+            b"\xff\xd8\xff\xe0",
+        )
+
+
+class TestDLibEngine(unittest.TestCase):
+    def test_settings_mapping(self):
+        engine = imgkit.LibEngine(library="libwkhtmltox.so")
+        r = imgkit.IMGKit(
+            "http://ya.ru", "url", options={"format": "png", "width": 320, "quiet": ""}
+        )
+        settings = engine.settings(r, "out.jpg")
+        self.assertEqual(
+            set(settings),
+            {("fmt", "png"), ("screenWidth", "320"), ("in", "http://ya.ru")},
+        )
+
+    def test_format_from_output_path(self):
+        engine = imgkit.LibEngine(library="libwkhtmltox.so")
+        r = imgkit.IMGKit("http://ya.ru", "url")
+        self.assertEqual(engine.settings(r, "out.PNG")[0], ("fmt", "png"))
+        self.assertEqual(engine.settings(r, None)[0], ("fmt", "jpg"))
+        self.assertEqual(engine.settings(r, "out")[0], ("fmt", "jpg"))
+        r.command(output="cached.png")
+        self.assertEqual(engine.settings(r)[0], ("fmt", "png"))
+
+    def test_unsupported_renders_use_cli(self):
+        engine = imgkit.LibEngine(library="libwkhtmltox.so")
+        for r in (
+            imgkit.IMGKit("html", "string", options={"cookie": [("a", "b")]}),
+            imgkit.IMGKit("html", "string", toc={"xsl-style-sheet": "test.xsl"}),
+            imgkit.IMGKit(["http://ya.ru", "http://google.com"], "url"),
+        ):
+            self.assertIsNone(engine.settings(r))
+
+    def test_fallback_without_library(self):
+        engine = imgkit.LibEngine(library="/nonexistent/libwkhtmltox.so")
+        self.assertFalse(engine.available)
+        output = imgkit.from_string("html", False, config=imgkit.config(engine=engine))
+        self.assertEqual(output[:4], b"\xff\xd8\xff\xe0")
+
+    @unittest.skipUnless(imgkit.LibEngine().available, "libwkhtmltox not installed")
+    def test_render_with_library(self):
+        engine = imgkit.LibEngine(max_renders=2)
+        config = imgkit.config(engine=engine)
+        try:
+            for _ in range(3):
+                output = imgkit.from_string("hello imgkit!", False, config=config)
+                self.assertEqual(output[:4], b"\xff\xd8\xff\xe0")
+            self.assertEqual(engine.recycled, 1)
+        finally:
+            engine.close()
+
+    @unittest.skipUnless(imgkit.LibEngine().available, "libwkhtmltox not installed")
+    def test_render_png_with_library(self):
+        import tempfile
+
+        engine = imgkit.LibEngine()
+        output = os.path.join(tempfile.mkdtemp(), "out.png")
+        try:
+            self.assertTrue(
+                imgkit.from_string("hello imgkit!", output, config=imgkit.config(engine=engine))
+            )
+            with open(output, "rb") as f:
+                self.assertEqual(f.read(8), b"\x89PNG\r\n\x1a\n")
+        finally:
+            engine.close()
+            os.remove(output)
+
+
+class TestDRenderStats(unittest.TestCase):
+    def test_stats_of_string_render(self):
+        r = imgkit.IMGKit("<html><head></head>hello</html>", "string", css="fixtures/example.css")
+        output = r.to_img()
+        stats = r.stats
+        for stage in ("config", "meta_scan", "css", "argv", "spawn", "process", "result"):
+            self.assertIn(stage, stats.stages)
+        self.assertEqual(stats.exit_code, 0)
+        self.assertEqual(stats.bytes_in, len(r._buffered_payload()))
+        self.assertEqual(stats.bytes_out, len(output))
+        self.assertTrue(stats.total > 0)
+        if hasattr(os, "wait4"):
+            self.assertTrue(stats.max_rss > 0)
+            self.assertTrue(stats.user_time >= 0)
+
+    def test_stats_of_file_output(self):
+        r = imgkit.IMGKit("fixtures/example.html", "file")
+        self.assertTrue(r.to_img("out.jpg"))
+        self.assertEqual(r.stats.bytes_in, os.path.getsize("fixtures/example.html"))
+        self.assertEqual(r.stats.bytes_out, os.path.getsize("out.jpg"))
+        os.remove("out.jpg")
+
+    def test_hooks_see_success_and_failure(self):
+        calls = []
+        config = imgkit.config(hooks=[lambda kit, stats: calls.append(stats)])
+        imgkit.from_string("html", False, config=config)
+        with self.assertRaises(OSError):
+            imgkit.from_url("clearlywrongurl.asdf", False, config=config)
+        self.assertEqual(len(calls), 2)
+        self.assertIsNone(calls[0].error)
+        self.assertIsInstance(calls[1].error, OSError)
+        self.assertNotEqual(calls[1].exit_code, 0)
+        self.assertEqual(calls[0].as_dict()["exit_code"], 0)
+
+    def test_failing_hook_is_logged(self):
+        def hook(kit, stats):
+            raise ValueError("exporter down")
+
+        config = imgkit.config(hooks=[hook])
+        logger = logging.getLogger("imgkit.imgkit")
+        handler = logging.Handler()
+        records = []
+        handler.emit = records.append
+        logger.addHandler(handler)
+        try:
+            self.assertEqual(imgkit.from_string("html", False, config=config)[:2], b"\xff\xd8")
+            with self.assertRaises(OSError):
+                imgkit.from_url("clearlywrongurl.asdf", False, config=config)
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(len(records), 2)
+
+    def test_cache_hit_stats(self):
+        cache = imgkit.MemoryCache()
+        imgkit.from_string("html", False, cache=cache)
+        r = imgkit.IMGKit("html", "string", cache=cache)
+        output = r.to_img()
+        self.assertTrue(r.stats.cached)
+        self.assertEqual(r.stats.bytes_out, len(output))
+        self.assertNotIn("spawn", r.stats.stages)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "asyncio.run requires Python 3.7+")
+    def test_async_stats(self):
+        import asyncio
+
+        r = imgkit.IMGKit("html", "string")
+        output = asyncio.run(r.to_img_async())
+        self.assertEqual(r.stats.exit_code, 0)
+        self.assertEqual(r.stats.bytes_out, len(output))
+        self.assertIn("process", r.stats.stages)
+
+    def test_batch_results_carry_stats(self):
+        results = imgkit.render_many([{"source": "html"}, {"source": "html"}])
+        self.assertTrue(all(result.stats.exit_code == 0 for result in results))
+
+
+class ScriptBinaryMixin(object):
+
+    """Runs renders with a shell script in place of wkhtmltoimage"""
+
+    def setUp(self):
+        import tempfile
+
+        self.directory = tempfile.mkdtemp()
+        self.binary = os.path.join(self.directory, "wkhtmltoimage")
+        self.config = imgkit.config(wkhtmltoimage=self.binary)
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.directory)
+
+    def write_binary(self, script):
+        with open(self.binary, "w") as f:
+            f.write("#!/bin/sh\n" + script)
+        os.chmod(self.binary, 0o755)
+
+    def write_format_binary(self, png=None):
+        """Picks the format like wkhtmltoimage: --format, else the output extension, else jpg"""
+
+        if png is None:
+            png = os.path.join(self.directory, "image.png")
+            with open(png, "wb") as f:
+                f.write(PNG_HEADER)
+        self.write_binary(
+            "cat > /dev/null\nfmt=\nprev=\n"
+            'for arg; do [ "$prev" = --format ] && fmt=$arg; prev=$arg; done\n'
+            '[ -z "$fmt" ] && [ "$prev" != - ] && fmt=${{prev##*.}}\n'
+            'if [ "$fmt" = png ]; then cmd="cat {}"; else cmd="printf \\377\\330\\377\\340"; fi\n'
+            'if [ "$prev" = - ]; then $cmd; else $cmd > "$prev"; fi\n'.format(png)
+        )
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+
+@unittest.skipIf(os.name == "nt", "needs a POSIX shell")
+class TestDOutputFormat(ScriptBinaryMixin, unittest.TestCase):
+    def setUp(self):
+        super(TestDOutputFormat, self).setUp()
+        self.write_format_binary()
+
+    def test_format_from_extension(self):
+        output = os.path.join(self.directory, "plain.png")
+        imgkit.from_string("html", output, config=self.config)
+        self.assertEqual(self.read(output), PNG_HEADER)
+        self.assertEqual(imgkit.from_string("html", False, config=self.config)[:2], b"\xff\xd8")
+
+    def test_cached_render(self):
+        cache = imgkit.MemoryCache()
+        png, jpg = (os.path.join(self.directory, name) for name in ("a.png", "b.jpg"))
+        imgkit.from_string("html", png, config=self.config, cache=cache)
+        imgkit.from_string("html", jpg, config=self.config, cache=cache)
+        self.assertEqual(self.read(png), PNG_HEADER)
+        self.assertEqual(self.read(jpg)[:2], b"\xff\xd8")
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(imgkit.from_string("html", False, config=self.config, cache=cache)[:2], b"\xff\xd8")
+        self.assertEqual(cache.hits, 1)
+
+    def test_atomic_render(self):
+        self.config.atomic_writes = True
+        output = os.path.join(self.directory, "atomic.png")
+        imgkit.from_string("html", output, config=self.config)
+        self.assertEqual(self.read(output), PNG_HEADER)
+
+    def test_single_flight(self):
+        self.config.single_flight = imgkit.SingleFlight()
+        png, jpg = (os.path.join(self.directory, name) for name in ("flight.png", "flight.jpg"))
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(lambda path: imgkit.from_string("html", path, config=self.config), [png, jpg]))
+        self.assertEqual(self.read(png), PNG_HEADER)
+        self.assertEqual(self.read(jpg)[:2], b"\xff\xd8")
+        self.assertEqual(self.config.single_flight.stats(), {"leaders": 2, "shared": 0})
+
+    @unittest.skipIf(sys.version_info < (3, 7), "asyncio.run requires Python 3.7+")
+    def test_async_single_flight(self):
+        import asyncio
+
+        self.config.single_flight = imgkit.SingleFlight()
+        png, jpg = (os.path.join(self.directory, name) for name in ("flight.png", "flight.jpg"))
+
+        async def render_both():
+            await asyncio.gather(
+                imgkit.from_string_async("html", png, config=self.config),
+                imgkit.from_string_async("html", jpg, config=self.config),
+            )
+
+        asyncio.run(render_both())
+        self.assertEqual(self.read(png), PNG_HEADER)
+        self.assertEqual(self.read(jpg)[:2], b"\xff\xd8")
+        self.assertEqual(self.config.single_flight.stats(), {"leaders": 2, "shared": 0})
+
+    def test_atomic_commit_checks_extension(self):
+        from imgkit.output import AtomicFile
+
+        output = os.path.join(self.directory, "atomic.jpg")
+        atomic = AtomicFile(output)
+        atomic.write(PNG_HEADER)
+        with self.assertRaises(OSError):
+            atomic.commit()
+        self.assertFalse(os.path.exists(output))
+        atomic = AtomicFile(output, check_format=False)
+        atomic.write(PNG_HEADER)
+        self.assertEqual(atomic.commit(), ("png", 3, 2))
+
+
+@unittest.skipIf(os.name == "nt", "needs a POSIX shell")
+class TestDTimeoutsAndLimits(ScriptBinaryMixin, unittest.TestCase):
+    def assertDead(self, pid):
+        import time
+
+        for _ in range(50):
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                return
+            time.sleep(0.1)
+        self.fail("process {} is still running".format(pid))
+
+    def test_timeout_kills_process_group(self):
+        pid_file = os.path.join(self.directory, "pid")
+        self.write_binary("sleep 30 &\necho $! > {}\nwait\n".format(pid_file))
+        with self.assertRaises(imgkit.IMGKit.RenderTimeout) as context:
+            imgkit.from_string("html", False, config=self.config, timeout=0.5)
+        self.assertIsInstance(context.exception, OSError)
+        with open(pid_file) as f:
+            self.assertDead(int(f.read()))
+
+    def test_timeout_not_reached(self):
+        self.write_binary("cat > /dev/null\nprintf image\n")
+        output = imgkit.from_string("html", False, config=self.config, timeout=30)
+        self.assertEqual(output, b"image")
+
+    def test_resource_limits(self):
+        self.write_binary("cat > /dev/null\nulimit -v\nulimit -t\n")
+        output = imgkit.from_string(
+            "html", False, config=self.config, memory_limit=512 * 1024 ** 2, cpu_limit=7
+        )
+        self.assertEqual(output.split(), [b"524288", b"7"])
+
+    @unittest.skipIf(sys.version_info < (3, 7), "asyncio.run requires Python 3.7+")
+    def test_async_timeout(self):
+        import asyncio
+
+        self.write_binary("sleep 30\n")
+        r = imgkit.IMGKit("html", "string", config=self.config, timeout=0.5)
+        with self.assertRaises(imgkit.IMGKit.RenderTimeout):
+            asyncio.run(r.to_img_async())
+        self.assertIsInstance(r.stats.error, imgkit.IMGKit.RenderTimeout)
+
+
+@unittest.skipIf(os.name == "nt", "needs a POSIX shell")
+class TestDSingleFlight(ScriptBinaryMixin, unittest.TestCase):
+    def setUp(self):
+        super(TestDSingleFlight, self).setUp()
+        self.runs = os.path.join(self.directory, "runs")
+        self.config.single_flight = imgkit.SingleFlight()
+
+    def write_counting_binary(self, script):
+        self.write_binary("echo run >> {}\ncat > /dev/null\nsleep 0.5\n{}".format(self.runs, script))
+
+    def run_count(self):
+        with open(self.runs) as f:
+            return len(f.readlines())
+
+    def render_from_threads(self, count, output_path=False):
+        from concurrent.futures import ThreadPoolExecutor
+
+        def render(_):
+            try:
+                return imgkit.from_string("html", output_path, config=self.config)
+            except OSError as error:
+                return error
+
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            return list(executor.map(render, range(count)))
+
+    def test_identical_renders_share_one_process(self):
+        self.write_counting_binary("printf image\n")
+        results = self.render_from_threads(5)
+        self.assertEqual(results, [b"image"] * 5)
+        self.assertEqual(self.run_count(), 1)
+        self.assertEqual(self.config.single_flight.stats(), {"leaders": 1, "shared": 4})
+
+    def test_outputs_written_per_caller(self):
+        self.write_counting_binary("printf image\n")
+        output = io.BytesIO()
+        self.assertTrue(imgkit.from_string("html", output, config=self.config))
+        self.assertEqual(output.getvalue(), b"image")
+
+    def test_errors_reach_all_waiters(self):
+        self.write_counting_binary("echo Error >&2\nexit 1\n")
+        results = self.render_from_threads(3)
+        self.assertTrue(all(isinstance(result, OSError) for result in results))
+        self.assertEqual(self.run_count(), 1)
+
+    def test_different_renders_are_not_shared(self):
+        self.write_counting_binary("printf image\n")
+        imgkit.from_string("html", False, config=self.config)
+        imgkit.from_string("other html", False, config=self.config)
+        self.assertEqual(self.run_count(), 2)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "asyncio.run requires Python 3.7+")
+    def test_async_renders_share_one_process(self):
+        import asyncio
+
+        self.write_counting_binary("printf image\n")
+
+        async def render_all():
+            return await asyncio.gather(
+                *[imgkit.from_string_async("html", False, config=self.config) for _ in range(5)]
+            )
+
+        self.assertEqual(asyncio.run(render_all()), [b"image"] * 5)
+        self.assertEqual(self.run_count(), 1)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "asyncio.run requires Python 3.7+")
+    def test_cancelled_leader_does_not_fail_waiters(self):
+        import asyncio
+
+        self.write_counting_binary("printf image\n")
+
+        async def render():
+            return await imgkit.from_string_async("html", False, config=self.config)
+
+        async def cancel_leader():
+            leader = asyncio.ensure_future(render())
+            await asyncio.sleep(0.2)
+            waiter = asyncio.ensure_future(render())
+            await asyncio.sleep(0.1)
+            leader.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await leader
+            return await waiter
+
+        self.assertEqual(asyncio.run(cancel_leader()), b"image")
+        self.assertEqual(self.run_count(), 2)
+
+    def test_interrupted_leader_hands_over_to_thread_waiter(self):
+        import threading
+
+        flight = imgkit.SingleFlight()
+        started = threading.Event()
+        joined = threading.Event()
+        results = []
+
+        class Interrupted(BaseException):
+            pass
+
+        def interrupted():
+            started.set()
+            while not flight.shared:
+                joined.wait(0.01)
+            raise Interrupted()
+
+        def lead():
+            try:
+                flight.do("key", interrupted)
+            except Interrupted:
+                pass
+
+        leader = threading.Thread(target=lead)
+        leader.start()
+        started.wait()
+        waiter = threading.Thread(target=lambda: results.append(flight.do("key", lambda: b"image")))
+        waiter.start()
+        leader.join()
+        waiter.join()
+        self.assertEqual(results, [(b"image", False)])
+
+
+class TestDFanOut(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.directory)
+
+    def test_files_to_output_list(self):
+        outputs = [os.path.join(self.directory, name) for name in ("a.jpg", "b.jpg")]
+        results = imgkit.from_file(
+            ["fixtures/example.html", "fixtures/example.html"], outputs, workers=2
+        )
+        self.assertEqual([result.output for result in results], [True, True])
+        for output in outputs:
+            with open(output, "rb") as f:
+                self.assertEqual(f.read(4), b"\xff\xd8\xff\xe0")
+
+    def test_urls_to_template(self):
+        template = os.path.join(self.directory, "{index}-{name}.jpg")
+        results = imgkit.from_url(["http://ya.ru", "http://google.com/a b"], template)
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual(
+            sorted(os.listdir(self.directory)), ["0-ya.ru.jpg", "1-google.com_a_b.jpg"]
+        )
+
+    def test_per_source_errors(self):
+        results = imgkit.from_url(["http://ya.ru", "clearlywrongurl.asdf"], [False, False])
+        self.assertEqual(results[0].output[:4], b"\xff\xd8\xff\xe0")
+        self.assertIsInstance(results[1].error, OSError)
+
+    def test_output_count_must_match(self):
+        with self.assertRaises(ValueError) as raised:
+            imgkit.from_url(["http://ya.ru", "http://google.com"], ["a.jpg"])
+        self.assertEqual(str(raised.exception), "2 sources need as many output paths, got 1")
+
+    def test_single_output_keeps_one_process(self):
+        output = imgkit.from_url(["http://ya.ru", "http://google.com"], False)
+        self.assertEqual(output[:4], b"\xff\xd8\xff\xe0")
+
+
+def has_pillow():
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+@unittest.skipIf(os.name == "nt", "needs a POSIX shell")
+@unittest.skipIf(not has_pillow(), "derivatives need Pillow")
+class TestDDerivatives(ScriptBinaryMixin, unittest.TestCase):
+    def setUp(self):
+        from PIL import Image
+
+        super(TestDDerivatives, self).setUp()
+        rendered = os.path.join(self.directory, "rendered.png")
+        Image.new("RGBA", (400, 200), (255, 0, 0, 255)).save(rendered)
+        self.write_binary("cat > /dev/null\ncat {}\n".format(rendered))
+
+    def open(self, data):
+        from PIL import Image
+
+        return Image.open(io.BytesIO(data) if isinstance(data, bytes) else data)
+
+    def test_several_sizes_and_formats(self):
+        thumbnail = os.path.join(self.directory, "thumb.webp")
+        results = imgkit.from_string(
+            "html",
+            False,
+            config=self.config,
+            derivatives=[
+                imgkit.Derivative(thumbnail, size=(100, 100)),
+                imgkit.Derivative(size=(40, 30), fit="resize", format="jpeg", quality=70),
+                imgkit.Derivative(),
+            ],
+        )
+        self.assertTrue(results[0])
+        image = self.open(thumbnail)
+        self.assertEqual((image.format, image.size), ("WEBP", (100, 50)))
+        image = self.open(results[1])
+        self.assertEqual((image.format, image.size, image.mode), ("JPEG", (40, 30), "RGB"))
+        image = self.open(results[2])
+        self.assertEqual((image.format, image.size), ("PNG", (400, 200)))
+
+    def test_render_in_format_of_its_extension(self):
+        self.write_format_binary(os.path.join(self.directory, "rendered.png"))
+        original = os.path.join(self.directory, "original.png")
+        imgkit.from_string("html", original, config=self.config, derivatives=[imgkit.Derivative()])
+        self.assertEqual(self.open(original).format, "PNG")
+
+    def test_render_written_beside_derivatives(self):
+        original = os.path.join(self.directory, "original.png")
+        r = imgkit.IMGKit("html", "string", config=self.config)
+        r.to_img(original, [imgkit.Derivative(format="png", size=(10, 10))])
+        self.assertEqual(self.open(original).size, (400, 200))
+        self.assertIn("derivatives", r.stats.stages)
+
+    def test_unknown_fit(self):
+        with self.assertRaises(ValueError):
+            imgkit.Derivative(fit="stretch")
+
+
+class TestDCommandLine(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.directory)
+
+    def run_manifest(self, lines, **kwargs):
+        import json
+
+        from imgkit import cli
+
+        manifest = io.StringIO(u"\n".join(lines) + u"\n")
+        log = io.StringIO()
+        counts = cli.run(manifest, log, concurrency=2, options={"quiet": ""}, **kwargs)
+        records = [json.loads(line) for line in log.getvalue().splitlines()]
+        return counts, sorted(records, key=lambda record: record["line"])
+
+    def job(self, source, name, **extra):
+        import json
+
+        extra.update(source=source, output=os.path.join(self.directory, name))
+        return json.dumps(extra)
+
+    def test_manifest_jobs_and_log(self):
+        counts, records = self.run_manifest(
+            [
+                self.job("http://ya.ru", "a.jpg"),
+                self.job("fixtures/example.html", "b.jpg", type="file"),
+                "not json",
+                self.job("clearlywrongurl.asdf", "c.jpg"),
+            ]
+        )
+        self.assertEqual(
+            counts, {"ok": 2, "unchanged": 0, "error": 1, "skipped": 0, "invalid": 1}
+        )
+        self.assertEqual(
+            [record["status"] for record in records], ["ok", "ok", "invalid", "error"]
+        )
+        self.assertIn("process", records[0]["stages"])
+        self.assertTrue(records[0]["seconds"] > 0)
+        self.assertTrue(os.path.getsize(os.path.join(self.directory, "b.jpg")) > 0)
+
+    def test_resume_skips_existing_outputs(self):
+        jobs = [self.job("http://ya.ru", "a.jpg"), self.job("http://google.com", "b.jpg")]
+        self.run_manifest(jobs[:1])
+        counts, records = self.run_manifest(jobs, resume=True)
+        self.assertEqual(counts["skipped"], 1)
+        self.assertEqual([record["status"] for record in records], ["skipped", "ok"])
+
+    def test_main_exit_code(self):
+        from imgkit import cli
+
+        manifest = os.path.join(self.directory, "jobs.jsonl")
+        log = os.path.join(self.directory, "log.jsonl")
+        with open(manifest, "w") as f:
+            f.write(self.job("http://ya.ru", "a.jpg") + "\n")
+        self.assertEqual(cli.main([manifest, "--log", log, "-j", "1"]), 0)
+        with open(manifest, "a") as f:
+            f.write(self.job("clearlywrongurl.asdf", "b.jpg") + "\n")
+        self.assertEqual(cli.main([manifest, "--log", log, "--resume"]), 1)
+        with open(log) as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+
+class TestDIncremental(unittest.TestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+
+        self.directory = tempfile.mkdtemp()
+        self.html = os.path.join(self.directory, "page.html")
+        self.css = os.path.join(self.directory, "page.css")
+        self.output = os.path.join(self.directory, "page.jpg")
+        shutil.copy("fixtures/example.html", self.html)
+        shutil.copy("fixtures/example.css", self.css)
+        self.manifest = imgkit.RenderManifest(os.path.join(self.directory, "manifest.json"))
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.directory)
+
+    def render(self, options=None, css=None):
+        r = imgkit.IMGKit(
+            self.html, "file", options=options, css=css or self.css, manifest=self.manifest
+        )
+        r.to_img(self.output)
+        return r.stats.skipped
+
+    def test_unchanged_inputs_are_skipped(self):
+        self.assertFalse(self.render())
+        self.assertTrue(self.render())
+        self.assertFalse(self.render(options={"width": 300}))
+        with open(self.css, "a") as f:
+            f.write("p { color: red; }")
+        self.assertFalse(self.render(options={"width": 300}))
+        self.assertTrue(self.render(options={"width": 300}))
+
+    def test_touched_file_is_not_rerendered(self):
+        self.render()
+        stat = os.stat(self.html)
+        os.utime(self.html, (stat.st_atime, stat.st_mtime + 10))
+        self.assertTrue(self.render())
+        recorded = self.manifest.outputs[os.path.abspath(self.output)]
+        self.assertEqual(recorded["files"][os.path.abspath(self.html)]["mtime"], stat.st_mtime + 10)
+
+    def test_missing_output_is_rendered(self):
+        self.render()
+        os.remove(self.output)
+        self.assertFalse(self.render())
+
+    def test_saved_manifest_is_reloaded(self):
+        with self.manifest:
+            self.render()
+        self.manifest = imgkit.RenderManifest(self.manifest.path)
+        self.assertTrue(self.render())
+
+    def test_strings_and_urls(self):
+        imgkit.from_string("html", self.output, manifest=self.manifest)
+        r = imgkit.IMGKit("html", "string", manifest=self.manifest)
+        r.to_img(self.output)
+        self.assertTrue(r.stats.skipped)
+        r = imgkit.IMGKit("http://ya.ru", "url", manifest=self.manifest)
+        r.to_img(self.output)
+        self.assertFalse(r.stats.skipped)
+
+    def test_command_line_flag(self):
+        import json
+
+        from imgkit import cli
+
+        manifest = os.path.join(self.directory, "jobs.jsonl")
+        log = os.path.join(self.directory, "log.jsonl")
+        with open(manifest, "w") as f:
+            f.write(json.dumps({"source": self.html, "type": "file", "output": self.output}))
+        args = [manifest, "--log", log, "--incremental", self.manifest.path]
+        self.assertEqual(cli.main(args), 0)
+        self.assertEqual(cli.main(args), 0)
+        with open(log) as f:
+            statuses = [json.loads(line)["status"] for line in f]
+        self.assertEqual(statuses, ["ok", "unchanged"])
+
+
+PNG_HEADER = b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x03\x00\x00\x00\x02"
+
+
+class TestDAtomicWrites(ScriptBinaryMixin, unittest.TestCase):
+    def setUp(self):
+        super(TestDAtomicWrites, self).setUp()
+        self.config.atomic_writes = True
+        self.output = os.path.join(self.directory, "out.png")
+        self.image = os.path.join(self.directory, "image.png")
+
+    def render_binary(self, data):
+        with open(self.image, "wb") as f:
+            f.write(data)
+        self.write_binary("cat > /dev/null\ncat {}\n".format(self.image))
+
+    def test_sniff_image(self):
+        import struct
+
+        from imgkit.output import sniff_image
+
+        self.assertEqual(sniff_image(PNG_HEADER), ("png", 3, 2))
+        bmp = b"BM" + b"\x00" * 16 + struct.pack("<ii", 4, -5)
+        self.assertEqual(sniff_image(bmp), ("bmp", 4, 5))
+        jpeg = (
+            b"\xff\xd8\xff\xe0\x00\x04\x00\x00"
+            + b"\xff\xc0\x00\x11\x08"
+            + struct.pack(">HH", 6, 7)
+        )
+        self.assertEqual(sniff_image(jpeg), ("jpg", 7, 6))
+        self.assertEqual(sniff_image(b"<?xml?><svg>"), ("svg", None, None))
+        self.assertIsNone(sniff_image(b"Loading page"))
+
+    def test_atomic_render(self):
+        self.render_binary(PNG_HEADER)
+        self.assertTrue(imgkit.from_string("html", self.output, config=self.config))
+        with open(self.output, "rb") as f:
+            self.assertEqual(f.read(), PNG_HEADER)
+        self.assertEqual(sorted(os.listdir(self.directory)), ["image.png", "out.png", "wkhtmltoimage"])
+
+    @unittest.skipIf(os.name == "nt", "POSIX file modes")
+    def test_mode_follows_umask(self):
+        self.render_binary(PNG_HEADER)
+        previous = os.umask(0o027)
+        umask, os.umask = os.umask, None
+        try:
+            # commits must not touch the process-wide umask
+            imgkit.from_string("html", self.output, config=self.config)
+        finally:
+            os.umask = umask
+            os.umask(previous)
+        self.assertEqual(os.stat(self.output).st_mode & 0o777, 0o640)
+
+    def test_invalid_output_keeps_previous_file(self):
+        with open(self.output, "wb") as f:
+            f.write(b"previous")
+        for data in (b"", b"not an image", PNG_HEADER[:-4] + b"\x00" * 4):
+            self.render_binary(data)
+            with self.assertRaises(OSError):
+                imgkit.from_string("html", self.output, config=self.config)
+            with open(self.output, "rb") as f:
+                self.assertEqual(f.read(), b"previous")
+        self.assertFalse([name for name in os.listdir(self.directory) if name.startswith(".")])
+
+    def test_cached_render(self):
+        self.render_binary(PNG_HEADER)
+        cache = imgkit.MemoryCache()
+        imgkit.from_string("html", self.output, config=self.config, cache=cache)
+        os.remove(self.output)
+        imgkit.from_string("html", self.output, config=self.config, cache=cache)
+        self.assertTrue(os.path.exists(self.output))
+
+    def test_empty_output_is_an_error(self):
+        self.render_binary(b"")
+        open(self.output, "wb").close()
+        r = imgkit.IMGKit("html", "string", config=self.config)
+        with self.assertRaises(OSError):
+            r._handle_result([self.binary, "--quiet"], self.output, b"", "", 0)
+
+
+@unittest.skipIf(not hasattr(__import__("socket"), "AF_UNIX"), "needs Unix sockets")
+class TestDRenderServer(ScriptBinaryMixin, unittest.TestCase):
+    def setUp(self):
+        import threading
+
+        from imgkit.server import RenderServer
+
+        super(TestDRenderServer, self).setUp()
+        self.write_binary('cat > /dev/null\necho "$@"\n')
+        self.path = os.path.join(self.directory, "imgkit.sock")
+        self.server = RenderServer(self.path, 2, {"quiet": ""}, self.config)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.client = imgkit.Client(self.path, timeout=10)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        super(TestDRenderServer, self).tearDown()
+
+    def test_from_string(self):
+        self.assertIn(b"--quiet", self.client.from_string("html", False).split())
+        output = os.path.join(self.directory, "out.jpg")
+        self.assertTrue(self.client.from_string("html", output, options={"width": 10}))
+        with open(output, "rb") as f:
+            self.assertIn(b"--width", f.read().split())
+
+    def test_format_of_output_extension(self):
+        output = os.path.join(self.directory, "out.png")
+        self.client.from_string("html", output)
+        with open(output, "rb") as f:
+            self.assertIn(b"--format png", f.read())
+        self.client.from_string("html", output, options={"format": "bmp"})
+        with open(output, "rb") as f:
+            self.assertNotIn(b"png", f.read())
+
+    def test_concurrent_clients(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            images = list(executor.map(lambda i: self.client.from_url("http://ya.ru", False), range(8)))
+        self.assertEqual(len(images), 8)
+        self.assertTrue(all(b"http://ya.ru" in image.split() for image in images))
+
+    def test_errors(self):
+        self.write_binary("cat > /dev/null\necho Error: boom >&2\nexit 1\n")
+        with self.assertRaises(OSError) as context:
+            self.client.from_string("html", False)
+        self.assertIn("boom", str(context.exception))
+        self.write_binary("sleep 30\n")
+        with self.assertRaises(imgkit.IMGKit.RenderTimeout):
+            self.client.from_string("html", False, timeout=0.5)
+
+    def test_protocol(self):
+        import socket
+
+        from imgkit.client import recv_message, send_message
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        try:
+            send_message(sock, {"type": "ftp"}, b"x")
+            reply, image = recv_message(sock)
+            self.assertFalse(reply["ok"])
+            send_message(sock, {"type": "string"}, b"html")
+            reply, image = recv_message(sock)
+            self.assertTrue(reply["ok"])
+            self.assertEqual(reply["stats"]["exit_code"], 0)
+            self.assertIn(b"--quiet", image.split())
+        finally:
+            sock.close()
+
+
+class TestDStylesheetCache(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        from imgkit import stylesheets
+
+        stylesheets.clear_cache()
+        fd, self.css = tempfile.mkstemp(suffix=".css")
+        with os.fdopen(fd, "w") as f:
+            f.write("p { color: red; }")
+
+    def tearDown(self):
+        os.remove(self.css)
+
+    def test_block_is_cached_until_the_file_changes(self):
+        from imgkit.stylesheets import style_block
+
+        block = style_block([self.css])
+        self.assertEqual(block[0], "<style>p { color: red; }</style>")
+        self.assertIs(style_block([self.css]), block)
+        with open(self.css, "w") as f:
+            f.write("p { color: blue; }")
+        self.assertEqual(style_block([self.css])[1], b"<style>p { color: blue; }</style>")
+
+    def test_repeated_commands_inject_once(self):
+        html = "<html><head></head><body></head></body></html>"
+        r = imgkit.IMGKit(html, "string", css=self.css)
+        r.command()
+        r.command()
+        self.assertEqual(
+            r.source.to_s(),
+            "<html><head><style>p { color: red; }</style></head><body></head></body></html>",
+        )
+        self.assertEqual(r.unstyled_source, html)
+
+
+class TestDAssetCache(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, "img"))
+        self.write("img/dot.png", PNG_HEADER)
+        self.write("img/big.png", PNG_HEADER * 10)
+        self.write("font.woff", b"font")
+        self.write("style.css", b"@font-face { src: url('font.woff'); }")
+        self.html = os.path.join(self.directory, "page.html")
+        self.write(
+            "page.html",
+            b'<html><head><link rel="stylesheet" href="style.css">'
+            b'<link rel="canonical" href="other.html"></head>'
+            b'<body><img src="img/dot.png"><img src="img/big.png">'
+            b'<img src="missing.png"><img src="data:,x"></body></html>',
+        )
+        self.assets = imgkit.AssetCache(inline_limit=100)
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        with open(os.path.join(self.directory, name), "wb") as f:
+            f.write(data)
+
+    def test_rewrite(self):
+        import base64
+
+        from imgkit.assets import file_url
+
+        with open(self.html) as f:
+            html = self.assets.rewrite(f.read(), file_url(self.html))
+        dot = "data:image/png;base64," + base64.b64encode(PNG_HEADER).decode("ascii")
+        self.assertIn('<img src="{}">'.format(dot), html)
+        self.assertIn(file_url(os.path.join(self.directory, "img/big.png")), html)
+        self.assertIn(file_url(os.path.join(self.directory, "missing.png")), html)
+        self.assertIn('href="other.html"', html)
+        self.assertIn('src="data:,x"', html)
+
+        style = html.split('href="data:text/css;base64,')[1].split('"')[0]
+        style = base64.b64decode(style).decode("utf-8")
+        self.assertIn("url('data:", style)
+
+        fetches = self.assets.fetches
+        self.assertEqual(fetches, 5)
+        self.assets.rewrite(html, file_url(self.html))
+        self.assertEqual(self.assets.fetches, fetches)
+
+    def test_css_only_in_styles(self):
+        html = (
+            '<style>p { background: url("img/dot.png"); }</style>'
+            '<p style="background: url(img/dot.png)">url(img/dot.png)</p>'
+            '<script>var u = "url(img/dot.png)"; if (a<b) {}</script>'
+        )
+        html = self.assets.rewrite(html, self.html)
+        self.assertEqual(html.count("data:image/png"), 2)
+        self.assertIn('<p style="background: url(data:', html)
+        self.assertIn('>url(img/dot.png)</p><script>var u = "url(img/dot.png)"; if (a<b) {}</script>', html)
+
+    def test_changed_local_file_is_fetched_again(self):
+        import base64
+
+        from imgkit.assets import file_url
+
+        url = file_url(os.path.join(self.directory, "font.woff"))
+        reference = self.assets.reference(url)
+        self.assertEqual(base64.b64decode(reference.split(",")[1]), b"font")
+        self.assertEqual(self.assets.reference(url), reference)
+        self.assertEqual(self.assets.fetches, 1)
+        self.write("font.woff", b"new font")
+        reference = self.assets.reference(url)
+        self.assertEqual(base64.b64decode(reference.split(",")[1]), b"new font")
+        self.assertEqual(self.assets.fetches, 2)
+
+    def test_import_cycle(self):
+        import base64
+
+        self.write("a.css", b'@import "b.css";')
+        self.write("b.css", b'@import "a.css";')
+        html = self.assets.rewrite('<link rel="stylesheet" href="a.css">', self.html)
+        a = base64.b64decode(html.split("base64,")[1].split('"')[0])
+        b = base64.b64decode(a.split(b"base64,")[1].split(b'"')[0])
+        self.assertTrue(b.startswith(b'@import "file:'))
+        self.assertEqual(self.assets.fetches, 2)
+
+    def test_stylesheet_charsets(self):
+        from imgkit.assets import file_url
+
+        css = u"p:after { content: '\xe9'; background: url(img/dot.png) }"
+        self.write("latin.css", css.encode("latin-1"))
+        self.write(
+            "declared.css",
+            u'@charset "iso-8859-1"; p:after { content: "\xe9"; }'.encode("latin-1"),
+        )
+        latin = file_url(os.path.join(self.directory, "latin.css"))
+        self.assertIsNone(self.assets.reference(latin))
+        html = self.assets.rewrite('<link rel="stylesheet" href="latin.css">', self.html)
+        self.assertIn(latin, html)
+        reference = self.assets.reference(file_url(os.path.join(self.directory, "declared.css")))
+        self.assertTrue(reference.startswith("data:text/css;base64,"))
+
+    def test_file_source(self):
+        r = imgkit.IMGKit(self.html, "file", css="fixtures/example.css", assets=self.assets)
+        command = r.command()
+        self.assertEqual(command[-2:], ["-", "-"])
+        self.assertTrue(r.source.isString())
+        payload = r._buffered_payload()
+        self.assertIn(b"data:image/png;base64,", payload)
+        self.assertIn(b"font-size", payload)
+        self.assertIn("assets", r.stats.stages)
+        output = imgkit.from_file(self.html, False, assets=self.assets)
+        self.assertEqual(output[:4], b"\xff\xd8\xff\xe0")
+
+    def test_url_source(self):
+        r = imgkit.IMGKit("http://ya.ru", "url", assets=self.assets)
+        with self.assertRaises(r.SourceError):
+            r.command()
+
+
+@unittest.skipIf(os.name == "nt", "needs a POSIX shell")
+class TestDAssetServer(ScriptBinaryMixin, unittest.TestCase):
+    def setUp(self):
+        super(TestDAssetServer, self).setUp()
+        with open(os.path.join(self.directory, "logo.png"), "wb") as f:
+            f.write(PNG_HEADER)
+        self.server = imgkit.AssetServer(self.directory)
+        self.server.start()
+        self.config.asset_server = self.server
+
+    def tearDown(self):
+        self.server.close()
+        super(TestDAssetServer, self).tearDown()
+
+    def get(self, connection, path):
+        connection.request("GET", path)
+        response = connection.getresponse()
+        return response.status, response.getheader("Cache-Control"), response.read()
+
+    def test_pages_and_assets(self):
+        from six.moves import http_client
+
+        url = self.server.publish(u"<p>page</p>")
+        self.assertEqual(url, self.server.publish(u"<p>page</p>"))
+        path = url[len(self.server.url) - 1 :]
+        # one keep-alive connection for every request
+        connection = http_client.HTTPConnection(self.server.host, self.server.port)
+        self.assertEqual(self.get(connection, path), (200, "max-age=3600", b"<p>page</p>"))
+        self.assertEqual(self.get(connection, "/logo.png")[::2], (200, PNG_HEADER))
+        self.assertEqual(self.get(connection, "/../../etc/passwd")[0], 404)
+        self.server.unpublish(url)
+        self.assertEqual(self.get(connection, path)[0], 200)
+        self.server.unpublish(url)
+        self.assertEqual(self.get(connection, path)[0], 404)
+        connection.close()
+
+    def test_served_source(self):
+        # fetches the url before the output argument
+        self.write_binary(
+            'for arg; do url=$last; last=$arg; done\n'
+            '{} -c "import sys; from six.moves.urllib.request import urlopen; '
+            'print(urlopen(sys.argv[1]).read().decode())" "$url"\n'.format(sys.executable)
+        )
+        html = u'<html><head></head><body><img src="logo.png"></body></html>'
+        output = imgkit.from_string(html, False, config=self.config, css="fixtures/example.css")
+        self.assertIn(b"font-size", output)
+        self.assertIn(b'<img src="logo.png">', output)
+        self.assertEqual(self.server._pages, {})
+
+        # pages are published by renders only
+        r = imgkit.IMGKit(html, "served", config=self.config)
+        self.assertEqual(r.command()[-2:], ["-", "-"])
+        self.assertIn(b"<img", r._stdin_payload())
+        self.assertEqual(self.server._pages, {})
+
+    def test_served_cache_key_ignores_port(self):
+        self.write_binary("cat > /dev/null\nprintf image\n")
+        cache = imgkit.MemoryCache()
+        html = u"<p>cached</p>"
+        imgkit.from_string(html, False, config=self.config, cache=cache)
+        self.server.close()
+        self.server.port = 0
+        self.server.start()
+        r = imgkit.IMGKit(html, "served", config=self.config, cache=cache)
+        self.assertEqual(r.to_img(), b"image")
+        self.assertTrue(r.stats.cached)
+
+
+class TestDAdaptiveScheduler(unittest.TestCase):
+    def queue(self, scheduler, priorities):
+        started = []
+        for priority in priorities:
+            scheduler._enqueue(priority, lambda priority=priority: started.append(priority))
+        return started
+
+    def test_priority_order(self):
+        from imgkit.scheduler import BULK, INTERACTIVE
+
+        scheduler = imgkit.AdaptiveScheduler(min_workers=1, max_workers=1)
+        scheduler.acquire()
+        started = self.queue(scheduler, [BULK, INTERACTIVE, BULK, INTERACTIVE])
+        self.assertEqual(scheduler.waiting, 4)
+        for _ in range(4):
+            scheduler.release()
+        self.assertEqual(started, [INTERACTIVE, INTERACTIVE, BULK, BULK])
+
+    def test_memory_budget(self):
+        scheduler = imgkit.AdaptiveScheduler(max_workers=8, memory_budget=1000, rss_estimate=100)
+        scheduler.limit = 8
+        scheduler.acquire()
+        stats = imgkit.RenderStats()
+        stats.max_rss = 400
+        scheduler.release(stats)
+        self.assertEqual(scheduler.rss_estimate, 400)
+        self.assertEqual(scheduler.limit, 2)
+
+    def test_load_and_latency(self):
+        from imgkit import scheduler as module
+
+        load = module._load
+        scheduler = imgkit.AdaptiveScheduler(min_workers=1, max_workers=3, max_load=4, interval=0)
+        scheduler.limit = 1
+        try:
+            module._load = lambda: 1.0
+            scheduler.acquire()
+            self.queue(scheduler, [0, 0])
+            scheduler.release()
+            self.assertEqual(scheduler.limit, 2)
+            module._load = lambda: 9.0
+            scheduler.release()
+            self.assertEqual(scheduler.limit, 1)
+        finally:
+            module._load = load
+
+    def test_render_many(self):
+        scheduler = imgkit.AdaptiveScheduler(max_workers=2)
+        jobs = [{"source": "html", "priority": priority} for priority in (10, 0, 5)]
+        results = imgkit.render_many(jobs, scheduler=scheduler)
+        self.assertEqual([result.index for result in results], [0, 1, 2])
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual(scheduler.running, 0)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "asyncio.run requires Python 3.7+")
+    def test_async(self):
+        import asyncio
+
+        from imgkit.scheduler import INTERACTIVE
+
+        scheduler = imgkit.AdaptiveScheduler(min_workers=1, max_workers=1)
+
+        async def main():
+            return await asyncio.gather(
+                imgkit.from_string_async("html", False, semaphore=scheduler),
+                imgkit.from_string_async(
+                    "html", False, semaphore=scheduler, priority=INTERACTIVE
+                ),
+            )
+
+        images = asyncio.run(main())
+        self.assertEqual([image[:4] for image in images], [b"\xff\xd8\xff\xe0"] * 2)
+        self.assertEqual(scheduler.running, 0)
+
+
+class TestDErrorsAndRetries(ScriptBinaryMixin, unittest.TestCase):
+    def write_flaky_binary(self, failures, stderr):
+        """Fails ``failures`` times with ``stderr``, then renders"""
+
+        self.calls = os.path.join(self.directory, "calls")
+        self.write_binary(
+            "cat > /dev/null\necho x >> {0}\n"
+            'if [ $(wc -l < {0}) -le {1} ]; then echo "{2}" >&2; exit 1; fi\n'
+            "printf image\n".format(self.calls, failures, stderr)
+        )
+
+    def count_calls(self):
+        with open(self.calls) as f:
+            return len(f.readlines())
+
+    def test_classify(self):
+        from imgkit import errors
+
+        cases = [
+            ("Exit with code 1 due to network error: HostNotFoundError", 1, errors.NetworkError),
+            ("QXcbConnection: Could not connect to display", 1, errors.DisplayError),
+            ("Exit with code 1 due to network error: ContentNotFoundError", 1, errors.InputError),
+            ("Unknown long argument --bad", 1, errors.OptionError),
+            ("", -9, errors.CrashError),
+            ("Error: something else", 1, errors.RenderError),
+        ]
+        for stderr, exit_code, error_class in cases:
+            error = errors.classify("failed", stderr, exit_code)
+            self.assertIs(type(error), error_class)
+            self.assertIsInstance(error, OSError)
+            self.assertEqual(error.exit_code, exit_code)
+        self.assertTrue(issubclass(imgkit.IMGKit.RenderTimeout, imgkit.TransientError))
+
+    @unittest.skipIf(os.name == "nt", "POSIX signals")
+    def test_classify_resource_limits(self):
+        import signal
+
+        from imgkit import errors
+
+        cases = [
+            (-signal.SIGXCPU, {}, errors.ResourceLimitError),
+            (-signal.SIGKILL, {"cpu_limit": 10}, errors.ResourceLimitError),
+            (-signal.SIGABRT, {"memory_limit": 2 ** 28}, errors.ResourceLimitError),
+            (-signal.SIGSEGV, {"memory_limit": 2 ** 28, "cpu_limit": 10}, errors.CrashError),
+            (-signal.SIGKILL, {"memory_limit": 2 ** 28}, errors.CrashError),
+        ]
+        for exit_code, limits, error_class in cases:
+            error = errors.classify("failed", "", exit_code, **limits)
+            self.assertIs(type(error), error_class)
+        self.assertFalse(errors.ResourceLimitError.transient)
+        self.assertTrue(errors.CrashError.transient)
+
+    @unittest.skipIf(os.name == "nt", "POSIX signals")
+    def test_cpu_limit_is_not_retried(self):
+        from imgkit.errors import ResourceLimitError
+
+        self.write_binary("cat > /dev/null\nkill -XCPU $$\n")
+        self.config.retry = imgkit.RetryPolicy(backoff=0)
+        r = imgkit.IMGKit("html", "string", config=self.config, cpu_limit=10)
+        with self.assertRaises(ResourceLimitError):
+            r.to_img()
+        self.assertEqual(r.stats.retries, 0)
+
+    def test_retry_policy(self):
+        policy = imgkit.RetryPolicy(attempts=3, backoff=1, max_backoff=3, jitter=0.5)
+        self.assertTrue(1.5 <= policy.delay(5) <= 3)
+        self.assertTrue(0.5 <= policy.delay(1) <= 1)
+        from imgkit.errors import InputError, NetworkError
+
+        self.assertTrue(policy.should_retry(NetworkError("x"), 2))
+        self.assertFalse(policy.should_retry(NetworkError("x"), 3))
+        self.assertFalse(policy.should_retry(InputError("x"), 1))
+
+    def test_transient_failure_is_retried(self):
+        self.write_flaky_binary(2, "Exit with code 1 due to network error: TimeoutError")
+        self.config.retry = imgkit.RetryPolicy(attempts=3, backoff=0)
+        r = imgkit.IMGKit("html", "string", config=self.config)
+        self.assertEqual(r.to_img(False), b"image")
+        self.assertEqual(r.stats.retries, 2)
+        self.assertEqual(self.count_calls(), 3)
+
+    def test_permanent_failure_is_not_retried(self):
+        from imgkit.errors import InputError
+
+        self.write_flaky_binary(2, "Exit with code 1 due to network error: ContentNotFoundError")
+        self.config.retry = imgkit.RetryPolicy(attempts=3, backoff=0)
+        with self.assertRaises(InputError):
+            imgkit.from_string("html", False, config=self.config)
+        self.assertEqual(self.count_calls(), 1)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "asyncio.run requires Python 3.7+")
+    def test_async_retry(self):
+        import asyncio
+
+        self.write_flaky_binary(1, "Exit with code 1 due to network error: HostNotFoundError")
+        self.config.retry = imgkit.RetryPolicy(backoff=0)
+        image = asyncio.run(imgkit.from_string_async("html", False, config=self.config))
+        self.assertEqual(image, b"image")
+        self.assertEqual(self.count_calls(), 2)
+
+
 class TestECommandNotFound(unittest.TestCase):
     def test_cmd_not_found(self):
         config = imgkit.config()